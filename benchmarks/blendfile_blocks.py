@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Benchmarks the memory use and open time of the block index.
+
+Compares the object-per-block layout (a BlendFileBlock per block, indexed in
+lists and dicts) with the compact, array-backed BlendFileBlockTable. Each
+layout is timed when just opening the file, and when also building the
+address index used to resolve pointers.
+
+Usage: python3 benchmarks/blendfile_blocks.py some.blend [repeats]
+"""
+
+import gc
+import pathlib
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from blender_cloud import blendfile
+
+
+def open_and_index(filepath: str, compact: bool, resolve: bool) -> blendfile.BlendFile:
+    bfile = blendfile.open_blend(filepath, use_mmap=True, compact=compact)
+    if resolve:
+        # Looking up a single address builds the complete address index.
+        bfile.find_block_from_offset(0)
+    return bfile
+
+
+def bench_time(filepath: str, compact: bool, resolve: bool) -> float:
+    start = time.perf_counter()
+    bfile = open_and_index(filepath, compact, resolve)
+    duration = time.perf_counter() - start
+    bfile.close()
+    return duration
+
+
+def bench_memory(filepath: str, compact: bool, resolve: bool) -> int:
+    # Decode the DNA catalog outside of the measurement, so that only the
+    # block index is measured.
+    open_and_index(filepath, compact, False).close()
+
+    gc.collect()
+    tracemalloc.start()
+    bfile = open_and_index(filepath, compact, resolve)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    bfile.close()
+    return size
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        raise SystemExit(1)
+    filepath = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with blendfile.open_blend(filepath, use_mmap=True, compact=True) as bfile:
+        print('%s: %d blocks' % (filepath, len(bfile.blocks)))
+
+    cases = [
+        ('objects', False, False),
+        ('compact', True, False),
+        ('objects + address index', False, True),
+        ('compact + address index', True, True),
+    ]
+    print('%-26s %10s %12s' % ('', 'open', 'memory'))
+    for label, compact, resolve in cases:
+        duration = min(bench_time(filepath, compact, resolve) for _ in range(repeats))
+        size = bench_memory(filepath, compact, resolve)
+        print('%-26s %9.3fs %9.1f MiB' % (label, duration, size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Benchmarks opening and re-saving compressed blend files.
+
+Compares the previous approach (decompress into a temporary file, compress
+single-threaded with the gzip module) with decompressing into memory and
+compressing in parallel, and with decompressing into a temporary file and
+compressing in parallel.
+
+Usage: python3 benchmarks/blendfile_gzip.py some.blend [repeats]
+
+The blend file is copied (and compressed, if it isn't already) into a
+temporary directory first, so the original is never modified.
+"""
+
+import gzip
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from blender_cloud import blendfile
+
+
+def legacy_open(filepath: str):
+    handle = tempfile.TemporaryFile()
+    with gzip.open(filepath, 'rb') as fs:
+        data = fs.read(blendfile.FILE_BUFFER_SIZE)
+        while data:
+            handle.write(data)
+            data = fs.read(blendfile.FILE_BUFFER_SIZE)
+    handle.seek(0, os.SEEK_SET)
+    return handle
+
+
+def legacy_close(handle, filepath: str):
+    handle.seek(0, os.SEEK_SET)
+    with gzip.open(filepath, 'wb') as fs:
+        data = handle.read(blendfile.FILE_BUFFER_SIZE)
+        while data:
+            fs.write(data)
+            data = handle.read(blendfile.FILE_BUFFER_SIZE)
+    handle.close()
+
+
+def bench_legacy(filepath: str) -> (float, float):
+    start = time.perf_counter()
+    handle = legacy_open(filepath)
+    bfile = blendfile.BlendFile(handle)
+    opened = time.perf_counter()
+    legacy_close(bfile.handle, filepath)
+    return opened - start, time.perf_counter() - opened
+
+
+def bench_current(filepath: str, max_in_memory_size=None) -> (float, float):
+    start = time.perf_counter()
+    bfile = blendfile.open_blend(filepath, 'rb+', max_in_memory_size=max_in_memory_size)
+    opened = time.perf_counter()
+    bfile.is_modified = True
+    bfile.close()
+    return opened - start, time.perf_counter() - opened
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        raise SystemExit(1)
+    source = pathlib.Path(sys.argv[1])
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = str(pathlib.Path(tmpdir) / source.name)
+        with source.open('rb') as infile:
+            is_compressed = infile.read(2) == b'\x1f\x8b'
+        if is_compressed:
+            shutil.copyfile(str(source), filepath)
+        else:
+            with source.open('rb') as infile, gzip.open(filepath, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, blendfile.FILE_BUFFER_SIZE)
+        print('%s: %d bytes compressed' % (source.name, os.path.getsize(filepath)))
+
+        cases = [
+            ('temp file + gzip (old)', bench_legacy),
+            ('in memory + parallel', bench_current),
+            ('temp file + parallel', lambda path: bench_current(path, max_in_memory_size=0)),
+        ]
+        print('%-26s %10s %10s' % ('', 'open', 'save'))
+        for label, bench in cases:
+            timings = [bench(filepath) for _ in range(repeats)]
+            print('%-26s %9.3fs %9.3fs' % (label,
+                                          min(t[0] for t in timings),
+                                          min(t[1] for t in timings)))
+
+
+if __name__ == '__main__':
+    main()
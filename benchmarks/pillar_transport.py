@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Benchmarks the threaded and the asyncio-native HTTP transport.
+
+Runs against a local stub server that answers after a fixed delay, to
+mimic network latency. Each workload is run on both transports:
+
+- Pillar API calls (pillarsdk.Node.find), as done by pillar_call() but
+  without its concurrency limit;
+- thumbnail downloads with pillar.download_to_file().
+
+The threaded transport runs 'requests' on the default executor, sized as
+in async_loop.setup_asyncio_executor(), and on the executors of the HTTP
+pools. The number of threads is sampled while the workload runs; the native
+transport should need none.
+
+Usage: python3 benchmarks/pillar_transport.py [requests] [latency in ms]
+"""
+
+import asyncio
+import concurrent.futures
+import http.server
+import json
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+import pillarsdk
+
+from blender_cloud import async_http, download_index, http_pools, pillar
+
+THUMBNAIL = b'\xff\xd8\xff' + bytes(8 * 1024)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.05
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # The pillarsdk sends 'null' as body of GET requests.
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        if self.path.startswith('/api/nodes/'):
+            body = json.dumps({'_id': self.path.rsplit('/', 1)[1], 'name': 'Bricks',
+                               'node_type': 'texture'}).encode()
+            content_type = 'application/json'
+        else:
+            body = THUMBNAIL
+            content_type = 'image/jpeg'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"%s"' % self.path)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+async def api_calls(base_url: str, count: int):
+    api = pillarsdk.Api(endpoint=base_url + '/api/', username='user', password='PILLAR',
+                        token='token')
+    api.requests_session = pillar.uncached_session
+    transport = pillar._native_transport()
+    coros = [pillar._perform_pillar_call(transport, api, pillarsdk.Node.find,
+                                         ('%024x' % idx, ), {})
+             for idx in range(count)]
+    nodes = await asyncio.gather(*coros)
+    assert all(node.name == 'Bricks' for node in nodes)
+
+
+async def downloads(base_url: str, count: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = download_index.DownloadIndex(str(pathlib.Path(tmpdir) / 'downloads.sqlite'))
+        try:
+            coros = [pillar.download_to_file('%s/thumbs/%i.jpg' % (base_url, idx),
+                                             '%s/%i.jpg' % (tmpdir, idx), index=index)
+                     for idx in range(count)]
+            await asyncio.gather(*coros)
+        finally:
+            index.close()
+
+
+def run(workload, base_url: str, count: int, native: bool) -> (float, int):
+    pillar.NATIVE_TRANSPORT = native
+    pillar._downloaded_urls.clear()
+    max_workers = max(10, pillar.pillar_limiter.max_limit + 4)
+
+    peak_threads = 0
+    done = threading.Event()
+
+    def sample_threads():
+        nonlocal peak_threads
+        while not done.wait(0.005):
+            workers = sum(1 for thread in threading.enumerate()
+                          if thread.name.startswith(('transport-benchmark', 'blender-cloud-')))
+            peak_threads = max(peak_threads, workers)
+
+    sampler = threading.Thread(target=sample_threads)
+    sampler.start()
+
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                     thread_name_prefix='transport-benchmark')
+    loop.set_default_executor(executor)
+    asyncio.set_event_loop(loop)
+    try:
+        start = time.perf_counter()
+        loop.run_until_complete(workload(base_url, count))
+        duration = time.perf_counter() - start
+    finally:
+        async_http.default_transport().close()
+        http_pools.close()
+        loop.close()
+        executor.shutdown()
+        done.set()
+        sampler.join()
+    return duration, peak_threads
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    StubHandler.latency = int(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%i' % server.server_port
+
+    print('%i requests, %i ms latency' % (count, StubHandler.latency * 1000))
+    print('%-12s %-9s %10s %15s' % ('workload', 'transport', 'time', 'executor threads'))
+    try:
+        for workload in (api_calls, downloads):
+            for native in (False, True):
+                duration, threads = run(workload, base_url, count, native)
+                print('%-12s %-9s %8.2f s %15i' % (workload.__name__,
+                                                    'native' if native else 'threaded',
+                                                    duration, threads))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,605 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""HTTP/1.1 client on asyncio streams.
+
+This performs requests on the asyncio loop itself, instead of running the
+blocking 'requests' library on the default executor, so that many requests
+can be in flight without a thread per request. It supports what the add-on
+needs from Pillar: keep-alive connections, TLS, redirects and streamed
+response bodies. Proxies are not supported; see supported().
+
+Responses mimic the parts of requests.Response that the add-on uses, and
+errors are raised as the corresponding 'requests' exceptions, so that code
+can handle both transports the same way.
+
+The pillarsdk is synchronous. run_replayed() runs such synchronous code on
+the loop by letting it fail on each HTTP request it makes, performing that
+request asynchronously, and running it again with the recorded responses.
+"""
+
+import asyncio
+import base64
+import collections
+import json
+import logging
+import pathlib
+import ssl
+import time
+import typing
+import urllib.parse
+import urllib.request
+import uuid
+
+import requests.certs
+import requests.exceptions
+import requests.structures
+
+from . import concurrency
+
+log = logging.getLogger(__name__)
+
+# Maximum number of simultaneous connections to one host.
+MAX_CONNECTIONS_PER_HOST = 32
+
+# Idle keep-alive connections are closed after this many seconds.
+KEEPALIVE_TIMEOUT = 15
+
+CONNECT_TIMEOUT = 30
+CONNECT_RETRIES = 3
+MAX_REDIRECTS = 10
+
+# Maximum number of requests a replayed function may perform.
+MAX_REPLAYED_REQUESTS = 20
+
+USER_AGENT = 'blender-cloud-async-http/1.0'
+
+_REDIRECT_STATUS_CODES = {301, 302, 303, 307, 308}
+_default_transport = None
+
+
+class NotSupportedError(Exception):
+    """Raised when a request can only be performed by the threaded transport."""
+
+
+def supported() -> bool:
+    """Returns whether the native transport can be used in this environment."""
+
+    # The requests library honours proxy settings; we don't implement those.
+    return not urllib.request.getproxies()
+
+
+class RequestInfo(typing.NamedTuple):
+    """The parts of requests.PreparedRequest that are used in error messages."""
+    method: str
+    url: str
+
+
+class Response:
+    """HTTP response, with the interface of requests.Response that we use.
+
+    Use 'await response.read()' before using content, text or json().
+    Unread responses must be closed to release their connection.
+    """
+
+    def __init__(self, method: str, url: str, status_code: int, reason: str,
+                 headers: requests.structures.CaseInsensitiveDict,
+                 connection: '_Connection', transport: 'Transport'):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.request = RequestInfo(method, url)
+        self._connection = connection
+        self._transport = transport
+        self._content = None  # type: typing.Optional[bytes]
+
+        # How to find the end of the body.
+        if method == 'HEAD' or status_code in (204, 304) or 100 <= status_code < 200:
+            self._remaining = 0
+            self._chunked = False
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            self._remaining = None
+            self._chunked = True
+        elif headers.get('Content-Length') is not None:
+            self._remaining = int(headers['Content-Length'])
+            self._chunked = False
+        else:
+            # Read until the server closes the connection.
+            self._remaining = None
+            self._chunked = False
+        self._chunk_left = 0
+        self._keep_alive = (headers.get('Connection', '').lower() != 'close' and
+                            (self._chunked or self._remaining is not None))
+
+        if self._remaining == 0:
+            self._content = b''
+            self._release()
+
+    def __repr__(self):
+        return '<%s [%i]>' % (type(self).__name__, self.status_code)
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            raise RuntimeError('Response body was not read; await response.read() first')
+        return self._content
+
+    @property
+    def text(self) -> str:
+        content_type = self.headers.get('Content-Type', '')
+        _, params = _parse_header_params(content_type)
+        return self.content.decode(params.get('charset', 'utf-8'), errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.exceptions.HTTPError(
+                '%i %s Error: %s for url: %s' % (self.status_code, kind, self.reason, self.url),
+                response=self)
+
+    async def read(self) -> bytes:
+        """Reads the entire body."""
+
+        if self._content is None:
+            blocks = []
+            async for block in self.iter_content(256 * 1024):
+                blocks.append(block)
+            self._content = b''.join(blocks)
+        return self._content
+
+    async def iter_content(self, chunk_size: int) -> typing.AsyncIterator[bytes]:
+        """Yields the body in blocks of at most chunk_size bytes."""
+
+        if self._content is not None:
+            if self._content:
+                yield self._content
+            return
+
+        try:
+            while True:
+                block = await self._read_block(chunk_size)
+                if not block:
+                    break
+                yield block
+        except (OSError, asyncio.IncompleteReadError) as ex:
+            self._keep_alive = False
+            self.close()
+            raise requests.exceptions.ChunkedEncodingError(
+                'Connection broken while reading %s: %s' % (self.url, ex))
+        except BaseException:
+            # Also when the caller stops iterating; the connection can be
+            # reused if the body was read completely.
+            self.close()
+            raise
+        self._release()
+
+    async def _read_block(self, chunk_size: int) -> bytes:
+        reader = self._connection.reader
+
+        if self._chunked:
+            if self._chunk_left == 0:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    raise asyncio.IncompleteReadError(line, None)
+                self._chunk_left = int(line.split(b';', 1)[0], 16)
+                if self._chunk_left == 0:
+                    # Skip trailers until the empty line.
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self._chunked = False
+                    self._remaining = 0
+                    return b''
+            block = await reader.read(min(chunk_size, self._chunk_left))
+            if not block:
+                raise asyncio.IncompleteReadError(block, self._chunk_left)
+            self._chunk_left -= len(block)
+            if self._chunk_left == 0:
+                await reader.readexactly(2)  # CRLF after the chunk data
+            return block
+
+        if self._remaining is None:
+            return await reader.read(chunk_size)
+        if self._remaining == 0:
+            return b''
+        block = await reader.read(min(chunk_size, self._remaining))
+        if not block:
+            raise asyncio.IncompleteReadError(block, self._remaining)
+        self._remaining -= len(block)
+        return block
+
+    def _release(self):
+        """Returns the connection to the pool after the body was read."""
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            self._transport._release(connection, reusable=self._keep_alive)
+
+    def close(self):
+        """Releases the connection; an unread body makes it unusable for further requests."""
+        if self._content is None and self._remaining != 0:
+            self._keep_alive = False
+        self._release()
+
+
+class _Connection:
+    def __init__(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.reused = False
+        self.limiter_token = None
+
+    def close(self):
+        self.writer.close()
+
+    def is_usable(self) -> bool:
+        return (not self.reader.at_eof() and
+                time.monotonic() - self.last_used < KEEPALIVE_TIMEOUT)
+
+
+class Transport:
+    """Pool of keep-alive connections, used to perform requests."""
+
+    def __init__(self, max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST):
+        self.max_connections_per_host = max_connections_per_host
+        self._idle = collections.defaultdict(list)  # {(scheme, host, port): [_Connection]}
+        self._limiters = {}  # {(scheme, host, port): AdaptiveLimiter}
+        self._loop = None
+        self._ssl_context = None
+
+        self.requests = 0
+        self.connections_opened = 0
+
+    def _check_loop(self):
+        # Connections are bound to the loop they were created on.
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            self.close()
+            self._loop = loop
+            self._limiters.clear()
+
+    def close(self):
+        """Closes all idle connections."""
+        for connections in self._idle.values():
+            for connection in connections:
+                try:
+                    connection.close()
+                except RuntimeError:
+                    # The loop it belonged to is already closed.
+                    pass
+        self._idle.clear()
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'connections_opened': self.connections_opened,
+            'idle_connections': sum(len(conns) for conns in self._idle.values()),
+        }
+
+    async def request(self, method: str, url: str, *,
+                      headers: typing.Mapping[str, str] = None,
+                      data: typing.Union[bytes, str, dict, None] = None,
+                      auth: typing.Tuple[str, str] = None,
+                      body_length: int = None,
+                      body_iter: typing.Callable[[], typing.AsyncIterator[bytes]] = None,
+                      stream=False,
+                      allow_redirects=True) -> Response:
+        """Performs an HTTP request.
+
+        :param data: request body; dicts are form-encoded.
+        :param body_iter: function returning an async iterator of the request
+            body, as alternative to 'data' for large bodies. Requires body_length.
+        :param stream: when False, the body is read before returning.
+        """
+
+        self._check_loop()
+        headers = requests.structures.CaseInsensitiveDict(headers or {})
+        if auth is not None:
+            credentials = ('%s:%s' % auth).encode('utf8')
+            headers['Authorization'] = 'Basic %s' % base64.b64encode(credentials).decode()
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data)
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        if isinstance(data, str):
+            data = data.encode('utf8')
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self._request_once(method, url, headers, data,
+                                                body_length, body_iter)
+            location = response.headers.get('Location')
+            if (not allow_redirects or response.status_code not in _REDIRECT_STATUS_CODES
+                    or not location or body_iter is not None):
+                break
+
+            response.close()
+            new_url = urllib.parse.urljoin(url, location)
+            if urllib.parse.urlsplit(new_url).netloc != urllib.parse.urlsplit(url).netloc:
+                headers.pop('Authorization', None)
+            if response.status_code == 303 or (response.status_code in (301, 302)
+                                               and method == 'POST'):
+                method, data = 'GET', None
+                headers.pop('Content-Type', None)
+            log.debug('Following redirect from %s to %s', url, new_url)
+            url = new_url
+        else:
+            raise requests.exceptions.TooManyRedirects('Exceeded %i redirects' % MAX_REDIRECTS)
+
+        if not stream:
+            await response.read()
+        return response
+
+    async def _request_once(self, method, url, headers, data, body_length, body_iter) -> Response:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise requests.exceptions.InvalidSchema('No connection adapter for %r' % url)
+        default_port = 443 if parts.scheme == 'https' else 80
+        port = parts.port or default_port
+        key = (parts.scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = parts.hostname if port == default_port else '%s:%i' % (parts.hostname, port)
+
+        if data is not None:
+            body_length = len(data)
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % host,
+                 'Accept-Encoding: identity',
+                 'Connection: keep-alive']
+        if 'User-Agent' not in headers:
+            lines.append('User-Agent: %s' % USER_AGENT)
+        for name, value in headers.items():
+            if value is not None:
+                lines.append('%s: %s' % (name, value))
+        if body_length is not None:
+            lines.append('Content-Length: %i' % body_length)
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1')
+
+        limiter = self._limiter(key)
+        token = await limiter.acquire()
+        try:
+            # A reused keep-alive connection may have been closed by the server
+            # in the meantime; in that case the request is retried once.
+            while True:
+                connection = await self._connect(key, parts.hostname, port)
+                try:
+                    status_code, reason, response_headers = await self._send(
+                        connection, head, data, body_iter)
+                except (OSError, asyncio.IncompleteReadError) as ex:
+                    connection.close()
+                    if connection.reused and body_iter is None:
+                        log.debug('Reused connection to %s failed, retrying: %s', host, ex)
+                        continue
+                    raise requests.exceptions.ConnectionError(
+                        'Connection to %s failed: %s' % (host, ex))
+                except BaseException:
+                    connection.close()
+                    raise
+                break
+        except BaseException:
+            limiter.release(token, measure=False)
+            raise
+
+        self.requests += 1
+        connection.limiter_token = token
+        return Response(method, url, status_code, reason, response_headers, connection, self)
+
+    async def _send(self, connection: _Connection, head: bytes, data: typing.Optional[bytes],
+                    body_iter) -> tuple:
+        writer = connection.writer
+        writer.write(head)
+        if data:
+            writer.write(data)
+        elif body_iter is not None:
+            async for block in body_iter():
+                writer.write(block)
+                await writer.drain()
+        await writer.drain()
+
+        while True:
+            head = await connection.reader.readuntil(b'\r\n\r\n')
+            status_line, *header_lines = head.decode('latin1').split('\r\n')
+            version, status, *reason = status_line.split(' ', 2)
+            if not version.startswith('HTTP/'):
+                raise requests.exceptions.ConnectionError('Invalid status line %r' % status_line)
+            status_code = int(status)
+            if status_code != 100:
+                break
+
+        response_headers = requests.structures.CaseInsensitiveDict()
+        for line in header_lines:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            name, value = name.strip(), value.strip()
+            if name in response_headers:
+                response_headers[name] += ', ' + value
+            else:
+                response_headers[name] = value
+        if version == 'HTTP/1.0' and response_headers.get('Connection', '').lower() != 'keep-alive':
+            response_headers['Connection'] = 'close'
+        return status_code, reason[0] if reason else '', response_headers
+
+    def _limiter(self, key: tuple) -> concurrency.AdaptiveLimiter:
+        try:
+            return self._limiters[key]
+        except KeyError:
+            limit = self.max_connections_per_host
+            limiter = self._limiters[key] = concurrency.AdaptiveLimiter(limit, limit, limit)
+            return limiter
+
+    async def _connect(self, key: tuple, hostname: str, port: int) -> _Connection:
+        idle = self._idle.get(key)
+        while idle:
+            connection = idle.pop()
+            if connection.is_usable():
+                connection.reused = True
+                return connection
+            connection.close()
+
+        ssl_context = None
+        if key[0] == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context(cafile=requests.certs.where())
+            ssl_context = self._ssl_context
+
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(hostname, port, ssl=ssl_context,
+                                            limit=256 * 1024),
+                    CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                error = requests.exceptions.ConnectTimeout(
+                    'Timeout connecting to %s:%i' % (hostname, port))
+            except OSError as ex:
+                error = requests.exceptions.ConnectionError(
+                    'Unable to connect to %s:%i: %s' % (hostname, port, ex))
+            else:
+                self.connections_opened += 1
+                return _Connection(key, reader, writer)
+            log.debug('Attempt %i: %s', attempt + 1, error)
+            await asyncio.sleep(0.05 * 2 ** attempt)
+        raise error
+
+    def _release(self, connection: _Connection, *, reusable: bool):
+        self._limiter(connection.key).release(connection.limiter_token, measure=False)
+        if not reusable or asyncio.get_event_loop() is not self._loop:
+            connection.close()
+            return
+        connection.last_used = time.monotonic()
+        self._idle[connection.key].append(connection)
+
+
+def _parse_header_params(value: str) -> typing.Tuple[str, dict]:
+    """Parses 'text/html; charset=utf-8' into ('text/html', {'charset': 'utf-8'})."""
+
+    main, *params = value.split(';')
+    parsed = {}
+    for param in params:
+        name, _, param_value = param.partition('=')
+        parsed[name.strip().lower()] = param_value.strip().strip('"')
+    return main.strip(), parsed
+
+
+class _RequestNeeded(BaseException):
+    """Raised by ReplaySession for a request that wasn't performed yet.
+
+    Derived from BaseException so that 'except Exception' clauses in the
+    replayed code don't swallow it.
+    """
+
+    def __init__(self, method: str, url: str, kwargs: dict):
+        super().__init__(method, url)
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+
+
+class _Unsupported(BaseException):
+    """Raised by ReplaySession for a request the transport cannot perform."""
+
+
+class ReplaySession:
+    """Stand-in for a requests.Session that replays recorded responses."""
+
+    def __init__(self, responses: typing.List[Response]):
+        self._responses = responses
+        self._index = 0
+
+    def request(self, method: str, url: str, *, data=None, headers=None, files=None,
+                params=None, **kwargs):
+        if files or params:
+            raise _Unsupported('Unsupported request to %s' % url)
+
+        if self._index < len(self._responses):
+            response = self._responses[self._index]
+            self._index += 1
+            return response
+        raise _RequestNeeded(method, url, {'data': data, 'headers': headers})
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+
+async def run_replayed(transport: Transport, func: typing.Callable[[ReplaySession], typing.Any]):
+    """Runs synchronous HTTP client code with requests performed by the transport.
+
+    func(session) should perform its requests with session.request(). It is
+    called again for every request it performs, with the responses so far
+    recorded in the session, so it must do the same requests in the same
+    order every time, and must not have side effects before its last request.
+
+    :raises NotSupportedError: when func does a request the transport cannot
+        perform; it can then be run on the threaded transport instead.
+    """
+
+    responses = []
+    for _ in range(MAX_REPLAYED_REQUESTS):
+        try:
+            return func(ReplaySession(responses))
+        except _Unsupported as ex:
+            raise NotSupportedError(str(ex))
+        except _RequestNeeded as needed:
+            response = await transport.request(needed.method, needed.url, **needed.kwargs)
+            responses.append(response)
+    raise NotSupportedError('Function performed more than %i requests' % MAX_REPLAYED_REQUESTS)
+
+
+def file_upload_body(field_name: str, path: pathlib.Path, block_size=256 * 1024) \
+        -> typing.Tuple[str, int, typing.Callable[[], typing.AsyncIterator[bytes]]]:
+    """Returns a multipart/form-data body with the file, like requests' files={field_name: file}.
+
+    :returns: (content type, length, body iterator function), for the
+        headers, body_length and body_iter parameters of Transport.request().
+    """
+
+    boundary = uuid.uuid4().hex
+    head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n\r\n' % (
+        boundary, field_name, path.name.replace('"', '%22'))).encode('utf8')
+    tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+    length = len(head) + path.stat().st_size + len(tail)
+
+    async def body_iter():
+        yield head
+        with path.open('rb') as infile:
+            while True:
+                block = infile.read(block_size)
+                if not block:
+                    break
+                yield block
+        yield tail
+
+    return 'multipart/form-data; boundary=%s' % boundary, length, body_iter
+
+
+def default_transport() -> Transport:
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = Transport()
+    return _default_transport
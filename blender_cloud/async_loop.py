@@ -16,13 +16,27 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
-"""Manages the asyncio loop."""
+"""Manages the asyncio loop.
+
+Blender owns the main thread, so the asyncio loop is run one iteration at a
+time from a modal operator, see kick_async_loop(). Instead of doing that on
+a fixed, very short timer, the operator sleeps until the next callback of the
+loop is due. Wake-ups from executor threads and network I/O can't interrupt
+Blender's timers, so while nothing is due the loop is polled at an interval
+that grows as long as the loop stays idle.
+
+Every kick runs the loop for at most KICK_TIME_BUDGET seconds, so that many
+callbacks becoming ready at once don't make the user interface stutter. The
+time spent is measured by kick_stats.
+"""
 
 import asyncio
+import collections
 import traceback
 import concurrent.futures
 import logging
-import gc
+import math
+import time
 import typing
 
 import bpy
@@ -32,6 +46,63 @@ log = logging.getLogger(__name__)
 # Keeps track of whether a loop-kicking operator is already running.
 _loop_kicking_operator_running = False
 
+# Shortest time between two iterations of the asyncio loop, in seconds.
+MIN_KICK_INTERVAL = 0.001
+# Longest time between two iterations while there are unfinished tasks; this is the
+# latency with which results of executor threads and network I/O are picked up.
+MAX_KICK_INTERVAL = 0.1
+# Factor by which the polling interval grows for every iteration in which the loop was idle.
+KICK_INTERVAL_BACKOFF = 1.5
+
+# Time in seconds a kick may spend running the loop before returning to Blender;
+# the rest of the ready callbacks are run on the next kick.
+KICK_TIME_BUDGET = 0.004
+# Maximum number of ready callbacks run per iteration of the loop, so that the
+# time budget is checked in between, even when many are ready at once.
+KICK_BATCH_SIZE = 32
+
+
+class KickStats:
+    """Measures how much time the user interface spends running the asyncio loop."""
+
+    def __init__(self, window: float = 1.0):
+        self.window = window
+        self._kicks = collections.deque()  # (end time, duration) of recent kicks
+
+        self.kicks = 0
+        self.total_time = 0.0
+        self.over_budget = 0  # kicks that stopped with callbacks still ready
+
+    def record(self, duration: float, over_budget: bool):
+        now = time.perf_counter()
+        self._kicks.append((now, duration))
+        self.kicks += 1
+        self.total_time += duration
+        if over_budget:
+            self.over_budget += 1
+        self._forget(now)
+
+    def _forget(self, now: float):
+        while self._kicks and self._kicks[0][0] < now - self.window:
+            self._kicks.popleft()
+
+    def ui_time_per_second(self) -> float:
+        """Returns the seconds spent in the loop per second, over the last window."""
+
+        self._forget(time.perf_counter())
+        return sum(duration for _, duration in self._kicks) / self.window
+
+    def stats(self) -> dict:
+        return {
+            'kicks': self.kicks,
+            'total_time': self.total_time,
+            'over_budget': self.over_budget,
+            'ui_time_per_second': self.ui_time_per_second(),
+        }
+
+
+kick_stats = KickStats()
+
 
 def setup_asyncio_executor():
     """Sets up AsyncIO to run properly on each platform."""
@@ -48,66 +119,123 @@ def setup_asyncio_executor():
     else:
         loop = asyncio.get_event_loop()
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    # Room for the maximum number of simultaneous Pillar calls, and some other work.
+    # Downloads and uploads run on the executors of their HTTP pools, see http_pools.
+    from . import pillar
+    max_workers = max(10, pillar.pillar_limiter.max_limit + 4)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
     loop.set_default_executor(executor)
     # loop.set_debug(True)
 
-    from . import pillar
-    # No more than this many Pillar calls should be made simultaneously
-    pillar.pillar_semaphore = asyncio.Semaphore(3, loop=loop)
 
+def kick_async_loop(*args, time_budget: float = None) -> bool:
+    """Runs iterations of the asyncio event loop, for at most the time budget.
 
-def kick_async_loop(*args) -> bool:
-    """Performs a single iteration of the asyncio event loop.
+    At least one iteration is run. More follow while callbacks are ready and
+    there is time left.
 
+    :param time_budget: time in seconds, defaults to KICK_TIME_BUDGET.
     :return: whether the asyncio loop should stop after this kick.
     """
 
     loop = asyncio.get_event_loop()
 
-    # Even when we want to stop, we always need to do one more
-    # 'kick' to handle task-done callbacks.
-    stop_after_this_kick = False
-
     if loop.is_closed():
         log.warning('loop closed, stopping immediately.')
         return True
 
+    # Even when we want to stop, we always need to do one more
+    # 'kick' to handle task-done callbacks. While callbacks are ready to
+    # run some task is still busy, so only look at the tasks when idle.
+    ready_count, _ = loop_state(loop)
+    stop_after_this_kick = not ready_count and _all_tasks_done()
+
+    if time_budget is None:
+        time_budget = KICK_TIME_BUDGET
+    start = time.perf_counter()
+    while True:
+        _run_iteration(loop)
+        ready_count, _ = loop_state(loop)
+        duration = time.perf_counter() - start
+        if not ready_count or duration >= time_budget:
+            break
+    kick_stats.record(duration, over_budget=bool(ready_count))
+
+    return stop_after_this_kick
+
+
+def _run_iteration(loop: asyncio.AbstractEventLoop):
+    """Runs one iteration of the loop, with at most KICK_BATCH_SIZE ready callbacks."""
+
+    ready = getattr(loop, '_ready', None)
+    held_back = []
+    if ready is not None:
+        while len(ready) > KICK_BATCH_SIZE:
+            held_back.append(ready.pop())
+
+    loop.stop()
+    loop.run_forever()
+
+    # These were ready before anything that was scheduled during this iteration.
+    if held_back:
+        ready.extendleft(held_back)
+
+
+def _all_tasks_done() -> bool:
+    """Returns whether all tasks are done, logging their results if they are."""
+
     all_tasks = asyncio.Task.all_tasks()
     if not len(all_tasks):
         log.debug('no more scheduled tasks, stopping after this kick.')
-        stop_after_this_kick = True
+        return True
 
-    elif all(task.done() for task in all_tasks):
-        log.debug('all %i tasks are done, fetching results and stopping after this kick.',
-                  len(all_tasks))
-        stop_after_this_kick = True
+    if not all(task.done() for task in all_tasks):
+        return False
 
-        # Clean up circular references between tasks.
-        gc.collect()
+    log.debug('all %i tasks are done, fetching results and stopping after this kick.',
+              len(all_tasks))
+    for task_idx, task in enumerate(all_tasks):
+        # noinspection PyBroadException
+        try:
+            res = task.result()
+            log.debug('   task #%i: result=%r', task_idx, res)
+        except asyncio.CancelledError:
+            # No problem, we want to stop anyway.
+            log.debug('   task #%i: cancelled', task_idx)
+        except Exception:
+            print('{}: resulted in exception'.format(task))
+            traceback.print_exc()
 
-        for task_idx, task in enumerate(all_tasks):
-            if not task.done():
-                continue
+    return True
 
-            # noinspection PyBroadException
-            try:
-                res = task.result()
-                log.debug('   task #%i: result=%r', task_idx, res)
-            except asyncio.CancelledError:
-                # No problem, we want to stop anyway.
-                log.debug('   task #%i: cancelled', task_idx)
-            except Exception:
-                print('{}: resulted in exception'.format(task))
-                traceback.print_exc()
 
-            # for ref in gc.get_referrers(task):
-            #     log.debug('      - referred by %s', ref)
+def loop_state(loop: asyncio.AbstractEventLoop) -> typing.Tuple[int, typing.Optional[float]]:
+    """Returns the number of ready callbacks and the time until the next timer is due.
 
-    loop.stop()
-    loop.run_forever()
+    This inspects the internals of asyncio.BaseEventLoop; for other loops it
+    returns (0, None), so that the loop is polled.
+    """
 
-    return stop_after_this_kick
+    ready = getattr(loop, '_ready', None)
+    scheduled = getattr(loop, '_scheduled', None)
+    ready_count = len(ready) if ready is not None else 0
+    if not scheduled:
+        return ready_count, None
+    # A heap; cancelled timers may still be in there, which just means an early wake-up.
+    return ready_count, scheduled[0].when() - loop.time()
+
+
+def next_kick_interval(loop: asyncio.AbstractEventLoop, idle_interval: float) -> float:
+    """Returns the time in seconds until the loop should be kicked again.
+
+    :param idle_interval: the polling interval to use when nothing is due sooner.
+    """
+
+    ready_count, next_timer = loop_state(loop)
+    if ready_count:
+        return MIN_KICK_INTERVAL
+    interval = idle_interval if next_timer is None else min(idle_interval, next_timer)
+    return max(MIN_KICK_INTERVAL, interval)
 
 
 def ensure_async_loop():
@@ -130,6 +258,7 @@ class AsyncLoopModalOperator(bpy.types.Operator):
     bl_label = 'Runs the asyncio main loop'
 
     timer = None
+    idle_interval = MIN_KICK_INTERVAL
     log = logging.getLogger(__name__ + '.AsyncLoopModalOperator')
 
     def __del__(self):
@@ -153,11 +282,21 @@ class AsyncLoopModalOperator(bpy.types.Operator):
         context.window_manager.modal_handler_add(self)
         _loop_kicking_operator_running = True
 
-        wm = context.window_manager
-        self.timer = wm.event_timer_add(0.00001, window=context.window)
+        self.idle_interval = MIN_KICK_INTERVAL
+        self._schedule_kick(context, MIN_KICK_INTERVAL)
 
         return {'RUNNING_MODAL'}
 
+    def _schedule_kick(self, context, interval: float):
+        """Sets the timer to the interval, unless it is close enough already."""
+
+        timer = self.timer
+        if timer is not None:
+            if math.isclose(timer.time_step, interval, rel_tol=0.25):
+                return
+            context.window_manager.event_timer_remove(timer)
+        self.timer = context.window_manager.event_timer_add(interval, window=context.window)
+
     def modal(self, context, event):
         global _loop_kicking_operator_running
 
@@ -167,18 +306,34 @@ class AsyncLoopModalOperator(bpy.types.Operator):
         if not _loop_kicking_operator_running:
             return {'FINISHED'}
 
+        loop = asyncio.get_event_loop()
         if event.type != 'TIMER':
+            # Work started by other operators shouldn't wait for the polling interval.
+            if self.idle_interval > MIN_KICK_INTERVAL and loop_state(loop)[0]:
+                self.idle_interval = MIN_KICK_INTERVAL
+                self._schedule_kick(context, MIN_KICK_INTERVAL)
             return {'PASS_THROUGH'}
 
         # self.log.debug('KICKING LOOP')
+        ready_before, _ = loop_state(loop)
         stop_after_this_kick = kick_async_loop()
         if stop_after_this_kick:
             context.window_manager.event_timer_remove(self.timer)
+            self.timer = None
             _loop_kicking_operator_running = False
 
-            self.log.debug('Stopped asyncio loop kicking')
+            self.log.debug('Stopped asyncio loop kicking; %s', kick_stats.stats())
             return {'FINISHED'}
 
+        # Poll quickly while things happen, and back off while the loop waits.
+        ready_after, _ = loop_state(loop)
+        if ready_before or ready_after:
+            self.idle_interval = MIN_KICK_INTERVAL
+        else:
+            self.idle_interval = min(MAX_KICK_INTERVAL,
+                                     self.idle_interval * KICK_INTERVAL_BACKOFF)
+        self._schedule_kick(context, next_kick_interval(loop, self.idle_interval))
+
         return {'RUNNING_MODAL'}
 
 
@@ -19,16 +19,59 @@
 # (c) 2009, At Mind B.V. - Jeroen Bakker
 # (c) 2014, Blender Foundation - Campbell Barton
 
+import array
+import bisect
+import collections
 import gzip
+import io
 import logging
+import mmap
 import os
 import struct
 import tempfile
+import zlib
 
 log = logging.getLogger("blendfile")
 
 FILE_BUFFER_SIZE = 1024 * 1024
 
+# Compressed blend files that decompress to at most this many bytes are kept
+# in memory, larger ones are decompressed to a temporary file.
+MAX_IN_MEMORY_SIZE = 512 * 1024 * 1024
+
+# Compressed blend files are written in chunks of this size, compressed in parallel.
+GZIP_CHUNK_SIZE = 1024 * 1024
+GZIP_COMPRESS_LEVEL = 9
+
+# Directory for the on-disk cache of decoded DNA catalogs, or None to only
+# cache them in memory. See dna_catalog().
+DNA_CACHE_DIRECTORY = None
+DNA_CACHE_FORMAT_VERSION = 1
+
+# Number of decoded DNA catalogs kept in memory; the least recently used one is
+# forgotten first. Each Blender version has its own catalog.
+DNA_CATALOG_CACHE_SIZE = 8
+
+# SDNA index of raw DATA blocks. Blender writes untyped data (strings, arrays,
+# pointer arrays, packed files) with this index, which is also that of its
+# first struct, Link, so such blocks can't be interpreted through their type.
+RAW_DATA_SDNA_INDEX = 0
+
+# OrderedDict {(fingerprint, pointer_size, endian_index): (structs, sdna_index_from_id)}
+_dna_catalog_cache = collections.OrderedDict()
+
+
+def _import_numpy():
+    """Returns the numpy module, which is only needed for the array API.
+
+    See BlendFileBlock.as_structured_array().
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("NumPy is required to read blend-file blocks as arrays") from None
+    return numpy
+
 
 # -----------------------------------------------------------------------------
 # module global routines
@@ -37,10 +80,27 @@ FILE_BUFFER_SIZE = 1024 * 1024
 # open a filename
 # determine if the file is compressed
 # and returns a handle
-def open_blend(filename, access="rb"):
+def open_blend(filename, access="rb", use_mmap=False, lazy=False, max_in_memory_size=None,
+               compact=False):
     """Opens a blend file for reading or writing pending on the access
     supports 2 kind of blend files. Uncompressed and compressed.
     Known issue: does not support packaged blend files
+
+    When use_mmap is True the file is memory-mapped; block headers and fields
+    are then read straight from the mapped buffer, without seeking the file
+    handle. Unterminated char arrays are returned as memoryview slices of the
+    buffer in that mode, which must be released before the file is closed.
+
+    When lazy is True only the file header and DNA1 catalog are read up front;
+    blocks are indexed on demand, see BlendFile.iter_blocks_from_code().
+
+    Compressed files are decompressed into memory when their uncompressed size
+    is at most max_in_memory_size bytes (defaults to MAX_IN_MEMORY_SIZE), and
+    into a temporary file otherwise.
+
+    When compact is True block headers are stored in a BlendFileBlockTable
+    instead of one BlendFileBlock per block, which saves a lot of memory on
+    files with many blocks.
     """
     handle = open(filename, access)
     magic_test = b"BLENDER"
@@ -48,27 +108,44 @@ def open_blend(filename, access="rb"):
     if magic == magic_test:
         log.debug("normal blendfile detected")
         handle.seek(0, os.SEEK_SET)
-        bfile = BlendFile(handle)
+        bfile = BlendFile(handle, use_mmap=use_mmap, lazy=lazy, compact=compact)
         bfile.is_compressed = False
         bfile.filepath_orig = filename
         return bfile
     elif magic[:2] == b'\x1f\x8b':
         log.debug("gzip blendfile detected")
+        if max_in_memory_size is None:
+            max_in_memory_size = MAX_IN_MEMORY_SIZE
+        # The gzip trailer holds the uncompressed size modulo 2**32, which is
+        # good enough to decide where to decompress to.
+        handle.seek(-4, os.SEEK_END)
+        expected_size = struct.unpack('<I', handle.read(4))[0]
         handle.close()
+
         log.debug("decompressing started")
         fs = gzip.open(filename, "rb")
         data = fs.read(FILE_BUFFER_SIZE)
         magic = data[:len(magic_test)]
         if magic == magic_test:
-            handle = tempfile.TemporaryFile()
+            if expected_size <= max_in_memory_size:
+                handle = io.BytesIO()
+            else:
+                handle = tempfile.TemporaryFile()
             while data:
                 handle.write(data)
+                if handle.tell() > max_in_memory_size and isinstance(handle, io.BytesIO):
+                    log.debug("decompressed data exceeds %d bytes, moving to temporary file",
+                              max_in_memory_size)
+                    in_memory = handle
+                    handle = tempfile.TemporaryFile()
+                    handle.write(in_memory.getbuffer())
+                    del in_memory
                 data = fs.read(FILE_BUFFER_SIZE)
             log.debug("decompressing finished")
             fs.close()
             log.debug("resetting decompressed file")
-            handle.seek(os.SEEK_SET, 0)
-            bfile = BlendFile(handle)
+            handle.seek(0, os.SEEK_SET)
+            bfile = BlendFile(handle, use_mmap=use_mmap, lazy=lazy, compact=compact)
             bfile.is_compressed = True
             bfile.filepath_orig = filename
             return bfile
@@ -78,6 +155,202 @@ def open_blend(filename, access="rb"):
         raise Exception("filetype not a blend or a gzip blend")
 
 
+def gzip_compress_parallel(infile, outfile, *,
+                           chunk_size=GZIP_CHUNK_SIZE,
+                           compresslevel=GZIP_COMPRESS_LEVEL,
+                           max_workers=None):
+    """Compresses infile to outfile (both binary file objects) in gzip format.
+
+    The data is split into chunks that are compressed in a thread pool, like
+    pigz does. Each chunk uses the last 32 KiB of the previous chunk as preset
+    dictionary and ends on a byte boundary, so the concatenated chunks form a
+    single regular deflate stream that any gzip reader can decompress.
+    """
+    import concurrent.futures
+    import time
+
+    window_size = 32 * 1024
+
+    def compress_chunk(chunk, zdict, is_last):
+        if zdict:
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                          zdict=zdict)
+        else:
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        flush_mode = zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH
+        return compressor.compress(chunk) + compressor.flush(flush_mode)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    outfile.write(b'\x1f\x8b\x08\x00' +
+                  struct.pack('<I', int(time.time()) & 0xffffffff) +
+                  b'\x00\xff')
+
+    crc = 0
+    total_size = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Limit the number of pending chunks, so we don't read everything into memory.
+        pending = collections.deque()
+        zdict = b''
+        chunk = infile.read(chunk_size)
+        while True:
+            next_chunk = infile.read(chunk_size)
+            is_last = not next_chunk
+
+            crc = zlib.crc32(chunk, crc)
+            total_size += len(chunk)
+            pending.append(executor.submit(compress_chunk, chunk, zdict, is_last))
+            zdict = chunk[-window_size:]
+
+            while pending and (is_last or len(pending) > 2 * max_workers):
+                outfile.write(pending.popleft().result())
+            if is_last:
+                break
+            chunk = next_chunk
+
+    outfile.write(struct.pack('<II', crc, total_size & 0xffffffff))
+
+
+def dna_catalog(header, data):
+    """Returns (structs, sdna_index_from_id) for the DNA1 block data.
+
+    Every file saved by the same Blender build contains the same DNA1 block,
+    so the last DNA_CATALOG_CACHE_SIZE decoded catalogs are cached per process,
+    keyed by a fingerprint of the block data plus pointer size and endianness.
+    When DNA_CACHE_DIRECTORY is set, catalogs are also pickled there and shared
+    between processes.
+
+    Note that this means that files with the same catalog share their DNAStruct
+    instances, including their 'user_data'.
+    """
+    import hashlib
+
+    fingerprint = hashlib.blake2b(data, digest_size=20).hexdigest()
+    key = (fingerprint, header.pointer_size, header.endian_index)
+    try:
+        catalog = _dna_catalog_cache[key]
+    except KeyError:
+        pass
+    else:
+        _dna_catalog_cache.move_to_end(key)
+        return catalog
+
+    cache_path = None
+    if DNA_CACHE_DIRECTORY:
+        cache_path = os.path.join(DNA_CACHE_DIRECTORY, 'dna-%s-%d%s.v%d.pickle' % (
+            fingerprint, header.pointer_size, 'le' if header.is_little_endian else 'be',
+            DNA_CACHE_FORMAT_VERSION))
+        catalog = _load_dna_catalog(cache_path)
+        if catalog is not None:
+            _remember_dna_catalog(key, catalog)
+            return catalog
+
+    catalog = BlendFile.decode_structs(header, data)
+    _remember_dna_catalog(key, catalog)
+    if cache_path:
+        _save_dna_catalog(cache_path, catalog)
+    return catalog
+
+
+def _remember_dna_catalog(key, catalog):
+    _dna_catalog_cache[key] = catalog
+    while len(_dna_catalog_cache) > DNA_CATALOG_CACHE_SIZE:
+        _dna_catalog_cache.popitem(last=False)
+
+
+def clear_dna_cache():
+    """Forgets all DNA catalogs cached in memory."""
+    _dna_catalog_cache.clear()
+
+
+def _load_dna_catalog(cache_path):
+    import pickle
+
+    try:
+        with open(cache_path, 'rb') as infile:
+            state = pickle.load(infile)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        log.warning('Unable to load DNA catalog from %s: %s', cache_path, ex)
+        return None
+
+    log.debug('loaded DNA catalog from %s', cache_path)
+    names, types, struct_fields, sdna_index_from_id = state
+
+    dna_types = []
+    for dna_type_id, size in types:
+        dna_type = DNAStruct(dna_type_id)
+        dna_type.size = size
+        dna_types.append(dna_type)
+
+    structs = []
+    for type_index, fields in struct_fields:
+        dna_struct = dna_types[type_index]
+        for field_type_index, name_index, dna_size, dna_offset in fields:
+            dna_name = names[name_index]
+            field = DNAField(dna_types[field_type_index], dna_name, dna_size, dna_offset)
+            dna_struct.fields.append(field)
+            dna_struct.field_from_name[dna_name.name_only] = field
+        structs.append(dna_struct)
+
+    return structs, sdna_index_from_id
+
+
+def _save_dna_catalog(cache_path, catalog):
+    """Pickles the catalog as flat tables.
+
+    The DNAStructs reference each other through their fields, so pickling
+    them directly would recurse far too deep.
+    """
+    import pickle
+
+    structs, sdna_index_from_id = catalog
+
+    names = []
+    name_index = {}
+    types = []
+    type_index = {}
+
+    def index_of(dna_type):
+        try:
+            return type_index[id(dna_type)]
+        except KeyError:
+            type_index[id(dna_type)] = len(types)
+            types.append((dna_type.dna_type_id, dna_type.size))
+            return type_index[id(dna_type)]
+
+    struct_fields = []
+    for dna_struct in structs:
+        fields = []
+        for field in dna_struct.fields:
+            if id(field.dna_name) not in name_index:
+                name_index[id(field.dna_name)] = len(names)
+                names.append(field.dna_name)
+            fields.append((index_of(field.dna_type), name_index[id(field.dna_name)],
+                           field.dna_size, field.dna_offset))
+        struct_fields.append((index_of(dna_struct), fields))
+
+    state = (names, types, struct_fields, sdna_index_from_id)
+    try:
+        os.makedirs(DNA_CACHE_DIRECTORY, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=DNA_CACHE_DIRECTORY, delete=False) as outfile:
+            pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as ex:
+        log.warning('Unable to save DNA catalog to %s: %s', cache_path, ex)
+        return
+
+    # Rename into place, so that other processes never see a partial file.
+    try:
+        os.replace(outfile.name, cache_path)
+    except OSError as ex:
+        log.warning('Unable to save DNA catalog to %s: %s', cache_path, ex)
+        os.unlink(outfile.name)
+        return
+    log.debug('saved DNA catalog to %s', cache_path)
+
+
 def pad_up_4(offset):
     return (offset + 3) & ~3
 
@@ -93,55 +366,185 @@ class BlendFile:
     __slots__ = (
         # file (result of open())
         "handle",
+        # mmap.mmap (or None when reading through 'handle')
+        "data",
         # str (original name of the file path)
         "filepath_orig",
         # BlendFileHeader
         "header",
         # struct.Struct
         "block_header_struct",
-        # BlendFileBlock
-        "blocks",
+        # [BlendFileBlock, ...] or BlendFileBlockTable,
+        # possibly incomplete (see 'blocks')
+        "_blocks",
+        # int (file offset of the next block header to index)
+        # or None when all blocks have been indexed
+        "_scan_offset",
         # [DNAStruct, ...]
         "structs",
         # dict {b'StructName': sdna_index}
         # (where the index is an index into 'structs')
         "sdna_index_from_id",
-        # dict {addr_old: block}
+        # dict {addr_old: block}, or None until first used
+        # (unused in compact mode, where '_blocks' has its own index)
         "block_from_offset",
-        # int
+        # dict {code: [BlendFileBlock, ...]}
+        # or in compact mode {code: array('I', [block_index, ...])}
         "code_index",
+        # bool (are blocks stored in a BlendFileBlockTable)
+        "is_compact",
         # bool (did we make a change)
         "is_modified",
         # bool (is file gzipped)
         "is_compressed",
         )
 
-    def __init__(self, handle):
+    def __init__(self, handle, use_mmap=False, lazy=False, compact=False):
         log.debug("initializing reading blend-file")
         self.handle = handle
+        self.data = None
         self.header = BlendFileHeader(handle)
         self.block_header_struct = self.header.create_block_header_struct()
-        self.blocks = []
+        self.is_compact = compact
+        if compact:
+            self._blocks = BlendFileBlockTable(self)
+        else:
+            self._blocks = []
         self.code_index = {}
+        self.structs = None
+        self.sdna_index_from_id = None
+        self.block_from_offset = None
+        self.is_modified = False
 
-        block = BlendFileBlock(handle, self)
-        while block.code != b'ENDB':
-            if block.code == b'DNA1':
-                (self.structs,
-                 self.sdna_index_from_id,
-                 ) = BlendFile.decode_structs(self.header, block, handle)
-            else:
-                handle.seek(block.size, os.SEEK_CUR)
+        # The first block header follows the file header we just read.
+        self._scan_offset = handle.tell()
 
-            self.blocks.append(block)
-            self.code_index.setdefault(block.code, []).append(block)
+        if use_mmap:
+            self.data = self._map_handle(handle)
 
-            block = BlendFileBlock(handle, self)
-        self.is_modified = False
-        self.blocks.append(block)
+        if lazy:
+            dna_block = self._find_dna1_block()
+            if dna_block is not None:
+                self._decode_dna1_block(dna_block)
+                return
+            log.debug("unable to find DNA1 block at end of file, indexing all blocks")
+
+        self._index_all_blocks()
+
+    @staticmethod
+    def _map_handle(handle):
+        if isinstance(handle, io.BytesIO):
+            # Decompressed into memory, no need to map anything.
+            return handle.getbuffer()
+        if handle.writable():
+            access = mmap.ACCESS_WRITE
+        else:
+            access = mmap.ACCESS_READ
+        log.debug("memory-mapping blend-file")
+        return mmap.mmap(handle.fileno(), 0, access=access)
+
+    def _read_block_header_values(self, offset):
+        if self.data is not None:
+            return BlendFileBlock.read_header_values(None, self, offset)
+        self.handle.seek(offset, os.SEEK_SET)
+        return BlendFileBlock.read_header_values(self.handle, self)
+
+    def _read_block_header(self, offset):
+        return BlendFileBlock.from_header_values(self, self._read_block_header_values(offset))
+
+    def _read_block_data(self, block):
+        """Returns the data of the block as bytes."""
+        if self.data is not None:
+            return bytes(self.data[block.file_offset:block.file_offset + block.size])
+        self.handle.seek(block.file_offset, os.SEEK_SET)
+        return self.handle.read(block.size)
+
+    def _decode_dna1_block(self, block):
+        (self.structs,
+         self.sdna_index_from_id,
+         ) = dna_catalog(self.header, self._read_block_data(block))
+
+    def _find_dna1_block(self):
+        """Locates the DNA1 block without indexing the blocks before it.
+
+        Blender writes the DNA1 block just before ENDB, so we look for the
+        start of its data (b'SDNANAME') in the tail of the file.
+
+        :returns: the DNA1 block, or None if it cannot be found this way.
+        """
+        magic = b'SDNANAME'
+        header_size = self.block_header_struct.size
+        first_block_offset = self._scan_offset
+
+        if isinstance(self.data, mmap.mmap):
+            data_offset = self.data.rfind(magic, first_block_offset + header_size)
+        else:
+            handle = self.handle
+            file_size = handle.seek(0, os.SEEK_END)
+            tail_size = FILE_BUFFER_SIZE
+            while True:
+                tail_start = max(file_size - tail_size, first_block_offset + header_size)
+                handle.seek(tail_start, os.SEEK_SET)
+                data_offset = handle.read(file_size - tail_start).rfind(magic)
+                if data_offset != -1:
+                    data_offset += tail_start
+                    break
+                if tail_start == first_block_offset + header_size:
+                    break
+                tail_size *= 4
+
+        if data_offset == -1:
+            return None
 
-        # cache (could lazy init, incase we never use?)
-        self.block_from_offset = {block.addr_old: block for block in self.blocks if block.code != b'ENDB'}
+        block = self._read_block_header(data_offset - header_size)
+        if block.code != b'DNA1' or block.file_offset != data_offset:
+            return None
+        return block
+
+    def _index_next_block(self):
+        """Reads the next block header and adds it to the index.
+
+        :returns: False if all blocks were already indexed, True otherwise.
+        """
+        if self._scan_offset is None:
+            return False
+
+        if self.is_compact:
+            values = self._read_block_header_values(self._scan_offset)
+            block_index = self._blocks.append_values(values)
+            code, size, file_offset = values[0], values[1], values[5]
+        else:
+            block = self._read_block_header(self._scan_offset)
+            self._blocks.append(block)
+            block_index = block
+            code, size, file_offset = block.code, block.size, block.file_offset
+
+        if code == b'ENDB':
+            self._scan_offset = None
+            return True
+
+        if code == b'DNA1' and self.structs is None:
+            self._decode_dna1_block(self._blocks[-1])
+
+        if self.is_compact:
+            try:
+                self.code_index[code].append(block_index)
+            except KeyError:
+                self.code_index[code] = array.array('I', (block_index,))
+        else:
+            self.code_index.setdefault(code, []).append(block_index)
+        self._scan_offset = file_offset + size
+        return True
+
+    def _index_all_blocks(self):
+        while self._scan_offset is not None:
+            self._index_next_block()
+
+    @property
+    def blocks(self):
+        """All blocks in the file, including the final ENDB block."""
+        self._index_all_blocks()
+        return self._blocks
 
     def __enter__(self):
         return self
@@ -151,37 +554,130 @@ class BlendFile:
 
     def find_blocks_from_code(self, code):
         assert(type(code) == bytes)
+        self._index_all_blocks()
         if code not in self.code_index:
             return []
+        if self.is_compact:
+            return [self._blocks[block_index] for block_index in self.code_index[code]]
         return self.code_index[code]
 
+    def iter_blocks_from_code(self, code):
+        """Yields the blocks with the given code, in file order.
+
+        Unlike find_blocks_from_code() this only indexes as many blocks as
+        needed, so on lazily opened files stopping the iteration early avoids
+        reading the rest of the file.
+        """
+        assert(type(code) == bytes)
+        index = 0
+        while True:
+            known_blocks = self.code_index.get(code, ())
+            if index < len(known_blocks):
+                if self.is_compact:
+                    yield self._blocks[known_blocks[index]]
+                else:
+                    yield known_blocks[index]
+                index += 1
+            elif not self._index_next_block():
+                return
+
     def find_block_from_offset(self, offset):
         # same as looking looping over all blocks,
         # then checking ``block.addr_old == offset``
         assert(type(offset) is int)
+        if self.is_compact:
+            self._index_all_blocks()
+            return self._blocks.find_from_addr(offset)
+        if self.block_from_offset is None:
+            self.block_from_offset = {block.addr_old: block for block in self.blocks
+                                      if block.code != b'ENDB'}
         return self.block_from_offset.get(offset)
 
+    def iter_dependencies(self, blocks, *,
+                          max_depth=None,
+                          codes=None,
+                          exclude_codes=(),
+                          visited=None,
+                          include_start=False):
+        """Yields every block reachable through pointers from the given blocks.
+
+        The pointer graph is walked breadth-first and without recursion, and
+        each block is yielded only once, no matter how often it is referenced.
+
+        :param blocks: the block, or iterable of blocks, to start from.
+        :param max_depth: maximum number of pointers to follow from the start
+            blocks, or None to follow everything.
+        :param codes: only yield blocks with these codes; other blocks are
+            still followed. None yields all blocks.
+        :param exclude_codes: blocks with these codes are neither yielded nor followed.
+        :param visited: set of addresses (addr_old) of blocks to skip. It is
+            updated with the addresses seen, so it can be shared between calls.
+        :param include_start: also yield the start blocks.
+        """
+        if isinstance(blocks, BlendFileBlock):
+            blocks = (blocks, )
+        if visited is None:
+            visited = set()
+
+        queue = collections.deque()
+        for block in blocks:
+            if block.addr_old in visited:
+                continue
+            visited.add(block.addr_old)
+            queue.append((block, 0))
+            if include_start and (codes is None or block.code in codes):
+                yield block
+
+        while queue:
+            block, depth = queue.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for pointer in block.iter_pointer_values():
+                if pointer in visited:
+                    continue
+                visited.add(pointer)
+                target = self.find_block_from_offset(pointer)
+                if target is None or target.code in exclude_codes:
+                    continue
+                queue.append((target, depth + 1))
+                if codes is None or target.code in codes:
+                    yield target
+
     def close(self):
         """
         Close the blend file
         writes the blend file to disk if changes has happened
         """
         handle = self.handle
+        close_handle = True
+
+        if self.data is not None:
+            try:
+                if isinstance(self.data, memoryview):
+                    self.data.release()
+                else:
+                    if self.is_modified:
+                        self.data.flush()
+                    self.data.close()
+            except BufferError:
+                # Someone still holds a memoryview of the buffer; it will be
+                # released when that is garbage collected.
+                log.warning("blend-file buffer still in use, not releasing explicitly")
+                # In-memory files cannot be closed while their buffer is in use.
+                close_handle = not isinstance(handle, io.BytesIO)
+            self.data = None
 
         if self.is_modified:
             if self.is_compressed:
                 log.debug("close compressed blend file")
-                handle.seek(os.SEEK_SET, 0)
+                handle.seek(0, os.SEEK_SET)
                 log.debug("compressing started")
-                fs = gzip.open(self.filepath_orig, "wb")
-                data = handle.read(FILE_BUFFER_SIZE)
-                while data:
-                    fs.write(data)
-                    data = handle.read(FILE_BUFFER_SIZE)
-                fs.close()
+                with open(self.filepath_orig, "wb") as fs:
+                    gzip_compress_parallel(handle, fs)
                 log.debug("compressing finished")
 
-        handle.close()
+        if close_handle:
+            handle.close()
 
     def ensure_subtype_smaller(self, sdna_index_curr, sdna_index_next):
         # never refine to a smaller type
@@ -193,16 +689,17 @@ class BlendFile:
                                 self.structs[sdna_index_next].dna_type_id.decode('ascii')))
 
     @staticmethod
-    def decode_structs(header, block, handle):
+    def decode_structs(header, data):
         """
         DNACatalog is a catalog of all information in the DNA1 file-block
+
+        :param data: the contents of the DNA1 block.
         """
         log.debug("building DNA catalog")
         shortstruct = DNA_IO.USHORT[header.endian_index]
         shortstruct2 = struct.Struct(header.endian_str + b'HH')
         intstruct = DNA_IO.UINT[header.endian_index]
 
-        data = handle.read(block.size)
         types = []
         names = []
 
@@ -277,6 +774,127 @@ class BlendFile:
         return structs, sdna_index_from_id
 
 
+class BlendFileBlockTable:
+    """
+    Compact table of block headers, stored column-wise in arrays.
+
+    Behaves like a read-only list of BlendFileBlock; the block objects are
+    only created when a block is accessed, and are kept so that changes made
+    to them (refine_type(), user_data) persist.
+    """
+    __slots__ = (
+        # BlendFile
+        "file",
+        # [code, ...] (distinct block codes, indexed by 'code_ids')
+        "codes",
+        # dict {code: index into 'codes'}
+        "code_id_from_code",
+        # array('H') (index into 'codes', per block)
+        "code_ids",
+        # array('I')
+        "sizes",
+        # array('Q')
+        "addr_olds",
+        # array('I')
+        "sdna_indices",
+        # array('I')
+        "counts",
+        # array('Q')
+        "file_offsets",
+        # dict {block_index: BlendFileBlock}
+        "_views",
+        # array('Q') (sorted addr_old of all blocks but ENDB)
+        # or None until first used
+        "_addr_sorted",
+        # array('I') (block index for each entry in '_addr_sorted')
+        "_addr_order",
+        )
+
+    def __init__(self, bfile):
+        self.file = bfile
+        self.codes = []
+        self.code_id_from_code = {}
+        self.code_ids = array.array('H')
+        self.sizes = array.array('I')
+        self.addr_olds = array.array('Q')
+        self.sdna_indices = array.array('I')
+        self.counts = array.array('I')
+        self.file_offsets = array.array('Q')
+        self._views = {}
+        self._addr_sorted = None
+        self._addr_order = None
+
+    def append_values(self, values):
+        """Adds a block from the values returned by BlendFileBlock.read_header_values().
+
+        :returns: the index of the new block.
+        """
+        code, size, addr_old, sdna_index, count, file_offset = values
+        try:
+            code_id = self.code_id_from_code[code]
+        except KeyError:
+            code_id = self.code_id_from_code[code] = len(self.codes)
+            self.codes.append(code)
+
+        self.code_ids.append(code_id)
+        self.sizes.append(size)
+        self.addr_olds.append(addr_old)
+        self.sdna_indices.append(sdna_index)
+        self.counts.append(count)
+        self.file_offsets.append(file_offset)
+        self._addr_sorted = self._addr_order = None
+        return len(self.code_ids) - 1
+
+    def code_at(self, index):
+        return self.codes[self.code_ids[index]]
+
+    def __len__(self):
+        return len(self.code_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        try:
+            return self._views[index]
+        except KeyError:
+            pass
+
+        values = (self.codes[self.code_ids[index]],
+                  self.sizes[index],
+                  self.addr_olds[index],
+                  self.sdna_indices[index],
+                  self.counts[index],
+                  self.file_offsets[index])
+        block = self._views[index] = BlendFileBlock.from_header_values(self.file, values)
+        return block
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _build_addr_index(self):
+        endb_id = self.code_id_from_code.get(b'ENDB')
+        addr_olds = self.addr_olds
+        code_ids = self.code_ids
+        # Stable sort, so of blocks sharing an address the last one in the
+        # file ends up last, just like in BlendFile.block_from_offset.
+        order = sorted((index for index in range(len(code_ids)) if code_ids[index] != endb_id),
+                       key=addr_olds.__getitem__)
+        self._addr_order = array.array('I', order)
+        self._addr_sorted = array.array('Q', (addr_olds[index] for index in order))
+
+    def find_from_addr(self, addr_old):
+        """Returns the block with the given old address, or None."""
+        if self._addr_sorted is None:
+            self._build_addr_index()
+        pos = bisect.bisect_right(self._addr_sorted, addr_old) - 1
+        if pos < 0 or self._addr_sorted[pos] != addr_old:
+            return None
+        return self[self._addr_order[pos]]
+
+
 class BlendFileBlock:
     """
     Instance of a struct.
@@ -304,42 +922,79 @@ class BlendFileBlock:
                  hex(self.addr_old),
                  ))
 
-    def __init__(self, handle, bfile):
-        OLDBLOCK = struct.Struct(b'4sI')
-
+    def __init__(self, handle, bfile, offset=None):
+        """Reads the block header from the handle, or from the memory-mapped
+        buffer of the blend file at the given offset.
+        """
         self.file = bfile
         self.user_data = None
+        (self.code,
+         self.size,
+         self.addr_old,
+         self.sdna_index,
+         self.count,
+         self.file_offset,
+         ) = self.read_header_values(handle, bfile, offset)
+
+    @classmethod
+    def from_header_values(cls, bfile, values):
+        """Creates a block from the values returned by read_header_values()."""
+        block = cls.__new__(cls)
+        block.file = bfile
+        block.user_data = None
+        (block.code,
+         block.size,
+         block.addr_old,
+         block.sdna_index,
+         block.count,
+         block.file_offset,
+         ) = values
+        return block
+
+    @staticmethod
+    def read_header_values(handle, bfile, offset=None):
+        """Reads a block header from the handle or from the buffer at the given offset.
+
+        :returns: tuple (code, size, addr_old, sdna_index, count, file_offset)
+        """
+        OLDBLOCK = struct.Struct(b'4sI')
 
-        data = handle.read(bfile.block_header_struct.size)
+        header_struct = bfile.block_header_struct
+        if offset is None:
+            data = handle.read(header_struct.size)
+            data_len = len(data)
+        else:
+            data = bfile.data
+            data_len = min(len(data) - offset, header_struct.size)
         # header size can be 8, 20, or 24 bytes long
         # 8: old blend files ENDB block (exception)
         # 20: normal headers 32 bit platform
         # 24: normal headers 64 bit platform
-        if len(data) > 15:
-
-            blockheader = bfile.block_header_struct.unpack(data)
-            self.code = blockheader[0].partition(b'\0')[0]
-            if self.code != b'ENDB':
-                self.size = blockheader[1]
-                self.addr_old = blockheader[2]
-                self.sdna_index = blockheader[3]
-                self.count = blockheader[4]
-                self.file_offset = handle.tell()
+        if data_len > 15:
+
+            if offset is None:
+                blockheader = header_struct.unpack(data)
             else:
-                self.size = 0
-                self.addr_old = 0
-                self.sdna_index = 0
-                self.count = 0
-                self.file_offset = 0
+                blockheader = header_struct.unpack_from(data, offset)
+            code = blockheader[0].partition(b'\0')[0]
+            if code != b'ENDB':
+                if offset is None:
+                    file_offset = handle.tell()
+                else:
+                    file_offset = offset + header_struct.size
+                return (code,
+                        blockheader[1],
+                        blockheader[2],
+                        blockheader[3],
+                        blockheader[4],
+                        file_offset)
         else:
-            blockheader = OLDBLOCK.unpack(data)
-            self.code = blockheader[0].partition(b'\0')[0]
-            self.code = DNA_IO.read_data0(blockheader[0])
-            self.size = 0
-            self.addr_old = 0
-            self.sdna_index = 0
-            self.count = 0
-            self.file_offset = 0
+            if offset is None:
+                blockheader = OLDBLOCK.unpack(data)
+            else:
+                blockheader = OLDBLOCK.unpack_from(data, offset)
+            code = DNA_IO.read_data0(blockheader[0])
+        return code, 0, 0, 0, 0, 0
 
     @property
     def dna_type(self):
@@ -369,7 +1024,6 @@ class BlendFileBlock:
         if base_index != 0:
             assert(base_index < self.count)
             ofs += (self.size // self.count) * base_index
-        self.file.handle.seek(ofs, os.SEEK_SET)
 
         if sdna_index_refine is None:
             sdna_index_refine = self.sdna_index
@@ -377,10 +1031,13 @@ class BlendFileBlock:
             self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
 
         dna_struct = self.file.structs[sdna_index_refine]
-        field = dna_struct.field_from_path(
-                self.file.header, self.file.handle, path)
+        accessor = dna_struct.field_accessor(self.file.header, path)
+        field = accessor.field
+        ofs += accessor.offset
 
-        return (self.file.handle.tell(), field.dna_name.array_size)
+        if self.file.data is None:
+            self.file.handle.seek(ofs, os.SEEK_SET)
+        return (ofs, field.dna_name.array_size)
 
     def get(self, path,
             default=...,
@@ -393,7 +1050,6 @@ class BlendFileBlock:
         if base_index != 0:
             assert(base_index < self.count)
             ofs += (self.size // self.count) * base_index
-        self.file.handle.seek(ofs, os.SEEK_SET)
 
         if sdna_index_refine is None:
             sdna_index_refine = self.sdna_index
@@ -401,12 +1057,94 @@ class BlendFileBlock:
             self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
 
         dna_struct = self.file.structs[sdna_index_refine]
+        if self.file.data is not None:
+            return dna_struct.field_get_from_buffer(
+                    self.file.header, self.file.data, ofs, path,
+                    default=default,
+                    use_nil=use_nil, use_str=use_str,
+                    )
+
+        self.file.handle.seek(ofs, os.SEEK_SET)
         return dna_struct.field_get(
                 self.file.header, self.file.handle, path,
                 default=default,
                 use_nil=use_nil, use_str=use_str,
                 )
 
+    def as_structured_array(self, sdna_index_refine=None):
+        """Returns the block data as NumPy structured array of 'count' structs.
+
+        When the file is memory-mapped (or decompressed into memory) the array
+        is a view of the file buffer, without copying; it must be deleted
+        before the file is closed, and on files opened for writing changes to
+        it end up in the file. Otherwise the block data is read into memory.
+
+        Requires NumPy.
+        """
+        numpy = _import_numpy()
+
+        if sdna_index_refine is None:
+            sdna_index_refine = self.sdna_index
+        else:
+            self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
+
+        dtype = self.file.structs[sdna_index_refine].numpy_dtype(self.file.header)
+        if dtype.itemsize * self.count > self.size:
+            raise ValueError("block %r of %d bytes is too small for %d x %r" %
+                             (self.code, self.size, self.count, dtype.itemsize))
+
+        if self.file.data is not None:
+            return numpy.frombuffer(self.file.data, dtype=dtype, count=self.count,
+                                    offset=self.file_offset)
+        return numpy.frombuffer(self.file._read_block_data(self), dtype=dtype, count=self.count)
+
+    def get_array(self, path, sdna_index_refine=None):
+        """Returns one field of all structs in the block as NumPy array.
+
+        Supports the same paths as get(), e.g. (b'id', b'name') or (b'lay', 2),
+        but returns the values of all 'count' structs at once. The result is a
+        view of as_structured_array(), so the same caveats apply.
+        """
+        array = self.as_structured_array(sdna_index_refine)
+        if type(path) is not tuple:
+            path = (path, )
+        try:
+            for item in path:
+                if type(item) is bytes:
+                    array = array[item.decode('ascii')]
+                else:
+                    array = array[:, item]
+        except (KeyError, ValueError, IndexError):
+            raise KeyError("%r not found in %r (%r)" %
+                           (path, array.dtype.names, self.code)) from None
+        return array
+
+    def iter_pointer_values(self):
+        """Yields the non-zero pointers in the block, of all 'count' structs.
+
+        Raw data blocks (see RAW_DATA_SDNA_INDEX) have no known type, so no
+        pointers are yielded for them, even when they hold an array of pointers.
+        """
+        if self.sdna_index == RAW_DATA_SDNA_INDEX:
+            return
+
+        bfile = self.file
+        dna_struct = self.dna_type
+        pointer_struct = dna_struct.get_pointer_struct(bfile.header)
+        if pointer_struct is None:
+            return
+
+        if bfile.data is not None:
+            data, offset = bfile.data, self.file_offset
+        else:
+            data, offset = bfile._read_block_data(self), 0
+
+        item_size = dna_struct.size
+        for index in range(min(self.count, self.size // item_size)):
+            for pointer in pointer_struct.unpack_from(data, offset + index * item_size):
+                if pointer:
+                    yield pointer
+
     def get_recursive_iter(self, path, path_root=b"",
                            default=...,
                            sdna_index_refine=None,
@@ -437,17 +1175,27 @@ class BlendFileBlock:
         for k in self.keys():
             yield from self.get_recursive_iter(k, use_str=False)
 
-    def get_data_hash(self):
+    def get_data_hash(self, algorithm=None):
         """
         Generates a 'hash' that can be used instead of addr_old as block id, and that should be 'stable' across .blend
         file load & save (i.e. it does not changes due to pointer addresses variations).
+
+        :param algorithm: None to hash the string representation of each non-pointer value, or one of
+            'adler32', 'crc32' or 'blake2b' to hash the raw block data in one go, with all pointer fields
+            zeroed out. The raw hashes are much faster, but also hash struct padding and bytes after the
+            terminating NUL of strings. Raw DATA blocks (see RAW_DATA_SDNA_INDEX) are hashed unmasked,
+            so arrays of pointers written as raw data still change with pointer addresses.
+        :returns: the hash as int.
         """
+        if algorithm is not None:
+            return self._get_raw_data_hash(algorithm)
+
         # TODO This implementation is most likely far from optimal... and CRC32 is not renown as the best hashing
         #      algo either. But for now does the job!
         import zlib
         def _is_pointer(self, k):
-            return self.file.structs[self.sdna_index].field_from_path(
-                    self.file.header, self.file.handle, k).dna_name.is_pointer
+            return self.file.structs[self.sdna_index].field_accessor(
+                    self.file.header, k).field.dna_name.is_pointer
 
         hsh = 1
         for k, v in self.items_recursive_iter():
@@ -455,6 +1203,32 @@ class BlendFileBlock:
                 hsh = zlib.adler32(str(v).encode(), hsh)
         return hsh
 
+    def _get_raw_data_hash(self, algorithm):
+        import hashlib
+        import zlib
+
+        data = self.file._read_block_data(self)
+
+        dna_struct = self.dna_type
+        mask = dna_struct.get_pointer_mask(self.file.header)
+        if mask is None or self.sdna_index == RAW_DATA_SDNA_INDEX:
+            # Nothing known to be a pointer; raw data is hashed as-is.
+            pass
+        # Only mask when the block actually is an array of this struct.
+        elif self.count and self.size == dna_struct.size * self.count:
+            # Big int arithmetic is done in C, which is a lot faster than masking per byte in Python.
+            masked = (int.from_bytes(data, 'little') &
+                      int.from_bytes(mask * self.count, 'little'))
+            data = masked.to_bytes(self.size, 'little')
+
+        if algorithm == 'adler32':
+            return zlib.adler32(data)
+        if algorithm == 'crc32':
+            return zlib.crc32(data)
+        if algorithm == 'blake2b':
+            return int.from_bytes(hashlib.blake2b(data, digest_size=16).digest(), 'big')
+        raise ValueError('Unknown hash algorithm %r' % algorithm)
+
     def set(self, path, value,
             sdna_index_refine=None,
             ):
@@ -465,8 +1239,12 @@ class BlendFileBlock:
             self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
 
         dna_struct = self.file.structs[sdna_index_refine]
-        self.file.handle.seek(self.file_offset, os.SEEK_SET)
         self.file.is_modified = True
+        if self.file.data is not None:
+            return dna_struct.field_set_into_buffer(
+                    self.file.header, self.file.data, self.file_offset, path, value)
+
+        self.file.handle.seek(self.file_offset, os.SEEK_SET)
         return dna_struct.field_set(
                 self.file.header, self.file.handle, path, value)
 
@@ -488,8 +1266,8 @@ class BlendFileBlock:
         if type(result) is not int:
             return result
 
-        assert(self.file.structs[sdna_index_refine].field_from_path(
-                self.file.header, self.file.handle, path).dna_name.is_pointer)
+        assert(self.file.structs[sdna_index_refine].field_accessor(
+                self.file.header, path).field.dna_name.is_pointer)
         if result != 0:
             # possible (but unlikely)
             # that this fails and returns None
@@ -651,6 +1429,18 @@ class DNAName:
 
         return result
 
+    def calc_array_shape(self):
+        """Returns the array dimensions, e.g. (4, 4) for 'mat[4][4]', or () for non-arrays."""
+        temp = self.name_full
+        result = []
+        index = temp.find(b'[')
+        while index != -1:
+            index_2 = temp.find(b']')
+            result.append(int(temp[index + 1:index_2]))
+            temp = temp[index_2 + 1:]
+            index = temp.find(b'[')
+        return tuple(result)
+
 
 class DNAField:
     """
@@ -676,6 +1466,98 @@ class DNAField:
         self.dna_offset = dna_offset
 
 
+class DNAFieldAccessor:
+    """
+    DNAFieldAccessor is a compiled lookup of a field path in a DNAStruct:
+    the field, its offset relative to the struct, and a single struct.Struct
+    that reads the entire value (including arrays) in one go.
+    """
+    __slots__ = (
+        # the path this accessor was compiled for, for error reporting
+        "path",
+        # DNAField
+        "field",
+        # offset relative to the start of the struct
+        "offset",
+        # number of bytes to read
+        "size",
+        # struct.Struct, or None for char arrays and unsupported types
+        "value_struct",
+        # bool (return a list instead of a single value)
+        "is_array",
+        # bool (char array, read as bytes/str)
+        "is_char",
+        )
+
+    def __init__(self, header, path, field, offset):
+        self.path = path
+        self.field = field
+        self.offset = offset
+        self.value_struct = None
+        self.is_array = False
+        self.is_char = False
+
+        dna_type = field.dna_type
+        dna_name = field.dna_name
+        if dna_name.is_pointer:
+            self.value_struct = struct.Struct(
+                    header.endian_str + (b'I' if header.pointer_size == 4 else b'Q'))
+        elif dna_type.dna_type_id == b'char':
+            self.is_char = True
+            self.size = dna_name.array_size
+            return
+        else:
+            format_char = DNA_IO.FORMAT_FROM_TYPE_ID.get(dna_type.dna_type_id)
+            if format_char is not None:
+                self.is_array = dna_name.array_size > 1
+                self.value_struct = struct.Struct(
+                        b'%s%d%s' % (header.endian_str, dna_name.array_size, format_char))
+
+        self.size = self.value_struct.size if self.value_struct is not None else 0
+
+    def _not_implemented(self):
+        dna_name = self.field.dna_name
+        dna_type = self.field.dna_type
+        return NotImplementedError("%r exists but isn't pointer, can't resolve field %r" %
+                (self.path, dna_name.name_only), dna_name, dna_type)
+
+    def _convert_chars(self, raw, use_nil, use_str):
+        if use_nil:
+            raw = DNA_IO.read_data0(bytes(raw))
+        if use_str:
+            return bytes(raw).decode('utf-8')
+        return raw
+
+    def read_from_handle(self, handle, use_nil=True, use_str=True):
+        """Reads the value from the handle, which must be positioned at the field."""
+        if self.is_char:
+            return self._convert_chars(handle.read(self.size), use_nil, use_str)
+
+        if self.value_struct is None:
+            raise self._not_implemented()
+        values = self.value_struct.unpack(handle.read(self.size))
+        if self.is_array:
+            return list(values)
+        return values[0]
+
+    def read_from_buffer(self, data, struct_offset, use_nil=True, use_str=True):
+        """Reads the value from the buffer, for the struct at the given offset.
+
+        Char arrays are returned as memoryview when use_nil and use_str are False.
+        """
+        offset = struct_offset + self.offset
+        if self.is_char:
+            return self._convert_chars(memoryview(data)[offset:offset + self.size],
+                                       use_nil, use_str)
+
+        if self.value_struct is None:
+            raise self._not_implemented()
+        values = self.value_struct.unpack_from(data, offset)
+        if self.is_array:
+            return list(values)
+        return values[0]
+
+
 class DNAStruct:
     """
     DNAStruct is a C-type structure stored in the DNA
@@ -685,6 +1567,18 @@ class DNAStruct:
         "size",
         "fields",
         "field_from_name",
+        # dict {path: DNAFieldAccessor}, filled on demand by field_accessor()
+        "accessor_from_path",
+        # bytes, False when the struct has no pointers, or None when not yet computed
+        "pointer_mask",
+        # dict {(endian_index, pointer_size): numpy.dtype}, filled on demand by numpy_dtype()
+        "numpy_dtypes",
+        # (offset, ...) of every data pointer, or None when not yet computed
+        # (see get_pointer_struct)
+        "pointer_offsets",
+        # struct.Struct reading all data pointers at once, False when the struct has
+        # no pointers, or None when not yet computed
+        "pointer_struct",
         "user_data",
         )
 
@@ -692,116 +1586,273 @@ class DNAStruct:
         self.dna_type_id = dna_type_id
         self.fields = []
         self.field_from_name = {}
+        self.accessor_from_path = {}
+        self.pointer_mask = None
+        self.numpy_dtypes = {}
+        self.pointer_offsets = None
+        self.pointer_struct = None
         self.user_data = None
 
     def __repr__(self):
         return '%s(%r)' % (type(self).__qualname__, self.dna_type_id)
 
-    def field_from_path(self, header, handle, path):
+    def field_offset_from_path(self, header, path):
         """
         Support lookups as bytes or a tuple of bytes and optional index.
 
         C style 'id.name'   -->  (b'id', b'name')
         C style 'array[4]'  -->  ('array', 4)
+
+        Returns (field, offset), where the offset is relative to the start of
+        this struct, or (None, None) when the path cannot be found.
         """
-        if type(path) is tuple:
-            name = path[0]
-            if len(path) >= 2 and type(path[1]) is not bytes:
-                name_tail = path[2:]
-                index = path[1]
-                assert(type(index) is int)
+        offset = 0
+        dna_struct = self
+        while True:
+            if type(path) is tuple:
+                name = path[0]
+                if len(path) >= 2 and type(path[1]) is not bytes:
+                    name_tail = path[2:]
+                    index = path[1]
+                    assert(type(index) is int)
+                else:
+                    name_tail = path[1:]
+                    index = 0
             else:
-                name_tail = path[1:]
+                name = path
+                name_tail = None
                 index = 0
-        else:
-            name = path
-            name_tail = None
-            index = 0
 
-        assert(type(name) is bytes)
+            assert(type(name) is bytes)
 
-        field = self.field_from_name.get(name)
+            field = dna_struct.field_from_name.get(name)
+            if field is None:
+                return None, None
 
-        if field is not None:
-            handle.seek(field.dna_offset, os.SEEK_CUR)
+            offset += field.dna_offset
             if index != 0:
                 if field.dna_name.is_pointer:
                     index_offset = header.pointer_size * index
                 else:
                     index_offset = field.dna_type.size * index
                 assert(index_offset < field.dna_size)
-                handle.seek(index_offset, os.SEEK_CUR)
+                offset += index_offset
             if not name_tail:  # None or ()
-                return field
+                return field, offset
+
+            dna_struct = field.dna_type
+            path = name_tail
+
+    def field_accessor(self, header, path):
+        """Returns the (cached) DNAFieldAccessor for the path, or None if not found."""
+        try:
+            return self.accessor_from_path[path]
+        except KeyError:
+            pass
+
+        field, offset = self.field_offset_from_path(header, path)
+        if field is None:
+            return None
+        accessor = self.accessor_from_path[path] = DNAFieldAccessor(header, path, field, offset)
+        return accessor
+
+    def pointer_ranges(self, header, data_only=False):
+        """Yields (offset, size) of every pointer in this struct, including nested structs.
+
+        :param data_only: skip function pointers.
+        """
+        for field in self.fields:
+            dna_name = field.dna_name
+            if dna_name.is_method_pointer:
+                if not data_only:
+                    yield field.dna_offset, field.dna_size
+            elif dna_name.is_pointer:
+                yield field.dna_offset, field.dna_size
+            elif field.dna_type.fields:
+                item_size = field.dna_type.size
+                for index in range(dna_name.array_size):
+                    item_offset = field.dna_offset + index * item_size
+                    for offset, size in field.dna_type.pointer_ranges(header, data_only):
+                        yield item_offset + offset, size
+
+    def get_pointer_mask(self, header):
+        """Returns a mask with zero bytes where pointers are, and 0xFF elsewhere.
+
+        :returns: the mask as bytes of the struct size, or None if the struct has no pointers.
+        """
+        if self.pointer_mask is None:
+            mask = bytearray(b'\xff' * self.size)
+            for offset, size in self.pointer_ranges(header):
+                mask[offset:offset + size] = bytes(size)
+            if len(mask) != self.size:
+                # Pointers outside the struct size would have grown the mask; don't trust it.
+                raise RuntimeError("DNA struct %r has fields beyond its size" % self.dna_type_id)
+            self.pointer_mask = bytes(mask) if 0 in mask else False
+        return self.pointer_mask or None
+
+    def get_pointer_struct(self, header):
+        """Returns a struct.Struct that unpacks all data pointers of this struct.
+
+        Data pointers are all pointers except function pointers, including
+        pointers in nested structs and every item of pointer arrays. Their
+        offsets are stored in 'pointer_offsets', in the order of the values.
+
+        :returns: the struct.Struct, or None if the struct has no data pointers.
+        """
+        if self.pointer_struct is None:
+            offsets = []
+            for offset, size in self.pointer_ranges(header, data_only=True):
+                offsets.extend(range(offset, offset + size, header.pointer_size))
+            offsets.sort()
+            self.pointer_offsets = tuple(offsets)
+
+            pointer_char = b'I' if header.pointer_size == 4 else b'Q'
+            fmt = [header.endian_str]
+            end = 0
+            for offset in offsets:
+                if offset > end:
+                    fmt.append(b'%dx' % (offset - end))
+                fmt.append(pointer_char)
+                end = offset + header.pointer_size
+            self.pointer_struct = struct.Struct(b''.join(fmt)) if offsets else False
+        return self.pointer_struct or None
+
+    def numpy_dtype(self, header):
+        """Returns a NumPy structured dtype with the memory layout of this struct.
+
+        Pointers become unsigned integers of the file's pointer size, char arrays
+        become bytes, and fields of unknown types are left out (but still take
+        up their space). Requires NumPy.
+        """
+        key = (header.endian_index, header.pointer_size)
+        try:
+            return self.numpy_dtypes[key]
+        except KeyError:
+            pass
+
+        numpy = _import_numpy()
+        endian = header.endian_str.decode('ascii')
+        names = []
+        formats = []
+        offsets = []
+        for field in self.fields:
+            dna_name = field.dna_name
+            dna_type = field.dna_type
+            if dna_name.is_pointer:
+                dtype = '%su%d' % (endian, header.pointer_size)
+            elif dna_type.dna_type_id == b'char' and dna_name.array_size > 1:
+                # The whole char array as one value, like get() returns it.
+                names.append(dna_name.name_only.decode('ascii'))
+                formats.append('S%d' % dna_name.array_size)
+                offsets.append(field.dna_offset)
+                continue
+            elif dna_type.fields:
+                dtype = dna_type.numpy_dtype(header)
             else:
-                return field.dna_type.field_from_path(header, handle, name_tail)
+                dtype = DNA_IO.NUMPY_FORMAT_FROM_TYPE_ID.get(dna_type.dna_type_id)
+                if dtype is None:
+                    continue
+                dtype = endian + dtype
+
+            shape = dna_name.calc_array_shape()
+            names.append(dna_name.name_only.decode('ascii'))
+            formats.append((dtype, shape) if shape else dtype)
+            offsets.append(field.dna_offset)
+
+        dtype = numpy.dtype({
+            'names': names,
+            'formats': formats,
+            'offsets': offsets,
+            'itemsize': self.size,
+        })
+        self.numpy_dtypes[key] = dtype
+        return dtype
+
+    def field_from_path(self, header, handle, path):
+        """
+        Support lookups as bytes or a tuple of bytes and optional index.
+
+        C style 'id.name'   -->  (b'id', b'name')
+        C style 'array[4]'  -->  ('array', 4)
+
+        Seeks the handle (relative to its current position) to the field.
+        """
+        accessor = self.field_accessor(header, path)
+        if accessor is None:
+            return None
+        handle.seek(accessor.offset, os.SEEK_CUR)
+        return accessor.field
+
+    def _field_not_found(self, path, default):
+        if default is not ...:
+            return default
+        raise KeyError("%r not found in %r (%r)" %
+                (path, [f.dna_name.name_only for f in self.fields], self.dna_type_id))
 
     def field_get(self, header, handle, path,
                   default=...,
                   use_nil=True, use_str=True,
                   ):
+        accessor = self.field_accessor(header, path)
+        if accessor is None:
+            return self._field_not_found(path, default)
+
+        handle.seek(accessor.offset, os.SEEK_CUR)
+        return accessor.read_from_handle(handle, use_nil, use_str)
+
+    def field_set(self, header, handle, path, value):
+        assert(type(path) == bytes)
+
         field = self.field_from_path(header, handle, path)
         if field is None:
-            if default is not ...:
-                return default
-            else:
-                raise KeyError("%r not found in %r (%r)" %
-                        (path, [f.dna_name.name_only for f in self.fields], self.dna_type_id))
+            raise KeyError("%r not found in %r" %
+                    (path, [f.dna_name.name_only for f in self.fields]))
 
         dna_type = field.dna_type
         dna_name = field.dna_name
 
-        if dna_name.is_pointer:
-            return DNA_IO.read_pointer(handle, header)
-        elif dna_type.dna_type_id == b'int':
-            if dna_name.array_size > 1:
-                return [DNA_IO.read_int(handle, header) for i in range(dna_name.array_size)]
-            return DNA_IO.read_int(handle, header)
-        elif dna_type.dna_type_id == b'short':
-            if dna_name.array_size > 1:
-                return [DNA_IO.read_short(handle, header) for i in range(dna_name.array_size)]
-            return DNA_IO.read_short(handle, header)
-        elif dna_type.dna_type_id == b'uint64_t':
-            if dna_name.array_size > 1:
-                return [DNA_IO.read_ulong(handle, header) for i in range(dna_name.array_size)]
-            return DNA_IO.read_ulong(handle, header)
-        elif dna_type.dna_type_id == b'float':
-            if dna_name.array_size > 1:
-                return [DNA_IO.read_float(handle, header) for i in range(dna_name.array_size)]
-            return DNA_IO.read_float(handle, header)
-        elif dna_type.dna_type_id == b'char':
-            if use_str:
-                if use_nil:
-                    return DNA_IO.read_string0(handle, dna_name.array_size)
-                else:
-                    return DNA_IO.read_string(handle, dna_name.array_size)
+        if dna_type.dna_type_id == b'char':
+            if type(value) is str:
+                return DNA_IO.write_string(handle, value, dna_name.array_size)
             else:
-                if use_nil:
-                    return DNA_IO.read_bytes0(handle, dna_name.array_size)
-                else:
-                    return DNA_IO.read_bytes(handle, dna_name.array_size)
+                return DNA_IO.write_bytes(handle, value, dna_name.array_size)
+        elif dna_type.dna_type_id == b'int':
+            DNA_IO.write_int(handle, header, value)
         else:
-            raise NotImplementedError("%r exists but isn't pointer, can't resolve field %r" %
-                    (path, dna_name.name_only), dna_name, dna_type)
+            raise NotImplementedError("Setting %r is not yet supported for %r" %
+                                      (dna_type, dna_name), dna_name, dna_type)
 
-    def field_set(self, header, handle, path, value):
+    def field_get_from_buffer(self, header, data, offset, path,
+                              default=...,
+                              use_nil=True, use_str=True,
+                              ):
+        """Same as field_get(), but reads from a buffer at the given struct offset."""
+        accessor = self.field_accessor(header, path)
+        if accessor is None:
+            return self._field_not_found(path, default)
+
+        return accessor.read_from_buffer(data, offset, use_nil, use_str)
+
+    def field_set_into_buffer(self, header, data, offset, path, value):
+        """Same as field_set(), but writes into a buffer at the given struct offset."""
         assert(type(path) == bytes)
 
-        field = self.field_from_path(header, handle, path)
+        field, field_offset = self.field_offset_from_path(header, path)
         if field is None:
             raise KeyError("%r not found in %r" %
                     (path, [f.dna_name.name_only for f in self.fields]))
 
         dna_type = field.dna_type
         dna_name = field.dna_name
+        offset += field_offset
 
         if dna_type.dna_type_id == b'char':
             if type(value) is str:
-                return DNA_IO.write_string(handle, value, dna_name.array_size)
+                return DNA_IO.write_string_into(data, offset, value, dna_name.array_size)
             else:
-                return DNA_IO.write_bytes(handle, value, dna_name.array_size)
+                return DNA_IO.write_bytes_into(data, offset, value, dna_name.array_size)
         elif dna_type.dna_type_id == b'int':
-            DNA_IO.write_int(handle, header, value)
+            DNA_IO.write_int_into(data, offset, header, value)
         else:
             raise NotImplementedError("Setting %r is not yet supported for %r" %
                                       (dna_type, dna_name), dna_name, dna_type)
@@ -838,6 +1889,25 @@ class DNA_IO:
 
         handle.write(stringw)
 
+    @staticmethod
+    def write_string_into(data, offset, astring, fieldlen):
+        assert(isinstance(astring, str))
+        if len(astring) >= fieldlen:
+            stringw = astring[0:fieldlen]
+        else:
+            stringw = astring + '\0'
+        stringw = stringw.encode('utf-8')
+        data[offset:offset + len(stringw)] = stringw
+
+    @staticmethod
+    def write_bytes_into(data, offset, astring, fieldlen):
+        assert(isinstance(astring, (bytes, bytearray)))
+        if len(astring) >= fieldlen:
+            stringw = astring[0:fieldlen]
+        else:
+            stringw = astring + b'\0'
+        data[offset:offset + len(stringw)] = stringw
+
     @staticmethod
     def read_bytes(handle, length):
         data = handle.read(length)
@@ -901,6 +1971,12 @@ class DNA_IO:
         to_write = st.pack(value)
         handle.write(to_write)
 
+    @staticmethod
+    def write_int_into(data, offset, fileheader, value):
+        assert isinstance(value, int), 'value must be int, but is %r: %r' % (type(value), value)
+        st = DNA_IO.SINT[fileheader.endian_index]
+        st.pack_into(data, offset, value)
+
     FLOAT = struct.Struct(b'<f'), struct.Struct(b'>f')
 
     @staticmethod
@@ -927,3 +2003,27 @@ class DNA_IO:
         if header.pointer_size == 8:
             st = DNA_IO.ULONG[header.endian_index]
             return st.unpack(handle.read(st.size))[0]
+
+    # Struct format characters of the numeric DNA types that can be read.
+    FORMAT_FROM_TYPE_ID = {
+        b'int': b'i',
+        b'short': b'h',
+        b'uint64_t': b'Q',
+        b'float': b'f',
+    }
+
+    # NumPy format strings (without byte order) of the numeric DNA types.
+    NUMPY_FORMAT_FROM_TYPE_ID = {
+        b'char': 'i1',
+        b'uchar': 'u1',
+        b'short': 'i2',
+        b'ushort': 'u2',
+        b'int': 'i4',
+        b'long': 'i4',
+        b'ulong': 'u4',
+        b'float': 'f4',
+        b'double': 'f8',
+        b'int8_t': 'i1',
+        b'int64_t': 'i8',
+        b'uint64_t': 'u8',
+    }
@@ -0,0 +1,192 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Scans directory trees of blend files, fanning out over multiple processes.
+
+Can be used as library, see scan_tree(), or from the commandline:
+
+    python3 -m blender_cloud.blendfile_scan /path/to/project > scan.jsonl
+
+which writes one JSON document per blend file, as soon as it has been scanned.
+"""
+
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import pathlib
+import sys
+import typing
+
+from . import blendfile
+
+log = logging.getLogger(__name__)
+
+# Maximum number of files submitted to the process pool per worker process.
+# Limits memory use when scanning huge trees, while keeping all workers busy.
+PENDING_PER_WORKER = 4
+
+LIBRARY_PATH_FIELDS = (b'filepath', b'name')
+IMAGE_PATH_FIELDS = (b'filepath', b'name')
+
+
+def find_blend_files(root: pathlib.Path, suffix='.blend') -> typing.Iterator[pathlib.Path]:
+    """Yields the paths of all blend files in the directory tree."""
+
+    for dirpath, dirnames, filenames in os.walk(str(root)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(suffix):
+                yield pathlib.Path(dirpath) / filename
+
+
+def _decode(value: bytes) -> str:
+    return value.decode('utf-8', 'replace')
+
+
+def _get_path(block: blendfile.BlendFileBlock, field_names) -> typing.Optional[str]:
+    for field_name in field_names:
+        value = block.get(field_name, default=None, use_str=False)
+        if value is not None:
+            return _decode(value)
+    return None
+
+
+def _is_id_block(block: blendfile.BlendFileBlock) -> bool:
+    fields = block.dna_type.fields
+    return bool(fields) and fields[0].dna_type.dna_type_id == b'ID'
+
+
+def scan_file(filepath: pathlib.Path, codes: typing.Optional[typing.Set[bytes]] = None) -> dict:
+    """Returns block codes, ID names and library/image paths of a blend file.
+
+    :param codes: block codes to report on; None reports on all ID blocks.
+    :returns: a JSON-compatible dict. Errors are reported in the 'error' key
+        instead of raised, so that one broken file doesn't stop a scan.
+    """
+
+    result = {'path': str(filepath)}
+    try:
+        with blendfile.open_blend(str(filepath), use_mmap=True) as bfile:
+            block_counts = {}
+            ids = {}
+            for block in bfile.blocks:
+                if codes is not None and block.code not in codes:
+                    continue
+                if codes is None and (block.code == b'ENDB' or not _is_id_block(block)):
+                    continue
+
+                code = _decode(block.code)
+                block_counts[code] = block_counts.get(code, 0) + 1
+                if _is_id_block(block):
+                    ids.setdefault(code, []).append(
+                        _decode(block.get((b'id', b'name'), use_str=False)))
+
+            result['blocks'] = block_counts
+            result['ids'] = ids
+            result['libraries'] = [_get_path(block, LIBRARY_PATH_FIELDS)
+                                   for block in bfile.find_blocks_from_code(b'LI')]
+            result['images'] = [_get_path(block, IMAGE_PATH_FIELDS)
+                                for block in bfile.find_blocks_from_code(b'IM')]
+            result['is_compressed'] = bfile.is_compressed
+    except Exception as ex:
+        log.debug('Error scanning %s', filepath, exc_info=True)
+        result['error'] = '%s: %s' % (type(ex).__name__, ex)
+
+    return result
+
+
+def _init_worker(dna_cache_directory: typing.Optional[str]):
+    blendfile.DNA_CACHE_DIRECTORY = dna_cache_directory
+
+
+def scan_tree(root: pathlib.Path, *,
+              codes: typing.Optional[typing.Iterable[bytes]] = None,
+              max_workers: int = None,
+              suffix='.blend',
+              dna_cache_directory: str = None) -> typing.Iterator[dict]:
+    """Scans all blend files in the tree, yielding results as they come in.
+
+    Files are scanned in a process pool, so results are yielded in
+    completion order, not in file order. See scan_file() for the results.
+
+    :param dna_cache_directory: directory in which the worker processes share
+        decoded DNA catalogs, see blendfile.DNA_CACHE_DIRECTORY.
+    """
+
+    if codes is not None:
+        codes = set(codes)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    scan = functools.partial(scan_file, codes=codes)
+    paths = find_blend_files(root, suffix)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                initializer=_init_worker,
+                                                initargs=(dna_cache_directory,)) as executor:
+        pending = set()
+        for path in paths:
+            pending.add(executor.submit(scan, path))
+            if len(pending) < max_workers * PENDING_PER_WORKER:
+                continue
+
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def main(argv=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python3 -m blender_cloud.blendfile_scan',
+        description='Scans blend files and writes one JSON document per file to stdout.')
+    parser.add_argument('root', type=pathlib.Path, help='directory to scan recursively')
+    parser.add_argument('-c', '--code', action='append', dest='codes',
+                        help='block code to report on, like OB or IM; can be given multiple '
+                             'times. Defaults to all ID blocks.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--suffix', default='.blend', help='file suffix to look for')
+    parser.add_argument('--dna-cache', default=None,
+                        help='directory to cache decoded DNA catalogs in, shared by the workers')
+    args = parser.parse_args(argv)
+
+    if not args.root.is_dir():
+        parser.error('%s is not a directory' % args.root)
+
+    codes = args.codes and [code.encode('ascii') for code in args.codes]
+    errors = 0
+    for result in scan_tree(args.root, codes=codes, max_workers=args.jobs, suffix=args.suffix,
+                            dna_cache_directory=args.dna_cache):
+        if 'error' in result:
+            errors += 1
+        sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
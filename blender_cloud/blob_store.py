@@ -0,0 +1,244 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Local store of downloaded Pillar files, shared by all projects.
+
+Files are downloaded once into the store, keyed by their file UUID and
+content hash, and then reflinked or copied into the directories where they
+are used. A file with new contents gets a new key, so it's never served from
+the old blob. The HTTP headers of each download are stored in the download
+index, so that a changed file (different ETag) is downloaded again even when
+the file document has no content hash.
+
+The store has a size budget; the least recently used files are removed
+when it is exceeded.
+"""
+
+import errno
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import typing
+
+from . import download_index, utils
+
+log = logging.getLogger(__name__)
+
+# Size budget of the default store, in bytes.
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+
+# Minimum number of seconds between two scans for files to evict.
+EVICTION_INTERVAL = 60
+
+# How files are placed in working directories, in order of preference.
+# Reflinks are copy-on-write clones, so they take no extra space until the
+# file is changed. Hardlinks aren't used: placed files are opened for writing
+# (e.g. by settings_sync), which would change the stored file as well.
+LINK_MODES = ('reflink', 'copy')
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+# Turns base64 content hashes into something that is safe in filenames.
+_SAFE_HASH_CHARS = str.maketrans('+/', '-_', '=')
+
+# Suffixes of the files in the store that aren't blobs themselves.
+_SIDECAR_SUFFIXES = ('.part', '.journal', '~')
+
+_default_store = None
+
+
+class BlobStore:
+    """Content store of downloaded files, keyed by blob_key()."""
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE,
+                 index: download_index.DownloadIndex = None):
+        """
+        :param index: the index of the downloads into this store, which also
+            tracks when each file was last used. Defaults to an index in the
+            store directory.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if index is None:
+            index = download_index.index_for_directory(directory)
+        self.index = index
+        self._last_eviction = 0.0
+        self._lock = threading.Lock()
+
+    def blob_path(self, key: str) -> str:
+        """Returns the path of the stored file for this key."""
+        return os.path.join(self.directory, key[-2:], key)
+
+    def touch(self, key: str):
+        """Marks the blob as used just now, for the LRU eviction."""
+        self.index.touch(self.blob_path(key))
+
+    def link_out(self, key: str, target_path: str) -> str:
+        """Places the stored file at target_path, replacing what is there.
+
+        :returns: the link mode used, see LINK_MODES, or '' when target_path
+            already was a copy of the stored file.
+        """
+
+        blob_path = self.blob_path(key)
+        self.touch(key)
+
+        try:
+            blob_stat = os.stat(blob_path)
+            target_stat = os.stat(target_path)
+        except FileNotFoundError:
+            pass
+        else:
+            # Placed files get the timestamp of the stored file, see below.
+            if (blob_stat.st_size == target_stat.st_size and
+                    blob_stat.st_mtime == target_stat.st_mtime):
+                return ''
+
+        directory = os.path.dirname(target_path)
+        os.makedirs(directory, exist_ok=True)
+
+        temp_path = '%s.%i.tmp' % (target_path, os.getpid())
+        for mode in LINK_MODES:
+            try:
+                _LINKERS[mode](blob_path, temp_path)
+            except OSError as ex:
+                log.debug('Unable to %s %s to %s: %s', mode, blob_path, target_path, ex)
+                utils.remove_file(temp_path)
+                continue
+            break
+        else:
+            raise OSError(errno.EIO, 'Unable to place stored file %s' % blob_path, target_path)
+
+        shutil.copystat(blob_path, temp_path)
+        os.replace(temp_path, target_path)
+        return mode
+
+    def blobs(self) -> typing.Iterator[typing.Tuple[str, int, float]]:
+        """Yields (key, size in bytes, last used timestamp) of all stored files."""
+
+        try:
+            subdirs = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        records = self.index.get_directory(self.directory)
+
+        for subdir in subdirs:
+            subdir_path = os.path.join(self.directory, subdir)
+            try:
+                names = os.listdir(subdir_path)
+            except NotADirectoryError:
+                continue
+
+            for name in names:
+                if name.endswith(_SIDECAR_SUFFIXES):
+                    continue
+                try:
+                    size = os.stat(os.path.join(subdir_path, name)).st_size
+                except FileNotFoundError:
+                    continue
+                record = records.get(self.blob_path(name))
+                yield name, size, record.last_used if record is not None else 0.0
+
+    def remove(self, key: str):
+        blob_path = self.blob_path(key)
+        utils.remove_file(blob_path)
+        self.index.delete(blob_path)
+
+    def evict(self) -> int:
+        """Removes the least recently used files until the store fits its size budget.
+
+        :returns: the number of bytes removed.
+        """
+
+        with self._lock:
+            self._last_eviction = time.monotonic()
+            blobs = sorted(self.blobs(), key=lambda blob: blob[2])
+            total_size = sum(size for _, size, _ in blobs)
+            removed = 0
+            for key, size, _ in blobs:
+                if total_size - removed <= self.max_size:
+                    break
+                log.debug('Evicting %s (%i bytes) from %s', key, size, self.directory)
+                self.remove(key)
+                removed += size
+
+        if removed:
+            log.info('Removed %i bytes from %s', removed, self.directory)
+        return removed
+
+    def maybe_evict(self) -> int:
+        """Calls evict(), unless it was called less than EVICTION_INTERVAL seconds ago."""
+
+        if self._last_eviction and time.monotonic() - self._last_eviction < EVICTION_INTERVAL:
+            return 0
+        return self.evict()
+
+
+def blob_key(file_uuid: str, content_hash: str = None) -> str:
+    """Returns the key of the stored file for this version of a Pillar file.
+
+    :param content_hash: the hash of the file contents from the file
+        document, hex or base64 encoded. Without one the key is just the
+        file UUID.
+    """
+    if not content_hash:
+        return file_uuid
+    safe_hash = content_hash.translate(_SAFE_HASH_CHARS)
+    if not re.fullmatch(r'[\w-]+', safe_hash, re.ASCII):
+        log.debug('Ignoring unexpected content hash %r of file %s', content_hash, file_uuid)
+        return file_uuid
+    return '%s-%s' % (file_uuid, safe_hash)
+
+
+def _reflink(source: str, target: str):
+    if sys.platform != 'linux':
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are only supported on Linux')
+
+    import fcntl
+
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+        fcntl.ioctl(outfile.fileno(), _FICLONE, infile.fileno())
+
+
+def _copy(source: str, target: str):
+    shutil.copyfile(source, target)
+
+
+_LINKERS = {
+    'reflink': _reflink,
+    'copy': _copy,
+}
+
+
+def default_store() -> BlobStore:
+    """Returns the store in the cache directory of the current user."""
+
+    global _default_store
+
+    from . import cache
+
+    # The cache directory depends on the logged-in user.
+    directory = cache.cache_directory('blobs')
+    if _default_store is None or _default_store.directory != directory:
+        _default_store = BlobStore(directory, index=download_index.default_index())
+    return _default_store
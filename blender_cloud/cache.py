@@ -19,21 +19,35 @@
 """HTTP Cache management.
 
 This module configures a cached session for the Requests package.
-It allows for filesystem-based caching of HTTP requests.
+It allows for filesystem-based caching of HTTP requests, in a cache with
+a size budget; see http_cache.BoundedFileCache.
 
-Requires the 3rd party packages CacheControl and lockfile.
+Requires the 3rd party package CacheControl.
 """
 
 import os
 import logging
+import shutil
+import threading
 import requests
 import cachecontrol
-from cachecontrol.caches import FileCache
 
-from . import appdirs
+from . import appdirs, http_cache, http_pools
 
 log = logging.getLogger(__name__)
 _session = None  # requests.Session object that's set up for caching by requests_session().
+_http_cache = None  # http_cache.BoundedFileCache used by _session.
+
+# Size budgets in bytes, and the eviction policy of the HTTP cache ('lru' or 'lfu').
+HTTP_CACHE_MAX_SIZE = 256 * 1024 ** 2
+HTTP_CACHE_POLICY = 'lru'
+THUMBNAILS_MAX_SIZE = 512 * 1024 ** 2
+
+# Suffixes of the files of downloads in progress, which thumbnail eviction skips.
+_PARTIAL_DOWNLOAD_SUFFIXES = ('.part', '.journal')
+
+# Directory of the unbounded CacheControl FileCache of older versions.
+_LEGACY_HTTP_CACHE = 'blender_cloud_http'
 
 
 def cache_directory(*subdirs) -> str:
@@ -71,15 +85,92 @@ def cache_directory(*subdirs) -> str:
 def requests_session() -> requests.Session:
     """Creates a Requests-Cache session object."""
 
-    global _session
+    global _session, _http_cache
 
     if _session is not None:
         return _session
 
-    cache_name = cache_directory('blender_cloud_http')
+    cache_name = cache_directory('http_cache')
     log.info('Storing cache in %s' % cache_name)
+    _http_cache = http_cache.BoundedFileCache(cache_name, max_size=HTTP_CACHE_MAX_SIZE,
+                                              policy=HTTP_CACHE_POLICY)
+    _remove_legacy_http_cache()
 
-    _session = cachecontrol.CacheControl(sess=requests.session(),
-                                         cache=FileCache(cache_name))
+    # Cached calls are Pillar API calls, so they share the configuration of that pool.
+    _session = requests.session()
+    http_pools.mount(_session, http_pools.API, cachecontrol.CacheControlAdapter,
+                     cache=_http_cache)
 
     return _session
+
+
+def http_cache_stats() -> dict:
+    """Returns the hit/miss/bytes statistics of the HTTP cache, see BoundedFileCache.stats()."""
+
+    if _http_cache is None:
+        return {}
+    return _http_cache.stats()
+
+
+def _remove_legacy_http_cache():
+    """Removes the unbounded cache of older versions in a background thread."""
+
+    legacy_dir = os.path.join(cache_directory(), _LEGACY_HTTP_CACHE)
+    if not os.path.isdir(legacy_dir):
+        return
+
+    def remove():
+        log.info('Removing old HTTP cache %s', legacy_dir)
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+
+    threading.Thread(target=remove, name='remove-legacy-http-cache', daemon=True).start()
+
+
+def evict_thumbnails(directory: str, max_size: int = None) -> int:
+    """Removes the least recently used thumbnails until the directory fits its budget.
+
+    When thumbnails were last used is taken from the download index; files
+    without a record go first. Thumbnails that are still being downloaded
+    are left alone.
+
+    :param max_size: size budget in bytes, defaults to THUMBNAILS_MAX_SIZE.
+    :returns: the number of bytes removed.
+    """
+
+    from . import download_index
+
+    if max_size is None:
+        max_size = THUMBNAILS_MAX_SIZE
+
+    index = download_index.default_index()
+    records = index.get_directory(directory)
+
+    thumbnails = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(_PARTIAL_DOWNLOAD_SUFFIXES):
+                continue
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+            record = records.get(path)
+            thumbnails.append((record.last_used if record is not None else 0.0, size, path))
+
+    thumbnails.sort()
+    total_size = sum(size for _, size, _ in thumbnails)
+    removed = 0
+    for _, size, path in thumbnails:
+        if total_size - removed <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        index.delete(path)
+        removed += size
+
+    if removed:
+        log.info('Removed %i bytes of thumbnails from %s', removed, directory)
+    return removed
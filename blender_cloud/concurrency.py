@@ -0,0 +1,272 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Concurrency control for calls to a server.
+
+AdaptiveLimiter limits the number of concurrent calls. The limit follows
+the AIMD scheme (additive increase, multiplicative decrease) known from
+TCP congestion control. While calls are limited by it and return quickly,
+the limit grows by one per `limit` successful calls. When the server
+signals that it is overloaded (HTTP 429/503, timeouts) or the latency of
+the calls grows well beyond the lowest latency seen, the limit is
+multiplied by a backoff factor.
+
+SingleFlight lets identical calls that are made at the same time share
+one call to the server.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+import typing
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter:
+    """Asyncio semaphore whose limit adapts to the latency and errors of the calls.
+
+    Usage:
+
+        token = await limiter.acquire(timeout=10)
+        try:
+            result = await do_the_call()
+        except SomeOverloadError:
+            limiter.release(token, overloaded=True)
+            raise
+        limiter.release(token)
+
+    Unlike asyncio.Semaphore it isn't bound to an event loop, so it can be
+    created at import time.
+    """
+
+    def __init__(self, initial_limit: int = 3, min_limit: int = 1, max_limit: int = 16, *,
+                 backoff: float = 0.7, latency_tolerance: float = 2.5):
+        """
+        :param backoff: factor the limit is multiplied by when backing off.
+        :param latency_tolerance: the limit is decreased when the average
+            latency exceeds this multiple of the baseline latency.
+        """
+        assert 1 <= min_limit <= initial_limit <= max_limit
+        assert 0 < backoff < 1
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiters = collections.deque()  # of asyncio.Future
+
+        # Calls started before the last decrease don't cause another one;
+        # they were made when the limit was still too high.
+        self._last_decrease = 0.0
+
+        # Exponentially weighted moving average of the latency, and a
+        # baseline that slowly creeps towards it, so that it can go up
+        # again when the network conditions change.
+        self._latency_avg = None  # type: typing.Optional[float]
+        self._latency_baseline = None  # type: typing.Optional[float]
+
+        self.calls = 0
+        self.overloads = 0
+
+    @property
+    def limit(self) -> int:
+        """The current maximum number of concurrent calls."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        """The number of calls currently holding a slot."""
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of calls waiting for a slot."""
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'in_flight': self._in_flight,
+            'queue_depth': self.queue_depth,
+            'calls': self.calls,
+            'overloads': self.overloads,
+            'latency_avg': self._latency_avg,
+            'latency_baseline': self._latency_baseline,
+        }
+
+    async def acquire(self, timeout: float = None) -> float:
+        """Waits for a slot to become available.
+
+        :returns: a token to pass to release().
+        :raises asyncio.TimeoutError: when no slot became available within the timeout.
+        """
+
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return time.monotonic()
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just before we gave up on it.
+                self._in_flight -= 1
+                self._wake_waiters()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        return time.monotonic()
+
+    def release(self, token: float, *, overloaded=False, measure=True):
+        """Releases the slot and adjusts the limit to the outcome of the call.
+
+        :param token: the value returned by acquire().
+        :param overloaded: whether the call failed because the server was overloaded.
+        :param measure: whether the call completed; False for cancelled calls
+            and calls that failed for reasons unrelated to the load.
+        """
+
+        self._in_flight -= 1
+        if overloaded:
+            self.overloads += 1
+            self._decrease(token, 'server overloaded')
+        elif measure:
+            self._record_latency(token, time.monotonic() - token)
+        self._wake_waiters()
+
+    def _record_latency(self, token: float, latency: float):
+        # Whether this call was limited by the limit; there is no evidence
+        # that a higher limit would work when it isn't reached anyway.
+        saturated = self._in_flight + 1 >= self.limit
+        self.calls += 1
+
+        if self._latency_avg is None:
+            self._latency_avg = self._latency_baseline = latency
+        else:
+            self._latency_avg += 0.2 * (latency - self._latency_avg)
+            self._latency_baseline = min(
+                latency,
+                self._latency_baseline + 0.01 * (self._latency_avg - self._latency_baseline))
+
+        if self._latency_avg > self.latency_tolerance * self._latency_baseline:
+            self._decrease(token, 'latency %.3f s > %.1f * %.3f s' % (
+                self._latency_avg, self.latency_tolerance, self._latency_baseline))
+        elif saturated and self._limit < self.max_limit:
+            old_limit = self.limit
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if self.limit != old_limit:
+                log.debug('Increased concurrency limit to %i', self.limit)
+
+    def _decrease(self, token: float, reason: str):
+        if token <= self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+
+        self._limit = max(self.min_limit, self._limit * self.backoff)
+        # Give the lower limit a fresh start, rather than letting calls
+        # from before the decrease push it down again.
+        self._latency_avg = self._latency_baseline
+        log.info('Decreased concurrency limit to %i: %s', self.limit, reason)
+
+    def _wake_waiters(self):
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self._in_flight += 1
+            waiter.set_result(None)
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.loop = asyncio.get_event_loop()
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Lets concurrent calls with the same key await one shared call.
+
+    The first caller starts the call as a task; callers with the same key
+    that arrive while it is running await that task instead of starting
+    their own. They all get the same result or exception. The call is only
+    cancelled when every caller waiting for it is cancelled.
+
+    Like AdaptiveLimiter it isn't bound to an event loop.
+    """
+
+    def __init__(self):
+        self._flights = {}  # {key: _Flight}
+        self.calls = 0  # calls that were actually performed
+        self.hits = 0  # calls that were answered by another call in flight
+        self.hits_per_label = collections.Counter()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'hits': self.hits,
+            'in_flight': self.in_flight,
+            'hits_per_label': dict(self.hits_per_label),
+        }
+
+    async def call(self, key: typing.Hashable,
+                   coro_func: typing.Callable[[], typing.Awaitable],
+                   label: str = None):
+        """Returns the result of coro_func(), or of the call in flight with the same key.
+
+        :param label: name to count hits under in the stats, like the function name.
+        """
+
+        loop = asyncio.get_event_loop()
+        flight = self._flights.get(key)
+        if flight is not None and flight.loop is loop and not flight.task.done():
+            self.hits += 1
+            self.hits_per_label[label] += 1
+        else:
+            self.calls += 1
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(coro_func()))
+
+            def done(task: asyncio.Future, flight=flight):
+                self._forget(key, flight)
+
+            flight.task.add_done_callback(done)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Every caller gave up on the call.
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key: typing.Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
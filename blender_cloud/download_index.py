@@ -0,0 +1,282 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Index of downloaded files, used to revalidate them with the server.
+
+For every downloaded file the index holds the URL, the ETag and
+Last-Modified headers of the response, and the length and modification
+time of the file as it was written. This replaces the '{filename}.headers'
+JSON files that used to be stored next to each download; those are
+migrated into the index when they are found.
+
+The index is an SQLite database in WAL mode, so that multiple Blender
+instances can use it at the same time.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'downloads.sqlite'
+SCHEMA_VERSION = 1
+_SCHEMA = (
+    '''CREATE TABLE downloads (
+        filename TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        etag TEXT NOT NULL,
+        last_modified TEXT,
+        length INTEGER,
+        mtime REAL,
+        last_used REAL NOT NULL
+    ) WITHOUT ROWID''',
+    'CREATE INDEX downloads_url ON downloads (url)',
+)
+
+# Maximum number of filenames per query, to stay below SQLite's limit on
+# the number of query parameters.
+_QUERY_BATCH_SIZE = 500
+
+_indices = {}  # mapping from database path to DownloadIndex
+_indices_lock = threading.Lock()
+
+
+class DownloadRecord(typing.NamedTuple):
+    filename: str
+    url: str
+    etag: str
+    last_modified: typing.Optional[str]
+    # Length and modification time of the file when it was downloaded.
+    length: typing.Optional[int]
+    mtime: typing.Optional[float]
+    # Timestamp of the last time the file was downloaded or used.
+    last_used: float
+
+    def matches(self, statinfo: os.stat_result) -> bool:
+        """Returns whether the file on disk still is the file that was downloaded."""
+        if self.length is not None and self.length != statinfo.st_size:
+            return False
+        return self.mtime is None or self.mtime == statinfo.st_mtime
+
+    @property
+    def headers(self) -> dict:
+        """The stored response headers, as they were stored in the old '.headers' files."""
+        return {
+            'ETag': self.etag,
+            'Last-Modified': self.last_modified,
+            'Content-Length': None if self.length is None else str(self.length),
+        }
+
+
+class DownloadIndex:
+    """SQLite database of downloaded files, keyed by their absolute path."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        self._conn = utils.open_index(self.path, SCHEMA_VERSION, _SCHEMA)
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, filename: str, legacy_header_store: str = None) -> typing.Optional[DownloadRecord]:
+        """Returns the record of the file, or None if there is none.
+
+        :param legacy_header_store: path of the old '.headers' file of this
+            download; it is migrated into the index if there is no record yet.
+        """
+
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT * FROM downloads WHERE filename=?', (filename, )).fetchone()
+        if row is not None:
+            return DownloadRecord(*row)
+        if legacy_header_store:
+            return self.migrate_header_store(filename, legacy_header_store)
+        return None
+
+    def get_many(self, filenames: typing.Iterable[str]) -> typing.Dict[str, DownloadRecord]:
+        """Returns the records of the files that have one, as {filename: record} dict."""
+
+        filenames = list(filenames)
+        records = {}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(filenames), _QUERY_BATCH_SIZE):
+                batch = filenames[start:start + _QUERY_BATCH_SIZE]
+                query = 'SELECT * FROM downloads WHERE filename IN (%s)' % ','.join('?' * len(batch))
+                for row in conn.execute(query, batch):
+                    records[row[0]] = DownloadRecord(*row)
+        return records
+
+    def get_directory(self, directory: str) -> typing.Dict[str, DownloadRecord]:
+        """Returns the records of all files in the directory (and its subdirectories)."""
+
+        prefix = os.path.join(os.path.abspath(directory), '')
+        # All strings starting with the prefix sort between these two,
+        # so this can be answered from the primary key index.
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT * FROM downloads WHERE filename >= ? AND filename < ?',
+                (prefix, upper_bound)).fetchall()
+        return {row[0]: DownloadRecord(*row) for row in rows}
+
+    def put(self, filename: str, url: str, headers: typing.Mapping[str, str],
+            statinfo: os.stat_result = None):
+        """Stores the record of a completed download.
+
+        :param headers: the ETag, Last-Modified and Content-Length headers of the response.
+        :param statinfo: os.stat() of the file; stat'ed here if not given.
+        """
+
+        if statinfo is None:
+            statinfo = os.stat(filename)
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                _record_values(filename, url, headers, statinfo))
+
+    def touch(self, filename: str, timestamp: float = None):
+        """Marks the file as used, see DownloadRecord.last_used."""
+
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._connection().execute('UPDATE downloads SET last_used=? WHERE filename=?',
+                                       (timestamp, filename))
+
+    def delete(self, filename: str):
+        with self._lock:
+            self._connection().execute('DELETE FROM downloads WHERE filename=?', (filename, ))
+
+    def migrate_header_store(self, filename: str,
+                             header_store: str) -> typing.Optional[DownloadRecord]:
+        """Moves the headers from an old '.headers' file into the index.
+
+        :returns: the new record, or None if there was nothing to migrate.
+        """
+
+        records = self._migrate([(filename, header_store)])
+        return records.get(filename)
+
+    def migrate_directory(self, directory: str) -> int:
+        """Moves the headers from all '.headers' files in the directory into the index.
+
+        :returns: the number of migrated files.
+        """
+
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return 0
+
+        to_migrate = [(os.path.abspath(entry.path[:-len('.headers')]), entry.path)
+                      for entry in entries
+                      if entry.name.endswith('.headers') and entry.is_file()]
+        if not to_migrate:
+            return 0
+        return len(self._migrate(to_migrate))
+
+    def _migrate(self, to_migrate: typing.List[typing.Tuple[str, str]]) \
+            -> typing.Dict[str, DownloadRecord]:
+        rows = []
+        for filename, header_store in to_migrate:
+            try:
+                with open(header_store, 'r') as infile:
+                    headers = json.load(infile)
+                statinfo = os.stat(filename)
+            except FileNotFoundError:
+                # Either there is nothing to migrate, or the headers are useless
+                # without the file they describe.
+                continue
+            except (OSError, ValueError) as ex:
+                log.warning('Unable to migrate %r, ignoring it: %s', header_store, ex)
+                continue
+            finally:
+                utils.remove_file(header_store)
+
+            # Same check as was done with the headers file.
+            try:
+                if int(headers['Content-Length']) != statinfo.st_size:
+                    continue
+            except (KeyError, TypeError, ValueError):
+                continue
+            # The old headers files didn't store the URL.
+            rows.append(_record_values(filename, '', headers, statinfo))
+
+        if rows:
+            log.info('Migrating %i header files into %s', len(rows), self.path)
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute('BEGIN')
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return {values[0]: DownloadRecord(*values) for values in rows}
+
+
+def _record_values(filename: str, url: str, headers: typing.Mapping[str, str],
+                   statinfo: os.stat_result) -> tuple:
+    try:
+        length = int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        length = statinfo.st_size
+    return (filename,
+            url,
+            str(headers.get('ETag') or ''),
+            headers.get('Last-Modified'),
+            length,
+            statinfo.st_mtime,
+            time.time())
+
+
+def index_for_directory(directory: str) -> DownloadIndex:
+    """Returns the index stored in the given directory, shared within this process."""
+
+    path = os.path.join(directory, INDEX_FILENAME)
+    with _indices_lock:
+        try:
+            return _indices[path]
+        except KeyError:
+            index = _indices[path] = DownloadIndex(path)
+            return index
+
+
+def default_index() -> DownloadIndex:
+    """Returns the index in the cache directory of the current user."""
+
+    from . import cache
+    return index_for_directory(cache.cache_directory())
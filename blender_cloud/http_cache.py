@@ -0,0 +1,255 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Size-bounded file cache for CacheControl.
+
+Cached responses are stored as one file each, written to a temporary
+file and renamed into place, so that readers never see partial files and
+no lock files are needed. An SQLite index in WAL mode tracks the size,
+last access time and number of hits of every entry, and their total size
+in a table of one row. When the total size exceeds the byte budget,
+entries are evicted by least recent use (LRU) or least frequent use (LFU)
+until it fits again.
+
+Both the files and the index can be shared by several Blender processes.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+from cachecontrol.cache import BaseCache
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.sqlite'
+SCHEMA_VERSION = 2
+_SCHEMA = (
+    '''CREATE TABLE entries (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL,
+        hits INTEGER NOT NULL
+    ) WITHOUT ROWID''',
+    # Sum of entries.size, updated in the same transactions.
+    'CREATE TABLE total (size INTEGER NOT NULL)',
+    'INSERT INTO total VALUES (0)',
+)
+
+# Byte budget of the cache, when not given.
+DEFAULT_MAX_SIZE = 256 * 1024 ** 2
+
+# Eviction removes entries until the cache is this fraction of its budget,
+# so that it doesn't have to run again for every new entry.
+EVICTION_LOW_WATER = 0.9
+
+EVICTION_POLICIES = ('lru', 'lfu')
+
+_EVICTION_ORDER = {
+    'lru': 'last_access',
+    'lfu': 'hits, last_access',
+}
+
+
+class BoundedFileCache(BaseCache):
+    """CacheControl cache of files in a directory, with a byte budget."""
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE, policy='lru',
+                 filemode=0o600, dirmode=0o700):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError('Unknown eviction policy %r, choose from %s'
+                             % (policy, ', '.join(EVICTION_POLICIES)))
+
+        self.directory = directory
+        self.max_size = max_size
+        self.policy = policy
+        self.filemode = filemode
+        self.dirmode = dirmode
+
+        self._lock = threading.Lock()
+        self._conn = None
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evictions = 0
+        self.bytes_evicted = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        os.makedirs(self.directory, self.dirmode, exist_ok=True)
+        self._conn = utils.open_index(os.path.join(self.directory, INDEX_FILENAME),
+                                      SCHEMA_VERSION, _SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha224(key.encode()).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        name = self._name(key)
+        try:
+            with open(self._path(name), 'rb') as infile:
+                value = infile.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_read += len(value)
+        with self._lock:
+            self._connection().execute(
+                'UPDATE entries SET last_access=?, hits=hits+1 WHERE name=?',
+                (time.time(), name))
+        return value
+
+    def set(self, key: str, value: bytes, expires=None):
+        name = self._name(key)
+        path = self._path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, self.dirmode, exist_ok=True)
+
+        # Unique per process and thread, so that concurrent writers don't collide.
+        temp_path = '%s.%i-%i.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.filemode)
+            with open(fd, 'wb') as outfile:
+                outfile.write(value)
+            os.replace(temp_path, path)
+        except PermissionError as ex:
+            # On Windows a file can't be replaced while another process reads it.
+            log.debug('Unable to store %s in the HTTP cache: %s', key, ex)
+            utils.remove_file(temp_path)
+            return
+        except BaseException:
+            utils.remove_file(temp_path)
+            raise
+        self.bytes_written += len(value)
+
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                old_size, hits = conn.execute('SELECT size, hits FROM entries WHERE name=?',
+                                              (name, )).fetchone() or (0, 0)
+                # Keep the hit count of an entry that is stored again, for LFU.
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                             (name, len(value), time.time(), hits))
+                conn.execute('UPDATE total SET size=size+?', (len(value) - old_size, ))
+                total_size = conn.execute('SELECT size FROM total').fetchone()[0]
+        if total_size > self.max_size:
+            # Under LFU the new entry has the fewest hits; it shouldn't be the first to go.
+            self.evict(keep=name)
+
+    def delete(self, key: str):
+        name = self._name(key)
+        utils.remove_file(self._path(name))
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._delete_entries(conn, [name])
+
+    @staticmethod
+    def _delete_entries(conn: sqlite3.Connection, names: typing.List[str]):
+        """Removes the entries from the index and their sizes from the total."""
+
+        removed = 0
+        for name in names:
+            row = conn.execute('SELECT size FROM entries WHERE name=?', (name, )).fetchone()
+            if row is None:
+                continue
+            conn.execute('DELETE FROM entries WHERE name=?', (name, ))
+            removed += row[0]
+        if removed:
+            conn.execute('UPDATE total SET size=size-?', (removed, ))
+
+    def evict(self, target_size: int = None, keep: str = None) -> int:
+        """Removes entries according to the eviction policy until the cache fits.
+
+        :param target_size: size in bytes to shrink to, defaults to
+            EVICTION_LOW_WATER times the byte budget.
+        :param keep: name of an entry that shouldn't be evicted.
+        :returns: the number of bytes removed.
+        """
+
+        if target_size is None:
+            target_size = int(self.max_size * EVICTION_LOW_WATER)
+
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute('SELECT name, size FROM entries ORDER BY %s'
+                                % _EVICTION_ORDER[self.policy]).fetchall()
+            total_size = sum(size for _, size in rows)
+            evicted = []
+            removed = 0
+            for name, size in rows:
+                if total_size - removed <= target_size:
+                    break
+                if name == keep:
+                    continue
+                utils.remove_file(self._path(name))
+                evicted.append(name)
+                removed += size
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._delete_entries(conn, evicted)
+
+        self.evictions += len(evicted)
+        self.bytes_evicted += removed
+        if evicted:
+            log.info('Evicted %i entries (%i bytes) from the HTTP cache in %s',
+                     len(evicted), removed, self.directory)
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            conn = self._connection()
+            entries = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            size = conn.execute('SELECT size FROM total').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'evictions': self.evictions,
+            'bytes_evicted': self.bytes_evicted,
+            'entries': entries,
+            'size': int(size),
+            'max_size': self.max_size,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
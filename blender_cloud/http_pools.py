@@ -0,0 +1,282 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Separate HTTP connection pools for the different kinds of requests.
+
+Requests made with the 'requests' library are divided over three pools,
+so that a large texture download can't hold up the API calls the user
+interface is waiting for:
+
+- API: calls to the Pillar API, by pillarsdk.
+- THUMBNAILS: many small downloads, for the texture browser.
+- TRANSFERS: downloads of texture files and uploads.
+
+Each pool has its own connection pool size, keep-alive and retry policy,
+see PoolConfig. Thumbnails and bulk transfers also run on their own thread
+pools, so that they don't occupy the threads of the asyncio executor that
+API calls run on.
+"""
+
+import concurrent.futures
+import logging
+import socket
+import threading
+import typing
+
+import requests
+import requests.adapters
+import requests.packages.urllib3.util.retry
+from requests.packages.urllib3.connection import HTTPConnection
+
+log = logging.getLogger(__name__)
+
+API = 'api'
+THUMBNAILS = 'thumbnails'
+TRANSFERS = 'transfers'
+
+
+class PoolConfig(typing.NamedTuple):
+    # Maximum number of connections kept per host.
+    pool_maxsize: int
+    # Number of retries after connection errors, and after responses with one of
+    # retry_statuses for idempotent requests. Retries wait backoff_factor * 2^n seconds.
+    retries: int
+    backoff_factor: float
+    retry_statuses: typing.FrozenSet[int] = frozenset()
+    # Whether to wait for a free connection when all pool_maxsize connections are
+    # in use, instead of opening one that is closed after use.
+    pool_block: bool = False
+    # Whether connections are reused; when False, the server is asked to close them.
+    keep_alive: bool = True
+    # When set, TCP keep-alive probes are sent after a connection has been idle
+    # for this many seconds, to detect dead connections during long transfers.
+    tcp_keepalive_idle: typing.Optional[int] = None
+    # When set, requests of this pool run on their own thread pool of this size,
+    # see executor().
+    max_workers: typing.Optional[int] = None
+
+    def retry(self) -> requests.packages.urllib3.util.retry.Retry:
+        return requests.packages.urllib3.util.retry.Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.retry_statuses,
+            # Return the last response when it keeps failing, instead of raising
+            # MaxRetryError, so that callers see the HTTP status.
+            raise_on_status=False,
+        )
+
+    def socket_options(self) -> list:
+        options = list(HTTPConnection.default_socket_options)
+        if self.tcp_keepalive_idle is None:
+            return options
+
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        # Not every platform allows setting the timings.
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.tcp_keepalive_idle))
+        elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, self.tcp_keepalive_idle))
+        return options
+
+
+POOL_CONFIGS = {
+    # Pillar calls are limited by pillar.pillar_limiter; one connection per call.
+    # The limiter backs off on overload errors, so those aren't retried here.
+    API: PoolConfig(pool_maxsize=16, retries=10, backoff_factor=0.05),
+    THUMBNAILS: PoolConfig(pool_maxsize=8, retries=3, backoff_factor=0.1,
+                           retry_statuses=frozenset({502, 503, 504}), max_workers=8),
+    # Two files downloaded in pillar.DOWNLOAD_SEGMENTS byte ranges at a time.
+    TRANSFERS: PoolConfig(pool_maxsize=8, retries=5, backoff_factor=0.5,
+                          retry_statuses=frozenset({502, 503, 504}),
+                          tcp_keepalive_idle=60, max_workers=8),
+}
+
+_lock = threading.RLock()
+_sessions = {}  # {pool name: requests.Session}
+_mounted = {}  # {pool name: [(session, adapter class, adapter kwargs)]}
+_executors = {}  # {pool name: ThreadPoolExecutor}
+
+
+class PoolAdapterMixin:
+    """Applies a PoolConfig to a requests.adapters.HTTPAdapter (sub)class."""
+
+    def __init__(self, *args, pool_config: PoolConfig, **kwargs):
+        self.pool_config = pool_config
+        super().__init__(*args,
+                         pool_maxsize=pool_config.pool_maxsize,
+                         pool_block=pool_config.pool_block,
+                         max_retries=pool_config.retry(),
+                         **kwargs)
+
+    def init_poolmanager(self, *args, **pool_kwargs):
+        # Also called when unpickling, when pool_config may not have been restored yet.
+        pool_config = getattr(self, 'pool_config', None)
+        if pool_config is not None:
+            pool_kwargs['socket_options'] = pool_config.socket_options()
+        super().init_poolmanager(*args, **pool_kwargs)
+
+    def add_headers(self, request, **kwargs):
+        super().add_headers(request, **kwargs)
+        if not self.pool_config.keep_alive:
+            request.headers['Connection'] = 'close'
+
+
+class PoolAdapter(PoolAdapterMixin, requests.adapters.HTTPAdapter):
+    pass
+
+
+_adapter_classes = {requests.adapters.HTTPAdapter: PoolAdapter}
+
+
+def _adapter_class(base_class) -> type:
+    try:
+        return _adapter_classes[base_class]
+    except KeyError:
+        cls = _adapter_classes[base_class] = type('Pool%s' % base_class.__name__,
+                                                  (PoolAdapterMixin, base_class), {})
+        return cls
+
+
+def mount(session: requests.Session, pool_name: str,
+          adapter_class=requests.adapters.HTTPAdapter, **adapter_kwargs):
+    """Mounts an adapter for the pool on the session, for HTTP and HTTPS.
+
+    The adapter is mounted again when the pool is reconfigured.
+
+    :param adapter_class: HTTPAdapter or a subclass, like cachecontrol.CacheControlAdapter.
+    :param adapter_kwargs: extra keyword arguments for the adapter class.
+    """
+
+    with _lock:
+        _mounted.setdefault(pool_name, []).append((session, adapter_class, adapter_kwargs))
+        _mount_adapter(session, pool_name, adapter_class, adapter_kwargs)
+
+
+def _mount_adapter(session: requests.Session, pool_name: str, adapter_class, adapter_kwargs):
+    config = POOL_CONFIGS[pool_name]
+    adapter = _adapter_class(adapter_class)(pool_config=config, **adapter_kwargs)
+    old_adapters = {session.adapters.get(prefix) for prefix in ('https://', 'http://')}
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    for old_adapter in old_adapters:
+        if old_adapter is not None:
+            old_adapter.close()
+
+
+def session(pool_name: str) -> requests.Session:
+    """Returns the session for requests of the given pool, shared within this process."""
+
+    with _lock:
+        try:
+            return _sessions[pool_name]
+        except KeyError:
+            pass
+        sess = _sessions[pool_name] = requests.session()
+        mount(sess, pool_name)
+        return sess
+
+
+def configure(pool_name: str, **changes):
+    """Changes the configuration of the pool, see PoolConfig for the options.
+
+    Sessions of the pool get new adapters; their idle connections are closed.
+    """
+
+    with _lock:
+        POOL_CONFIGS[pool_name] = POOL_CONFIGS[pool_name]._replace(**changes)
+        log.debug('HTTP pool %s: %s', pool_name, POOL_CONFIGS[pool_name])
+        for sess, adapter_class, adapter_kwargs in _mounted.get(pool_name, ()):
+            _mount_adapter(sess, pool_name, adapter_class, adapter_kwargs)
+
+        executor = _executors.pop(pool_name, None)
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def executor(pool_name: str) -> typing.Optional[concurrent.futures.ThreadPoolExecutor]:
+    """Returns the thread pool for requests of the pool.
+
+    Returns None when the pool has no max_workers, so that the default
+    executor of the asyncio loop is used.
+    """
+
+    max_workers = POOL_CONFIGS[pool_name].max_workers
+    if not max_workers:
+        return None
+
+    with _lock:
+        try:
+            return _executors[pool_name]
+        except KeyError:
+            pass
+        pool_executor = _executors[pool_name] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='blender-cloud-%s' % pool_name)
+        return pool_executor
+
+
+def stats() -> typing.Dict[str, dict]:
+    """Returns statistics of the connection pools, per pool name.
+
+    'connections_opened' and 'requests' count since the adapter was mounted;
+    'idle_connections' are open and waiting to be reused.
+    """
+
+    with _lock:
+        mounted = {pool_name: list(sessions) for pool_name, sessions in _mounted.items()}
+
+    result = {}
+    for pool_name in POOL_CONFIGS:
+        pool_stats = {'hosts': 0, 'connections_opened': 0, 'requests': 0,
+                      'idle_connections': 0, 'pool_maxsize': POOL_CONFIGS[pool_name].pool_maxsize}
+        adapters = {sess.adapters.get(prefix)
+                    for sess, _, _ in mounted.get(pool_name, ())
+                    for prefix in ('https://', 'http://')}
+        for adapter in adapters:
+            poolmanager = getattr(adapter, 'poolmanager', None)
+            if poolmanager is None:
+                continue
+            for key in poolmanager.pools.keys():
+                conn_pool = poolmanager.pools.get(key)
+                if conn_pool is None or conn_pool.pool is None:
+                    continue
+                pool_stats['hosts'] += 1
+                pool_stats['connections_opened'] += conn_pool.num_connections
+                pool_stats['requests'] += conn_pool.num_requests
+                # Unused slots in the queue are None.
+                pool_stats['idle_connections'] += sum(
+                    1 for conn in list(conn_pool.pool.queue) if conn is not None)
+        result[pool_name] = pool_stats
+    return result
+
+
+def close():
+    """Closes all idle connections and stops the thread pools."""
+
+    with _lock:
+        adapters = {sess.adapters.get(prefix)
+                    for sessions in _mounted.values()
+                    for sess, _, _ in sessions
+                    for prefix in ('https://', 'http://')}
+        executors = list(_executors.values())
+        _executors.clear()
+
+    for adapter in adapters:
+        if adapter is not None:
+            adapter.close()
+    for pool_executor in executors:
+        pool_executor.shutdown(wait=False)
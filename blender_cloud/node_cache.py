@@ -0,0 +1,386 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Persistent cache of Pillar documents, used by the texture browser.
+
+Project, node and file documents are stored by their '_id', together with
+their '_etag', so that they can be revalidated with the server. Listings
+map a query (like "the texture folders in this node") to the IDs of the
+documents it returned, and record which parent node or project they list
+the children of.
+
+The cache is an SQLite database in WAL mode, so that multiple Blender
+instances can use it at the same time. In front of it sits a MemoryCache of
+the decoded documents and listings, so that browsing back and forth doesn't
+decode the same JSON again.
+"""
+
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+import pillarsdk
+import pillarsdk.utils
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+CACHE_FILENAME = 'documents.sqlite'
+SCHEMA_VERSION = 1
+_SCHEMA = (
+    '''CREATE TABLE documents (
+        kind TEXT NOT NULL,
+        id TEXT NOT NULL,
+        etag TEXT,
+        doc TEXT NOT NULL,
+        fetched REAL NOT NULL,
+        PRIMARY KEY (kind, id)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE listings (
+        key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        parent TEXT,
+        ids TEXT NOT NULL,
+        fetched REAL NOT NULL
+    ) WITHOUT ROWID''',
+    'CREATE INDEX listings_parent ON listings (parent)',
+)
+
+# Maximum number of IDs per query, to stay below SQLite's limit on
+# the number of query parameters.
+_QUERY_BATCH_SIZE = 500
+
+# Number of decoded documents and listings kept in memory per DocumentCache, and for
+# how many seconds; this limits how long changes by other Blender instances go unseen.
+MEMORY_CACHE_SIZE = 4096
+MEMORY_CACHE_TTL = 600
+
+_caches = {}  # mapping from database path to DocumentCache
+_caches_lock = threading.Lock()
+
+
+class CachedListing(typing.NamedTuple):
+    key: str
+    # The documents in the order the server returned them.
+    docs: list
+    # Timestamp of the last time the listing was fetched or revalidated.
+    fetched: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched
+
+    @property
+    def etags(self) -> typing.Dict[str, typing.Optional[str]]:
+        return {doc['_id']: doc._etag for doc in self.docs}
+
+
+class MemoryCache:
+    """Bounded in-memory cache of decoded objects, with a time to live.
+
+    The least recently used entry is dropped when there are more than
+    max_entries. Entries can be tagged, so that all entries of one kind can
+    be invalidated at once. Cached objects are shared between all callers;
+    they must not be modified.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key: (expiry time, tags, value)
+        self._lock = threading.Lock()
+
+        # Incremented on every invalidation, see put().
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: typing.Hashable, default=None):
+        now = time.monotonic()
+        with self._lock:
+            try:
+                expires, _, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < now:
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: typing.Hashable, value, tags: typing.Iterable = (),
+            generation: int = None):
+        """Stores the value under the key.
+
+        :param tags: see invalidate().
+        :param generation: the value of self.generation from before the value
+            was obtained; when something was invalidated since, the value may be
+            outdated and isn't stored.
+        """
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, frozenset(tags), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tag: typing.Hashable) -> int:
+        """Removes the entries with the given tag, returns how many were removed."""
+
+        with self._lock:
+            self.generation += 1
+            keys = [key for key, (_, tags, _) in self._entries.items() if tag in tags]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _kind(resource_class) -> str:
+    return resource_class.path
+
+
+def _dumps(doc: pillarsdk.Resource) -> str:
+    # The pillarsdk JSON encoder stores datetimes in the format the server uses.
+    return pillarsdk.utils.dumps(doc.to_dict())
+
+
+def _loads(resource_class, doc_json: str) -> pillarsdk.Resource:
+    return resource_class(pillarsdk.utils.convert_datetime(json.loads(doc_json)))
+
+
+class DocumentCache:
+    """SQLite database of Pillar documents and listings of those documents."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+        # Keys are ('doc', kind, ID) for (document, fetched) tuples and ('listing', key)
+        # for (kind, IDs, fetched) tuples; listings are also tagged with their parent.
+        self.memory = MemoryCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        self._conn = utils.open_index(self.path, SCHEMA_VERSION, _SCHEMA)
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, resource_class, doc_ids: typing.Iterable[str],
+            max_age: float = None) -> typing.Dict[str, pillarsdk.Resource]:
+        """Returns the cached documents, as {doc ID: document} dict.
+
+        :param resource_class: pillarsdk.Node, pillarsdk.File, etc.
+        :param max_age: when given, documents fetched longer than this many
+            seconds ago are omitted.
+        """
+
+        min_fetched = -1.0 if max_age is None else time.time() - max_age
+        kind = _kind(resource_class)
+
+        docs = {}
+        missing = []
+        for doc_id in doc_ids:
+            doc, fetched = self.memory.get(('doc', kind, doc_id), (None, None))
+            if doc is None:
+                missing.append(doc_id)
+            elif fetched >= min_fetched:
+                docs[doc_id] = doc
+        if not missing:
+            return docs
+
+        rows = []
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(missing), _QUERY_BATCH_SIZE):
+                batch = missing[start:start + _QUERY_BATCH_SIZE]
+                query = 'SELECT id, doc, fetched FROM documents WHERE kind=? AND id IN (%s)' \
+                        % ','.join('?' * len(batch))
+                rows.extend(conn.execute(query, [kind] + batch))
+        for doc_id, doc_json, fetched in rows:
+            doc = _loads(resource_class, doc_json)
+            self._remember_doc(kind, doc, fetched)
+            if fetched >= min_fetched:
+                docs[doc_id] = doc
+        return docs
+
+    def _remember_doc(self, kind: str, doc: pillarsdk.Resource, fetched: float):
+        self.memory.put(('doc', kind, doc['_id']), (doc, fetched), tags=[kind])
+
+    def _remembered_docs(self, kind: str, doc_ids: typing.Iterable[str]) \
+            -> typing.Optional[list]:
+        """Returns the documents from memory, or None if any of them isn't there."""
+
+        docs = []
+        for doc_id in doc_ids:
+            doc, _ = self.memory.get(('doc', kind, doc_id), (None, None))
+            if doc is None:
+                return None
+            docs.append(doc)
+        return docs
+
+    def put(self, resource_class, docs: typing.Iterable[pillarsdk.Resource]):
+        """Stores the documents, replacing earlier versions."""
+
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                self._put_docs(conn, resource_class, docs, time.time())
+
+    def _put_docs(self, conn: sqlite3.Connection, resource_class, docs, timestamp: float):
+        kind = _kind(resource_class)
+        docs = list(docs)
+        conn.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+                         ((kind, doc['_id'], doc._etag, _dumps(doc), timestamp)
+                          for doc in docs))
+        for doc in docs:
+            self._remember_doc(kind, doc, timestamp)
+
+    def get_listing(self, resource_class, key: str) -> typing.Optional[CachedListing]:
+        """Returns the listing with its documents, or None if it isn't (completely) cached."""
+
+        kind = _kind(resource_class)
+        remembered = self.memory.get(('listing', key))
+        if remembered is not None and remembered[0] == kind:
+            _, ids, fetched = remembered
+            docs = self._remembered_docs(kind, ids)
+            if docs is not None:
+                return CachedListing(key, docs, fetched)
+
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT ids, fetched, parent FROM listings WHERE key=? AND kind=?',
+                               (key, kind)).fetchone()
+            if row is None:
+                return None
+            ids = json.loads(row[0])
+            rows = []
+            for start in range(0, len(ids), _QUERY_BATCH_SIZE):
+                batch = ids[start:start + _QUERY_BATCH_SIZE]
+                query = 'SELECT id, doc, fetched FROM documents WHERE kind=? AND id IN (%s)' \
+                        % ','.join('?' * len(batch))
+                rows.extend(conn.execute(query, [kind] + batch))
+            generation = self.memory.generation
+
+        if len(rows) < len(set(ids)):
+            log.debug('Listing %s refers to documents that are no longer cached', key)
+            return None
+
+        decoded = {}
+        for doc_id, doc_json, fetched in rows:
+            doc = decoded[doc_id] = _loads(resource_class, doc_json)
+            self._remember_doc(kind, doc, fetched)
+        self._remember_listing(key, kind, row[2], ids, row[1], generation)
+        return CachedListing(key, [decoded[doc_id] for doc_id in ids], row[1])
+
+    def _remember_listing(self, key: str, kind: str, parent: typing.Optional[str],
+                          ids: typing.List[str], fetched: float, generation: int = None):
+        self.memory.put(('listing', key), (kind, ids, fetched),
+                        tags=[kind, ('parent', parent)], generation=generation)
+
+    def put_listing(self, resource_class, key: str, parent: typing.Optional[str],
+                    doc_ids: typing.List[str], docs: typing.Iterable[pillarsdk.Resource]):
+        """Stores the listing and its documents in one transaction.
+
+        :param parent: ID of the node or project this lists the children of, if any;
+            see invalidate_parent().
+        :param doc_ids: IDs of the documents in the listing, in order.
+        :param docs: the listed documents that should be stored; documents that
+            are already in the cache and didn't change can be omitted.
+        """
+
+        timestamp = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                self._put_docs(conn, resource_class, docs, timestamp)
+                conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                             (key, _kind(resource_class), parent, json.dumps(doc_ids),
+                              timestamp))
+            self._remember_listing(key, _kind(resource_class), parent, list(doc_ids), timestamp)
+
+    def invalidate_parent(self, parent: str):
+        """Removes the listings of the children of the given node or project."""
+
+        with self._lock:
+            self._connection().execute('DELETE FROM listings WHERE parent=?', (parent, ))
+            self.memory.invalidate(('parent', parent))
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                conn.execute('DELETE FROM documents')
+                conn.execute('DELETE FROM listings')
+            self.memory.clear()
+
+
+def cache_for_directory(directory: str) -> DocumentCache:
+    """Returns the cache stored in the given directory, shared within this process."""
+
+    path = os.path.join(directory, CACHE_FILENAME)
+    with _caches_lock:
+        try:
+            return _caches[path]
+        except KeyError:
+            doc_cache = _caches[path] = DocumentCache(path)
+            return doc_cache
+
+
+def default_cache() -> DocumentCache:
+    """Returns the cache in the cache directory of the current user."""
+
+    from . import cache
+    return cache_for_directory(cache.cache_directory())
@@ -17,24 +17,27 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import asyncio
+import copy
 import datetime
 import json
 import os
 import functools
 import logging
+import threading
 from contextlib import closing, contextmanager
 import urllib.parse
 import pathlib
+import typing
 
-import requests.adapters
-import requests.packages.urllib3.util.retry
+import requests.exceptions
 import requests.structures
 import pillarsdk
 import pillarsdk.exceptions
 import pillarsdk.utils
 from pillarsdk.utils import sanitize_filename
 
-from . import cache
+from . import async_http, blob_store, cache, concurrency, download_index, http_pools, \
+    node_cache
 
 SUBCLIENT_ID = 'PILLAR'
 TEXTURE_NODE_TYPES = {'texture', 'hdri'}
@@ -42,19 +45,46 @@ TEXTURE_NODE_TYPES = {'texture', 'hdri'}
 RFC1123_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
 
 _pillar_api = {}  # will become a mapping from bool (cached/non-cached) to pillarsdk.Api objects.
+_pillar_api_credentials = None  # (user ID, token) the _pillar_api objects were created with.
 log = logging.getLogger(__name__)
 
-_retries = requests.packages.urllib3.util.retry.Retry(
-    total=10,
-    backoff_factor=0.05,
-)
-_http_adapter = requests.adapters.HTTPAdapter(max_retries=_retries)
-uncached_session = requests.session()
-uncached_session.mount('https://', _http_adapter)
-uncached_session.mount('http://', _http_adapter)
+# Session for uncached Pillar API calls; downloads and uploads use their own pools.
+uncached_session = http_pools.session(http_pools.API)
 
 _testing_blender_id_profile = None  # Just for testing, overrides what is returned by blender_id_profile.
 _downloaded_urls = set()  # URLs we've downloaded this Blender session.
+_revalidations = {}  # Listing key: Task revalidating that listing in the document cache.
+
+# Downloads of at least this many bytes are split into this many byte ranges,
+# which are downloaded concurrently, when the server supports range requests.
+SEGMENTED_DOWNLOAD_MIN_SIZE = 16 * 1024 * 1024
+DOWNLOAD_SEGMENTS = 4
+
+# Journals of partial downloads are saved every time this many bytes have been downloaded.
+JOURNAL_SAVE_INTERVAL = 4 * 1024 * 1024
+
+# Number of items requested per page by iter_pages(). The server may return fewer.
+PAGE_SIZE = 100
+
+# Maximum number of IDs per query in fetch_docs_by_id(); they end up in the URL.
+FILE_QUERY_BATCH_SIZE = 100
+
+# Listings in the document cache are revalidated with the server when they are older
+# than this many seconds; younger ones are used without any requests.
+NODE_CACHE_MAX_AGE = 300
+
+# Fields of File documents needed to show and download their thumbnails.
+THUMBNAIL_FILE_PROJECTION = {'filename': 1, 'variations': 1, 'width': 1, 'height': 1,
+                             'length': 1}
+
+# Windows has no os.pwrite(); segments are then written through their own file object.
+_have_pwrite = hasattr(os, 'pwrite')
+
+# Perform HTTP requests on the asyncio loop with async_http, instead of running
+# the 'requests' library on the default executor. The threaded transport is
+# still used for calls through the HTTP cache, when proxies are configured,
+# and for requests that async_http doesn't support.
+NATIVE_TRANSPORT = False
 
 
 class UserNotLoggedInError(RuntimeError):
@@ -188,11 +218,16 @@ def pillar_api(pillar_endpoint: str = None, caching=True) -> pillarsdk.Api:
     :param caching: whether to return a caching or non-caching API
     """
 
-    global _pillar_api
+    global _pillar_api, _pillar_api_credentials
 
     # Only return the Pillar API object if the user is still logged in.
     subclient = blender_id_subclient()
 
+    credentials = (subclient['subclient_user_id'], subclient['token'])
+    if _pillar_api and credentials != _pillar_api_credentials:
+        log.debug('Blender ID credentials changed, creating new Pillar API objects')
+        reset_pillar_api()
+
     if not _pillar_api:
         # Allow overriding the endpoint before importing Blender-specific stuff.
         if pillar_endpoint is None:
@@ -221,48 +256,217 @@ def pillar_api(pillar_endpoint: str = None, caching=True) -> pillarsdk.Api:
             True: _caching_api,
             False: _noncaching_api,
         }
+        _pillar_api_credentials = credentials
 
     return _pillar_api[caching]
 
 
-# This is an asyncio.Semaphore object, which is late-instantiated to be sure
-# the asyncio loop has been created properly. On Windows we create a new one,
-# which can cause this semaphore to still be linked against the old default
-# loop.
-pillar_semaphore = None
+def reset_pillar_api():
+    """Forgets the Pillar API objects and the query results obtained with them.
+
+    Call this when the credentials of the user change.
+    """
+
+    global _pillar_api, _pillar_api_credentials
+
+    _pillar_api = None
+    _pillar_api_credentials = None
+    pillar_memory_cache.clear()
+
+
+# Limits the number of simultaneous Pillar calls. The limit adapts to how
+# quickly Pillar responds; see concurrency.AdaptiveLimiter.
+pillar_limiter = concurrency.AdaptiveLimiter(initial_limit=3, min_limit=1, max_limit=16)
+
+# HTTP status codes with which the server tells us to back off.
+OVERLOAD_STATUS_CODES = {429, 502, 503, 504}
+
+
+def _is_overload_error(ex: Exception) -> bool:
+    """Returns whether the exception indicates that Pillar is overloaded."""
+
+    if isinstance(ex, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(ex, pillarsdk.exceptions.ConnectionError):
+        status_code = getattr(ex.response, 'status_code', None)
+        return status_code in OVERLOAD_STATUS_CODES
+    return False
+
+
+def _native_transport(caching=False) -> typing.Optional[async_http.Transport]:
+    """Returns the asyncio-native transport, or None if the threaded one should be used."""
+
+    # The HTTP cache is implemented as requests.Session.
+    if not NATIVE_TRANSPORT or caching or not async_http.supported():
+        return None
+    return async_http.default_transport()
+
+
+# Read-only pillarsdk class methods; identical concurrent calls to these share one request.
+SINGLE_FLIGHT_METHODS = {'all', 'all_from_endpoint', 'find', 'find_first', 'find_from_endpoint',
+                         'find_one', 'me'}
+
+# Shares the result of a call with identical calls made while it is in flight.
+pillar_single_flight = concurrency.SingleFlight()
+
+# Results of queries with caching=True are kept in memory for this many seconds,
+# so that repeating a query doesn't even reach the HTTP cache. Calls to one of
+# MODIFYING_METHODS through pillar_call() or sync_call() invalidate the results
+# of their resource class.
+PILLAR_MEMORY_CACHE_TTL = 60
+pillar_memory_cache = node_cache.MemoryCache(max_entries=512, ttl=PILLAR_MEMORY_CACHE_TTL)
+
+# Queries that aren't kept in memory; the current user's roles change when
+# their subscription is renewed.
+MEMORY_CACHE_EXCLUDED_METHODS = {'me'}
+
+# pillarsdk methods that change documents on the server.
+MODIFYING_METHODS = {'create', 'create_asset_from_file', 'delete', 'patch', 'post',
+                     'replace', 'share', 'update'}
+
+_MISSING = object()
+
+
+def _is_query(pillar_func) -> bool:
+    resource_class = getattr(pillar_func, '__self__', None)
+    return isinstance(resource_class, type) and pillar_func.__name__ in SINGLE_FLIGHT_METHODS
+
+
+def _resource_kind(pillar_func) -> typing.Optional[str]:
+    """Returns the endpoint path of the class or instance the function is bound to."""
+
+    owner = getattr(pillar_func, '__self__', None)
+    if owner is None:
+        return None
+    resource_class = owner if isinstance(owner, type) else type(owner)
+    return getattr(resource_class, 'path', None)
+
+
+def _invalidate_memory_cache(pillar_func):
+    """Forgets the query results that the call may have changed, if it is a modifying call."""
+
+    if getattr(pillar_func, '__name__', None) not in MODIFYING_METHODS:
+        return
+    kind = _resource_kind(pillar_func)
+    if kind is None:
+        pillar_memory_cache.clear()
+        return
+    count = pillar_memory_cache.invalidate(kind)
+    if count:
+        log.debug('%s invalidated %i cached %s queries', pillar_func.__name__, count, kind)
+
+
+def _single_flight_key(pillar_func, args: tuple, kwargs: dict, caching: bool):
+    """Returns the key identifying the call, or None if it shouldn't be shared."""
+
+    if not _is_query(pillar_func):
+        # Instance methods and anything that isn't a query; those may change things.
+        return None
+    resource_class = pillar_func.__self__
+    try:
+        arguments = json.dumps([args, kwargs], sort_keys=True, default=repr)
+    except (TypeError, ValueError):
+        return None
+    return resource_class, pillar_func.__name__, caching, arguments
 
 
 async def pillar_call(pillar_func, *args, caching=True, **kwargs):
     """Calls a Pillar function.
 
-    A semaphore is used to ensure that there won't be too many
-    calls to Pillar simultaneously.
+    The number of simultaneous calls to Pillar is limited by pillar_limiter,
+    which adapts to the latency and errors of these calls. Queries that are
+    identical to one in flight (same function, arguments and caching flag)
+    wait for that one instead, see SINGLE_FLIGHT_METHODS; they all get the
+    same result object. With caching=True, that result is also kept in
+    pillar_memory_cache for a while. Result objects are shared, so they
+    must not be modified.
     """
 
-    partial = functools.partial(pillar_func, *args, api=pillar_api(caching=caching), **kwargs)
-    loop = asyncio.get_event_loop()
+    key = _single_flight_key(pillar_func, args, kwargs, caching)
+    if key is None:
+        try:
+            return await _limited_pillar_call(pillar_func, args, kwargs, caching)
+        finally:
+            _invalidate_memory_cache(pillar_func)
+
+    use_memory_cache = caching and pillar_func.__name__ not in MEMORY_CACHE_EXCLUDED_METHODS
+    if use_memory_cache:
+        # Forgets the cached results when the credentials changed.
+        pillar_api(caching=caching)
+        result = pillar_memory_cache.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+    generation = pillar_memory_cache.generation
+
+    label = '%s.%s' % (key[0].__name__, pillar_func.__name__)
+    result = await pillar_single_flight.call(
+        key, lambda: _limited_pillar_call(pillar_func, args, kwargs, caching), label)
+    if use_memory_cache:
+        pillar_memory_cache.put(key, result, tags=[_resource_kind(pillar_func)],
+                                generation=generation)
+    return result
+
+
+async def _limited_pillar_call(pillar_func, args: tuple, kwargs: dict, caching: bool):
+    api = pillar_api(caching=caching)
+    transport = _native_transport(caching)
 
     # Use explicit calls to acquire() and release() so that we have more control over
     # how long we wait and how we handle timeouts.
     try:
-        await asyncio.wait_for(pillar_semaphore.acquire(), timeout=10, loop=loop)
+        token = await pillar_limiter.acquire(timeout=10)
     except asyncio.TimeoutError:
-        log.info('Waiting for semaphore to call %s', pillar_func.__name__)
+        log.info('Waiting for a free slot to call %s; limiter: %s; connections: %s',
+                 pillar_func.__name__, pillar_limiter.stats(),
+                 http_pools.stats()[http_pools.API])
         try:
-            await asyncio.wait_for(pillar_semaphore.acquire(), timeout=50, loop=loop)
+            token = await pillar_limiter.acquire(timeout=50)
         except asyncio.TimeoutError:
             raise RuntimeError('Timeout waiting for Pillar Semaphore!')
 
     try:
-        return await loop.run_in_executor(None, partial)
-    finally:
-        pillar_semaphore.release()
+        result = await _perform_pillar_call(transport, api, pillar_func, args, kwargs)
+    except pillarsdk.exceptions.ResourceNotFound:
+        # A quick and valid answer, as far as the load is concerned.
+        pillar_limiter.release(token)
+        raise
+    except Exception as ex:
+        overloaded = _is_overload_error(ex)
+        pillar_limiter.release(token, overloaded=overloaded, measure=False)
+        raise
+    except BaseException:
+        pillar_limiter.release(token, measure=False)
+        raise
+    pillar_limiter.release(token)
+    return result
+
+
+async def _perform_pillar_call(transport: typing.Optional[async_http.Transport],
+                               api: pillarsdk.Api, pillar_func, args, kwargs):
+    if transport is not None:
+        # The pillarsdk is synchronous, but only blocks on its HTTP requests.
+        # Those are performed by the native transport, see async_http.run_replayed().
+        def replayed(session: async_http.ReplaySession):
+            replay_api = copy.copy(api)
+            replay_api.requests_session = session
+            return pillar_func(*args, api=replay_api, **kwargs)
+
+        try:
+            return await async_http.run_replayed(transport, replayed)
+        except async_http.NotSupportedError as ex:
+            log.debug('Calling %s on the threaded transport: %s', pillar_func.__name__, ex)
+
+    partial = functools.partial(pillar_func, *args, api=api, **kwargs)
+    return await asyncio.get_event_loop().run_in_executor(None, partial)
 
 
 def sync_call(pillar_func, *args, caching=True, **kwargs):
     """Synchronous call to Pillar, ensures the correct Api object is used."""
 
-    return pillar_func(*args, api=pillar_api(caching=caching), **kwargs)
+    try:
+        return pillar_func(*args, api=pillar_api(caching=caching), **kwargs)
+    finally:
+        _invalidate_memory_cache(pillar_func)
 
 
 async def check_pillar_credentials(required_roles: set):
@@ -312,8 +516,6 @@ async def refresh_pillar_credentials(required_roles: set):
     :raises Exception: when the Pillar credential check fails.
     """
 
-    global _pillar_api
-
     import blender_id
 
     from . import blender
@@ -328,7 +530,7 @@ async def refresh_pillar_credentials(required_roles: set):
         raise CredentialsNotSyncedError()
 
     # Test the new URL
-    _pillar_api = None
+    reset_pillar_api()
     return await check_pillar_credentials(required_roles)
 
 
@@ -348,16 +550,61 @@ async def get_project_uuid(project_url: str) -> str:
     return project['_id']
 
 
-async def get_nodes(project_uuid: str = None, parent_node_uuid: str = None,
-                    node_type=None, max_results=None) -> list:
-    """Gets nodes for either a project or given a parent node.
+async def iter_pages(pillar_func, *args, params: dict = None, page_size: int = None,
+                     **kwargs) -> typing.AsyncIterator[list]:
+    """Yields the items of each page of an Eve collection, until the last page.
 
-    @param project_uuid: the UUID of the project, or None if only querying by parent_node_uuid.
-    @param parent_node_uuid: the UUID of the parent node. Can be the empty string if the
-        node should be a top-level node in the project. Can also be None to query all nodes in a
-        project. In both these cases the project UUID should be given.
+    The next page is requested while the caller processes the current one.
+
+    :param pillar_func: function like pillarsdk.Node.all, taking 'params' as keyword.
+    :param params: query parameters, without the page number.
+    :param page_size: requested number of items per page, defaults to PAGE_SIZE.
     """
 
+    params = dict(params or {})
+    params['max_results'] = int(page_size or PAGE_SIZE)
+    page = 1
+
+    def fetch(page_nr: int) -> asyncio.Future:
+        page_params = dict(params, page=page_nr)
+        return asyncio.ensure_future(pillar_call(pillar_func, *args, params=page_params, **kwargs))
+
+    next_page = fetch(page)
+    try:
+        while next_page is not None:
+            result = await next_page
+            next_page = None
+            items = result['_items']
+            if items and _has_next_page(result):
+                page += 1
+                next_page = fetch(page)
+            yield items
+    finally:
+        # The caller stopped iterating, or an error occurred.
+        if next_page is not None:
+            next_page.cancel()
+
+
+def _has_next_page(result) -> bool:
+    """Returns whether an Eve collection has a page after this one."""
+
+    try:
+        links = result['_links']
+    except KeyError:
+        pass
+    else:
+        return 'next' in links
+
+    # The server doesn't send links, so compute it from the metadata.
+    try:
+        meta = result['_meta']
+        return meta['page'] * meta['max_results'] < meta['total']
+    except (KeyError, TypeError):
+        return False
+
+
+def _nodes_query(project_uuid: str = None, parent_node_uuid: str = None,
+                 node_type=None) -> dict:
     if not project_uuid and not parent_node_uuid:
         raise ValueError('get_nodes(): either project_uuid or parent_node_uuid must be given.')
 
@@ -380,139 +627,785 @@ async def get_nodes(project_uuid: str = None, parent_node_uuid: str = None,
             # Convert set & tuple to list
             where['node_type'] = {'$in': list(node_type)}
 
-    params = {'projection': {'name': 1, 'parent': 1, 'node_type': 1, 'properties.order': 1,
-                             'properties.status': 1, 'properties.files': 1,
-                             'properties.content_type': 1, 'picture': 1},
-              'where': where,
-              'embed': ['parent']}
+    return {'projection': {'name': 1, 'parent': 1, 'node_type': 1, 'properties.order': 1,
+                           'properties.status': 1, 'properties.files': 1,
+                           'properties.content_type': 1, 'picture': 1},
+            'where': where,
+            'embed': ['parent']}
 
-    # Pagination
-    if max_results:
-        params['max_results'] = int(max_results)
 
-    children = await pillar_call(pillarsdk.Node.all, params)
+def iter_node_pages(project_uuid: str = None, parent_node_uuid: str = None,
+                    node_type=None, page_size: int = None) -> typing.AsyncIterator[list]:
+    """Yields pages of nodes, see get_nodes() for the parameters and iter_pages() for paging."""
 
-    return children['_items']
+    params = _nodes_query(project_uuid, parent_node_uuid, node_type)
+    return iter_pages(pillarsdk.Node.all, params=params, page_size=page_size)
 
 
-async def get_texture_projects(max_results=None) -> list:
-    """Returns project dicts that contain textures."""
+def iter_nodes(project_uuid: str = None, parent_node_uuid: str = None,
+               node_type=None, page_size: int = None) -> typing.AsyncIterator:
+    """Yields nodes one at a time, while fetching them page by page; see get_nodes()."""
+
+    return _iter_items(iter_node_pages(project_uuid, parent_node_uuid, node_type, page_size))
+
+
+async def get_nodes(project_uuid: str = None, parent_node_uuid: str = None,
+                    node_type=None, max_results=None) -> list:
+    """Gets nodes for either a project or given a parent node.
 
-    params = {}
+    @param project_uuid: the UUID of the project, or None if only querying by parent_node_uuid.
+    @param parent_node_uuid: the UUID of the parent node. Can be the empty string if the
+        node should be a top-level node in the project. Can also be None to query all nodes in a
+        project. In both these cases the project UUID should be given.
+    @param max_results: maximum number of nodes to return, or None to return all of them.
+    """
 
-    # Pagination
-    if max_results:
-        params['max_results'] = int(max_results)
+    return await _collect(iter_node_pages(project_uuid, parent_node_uuid, node_type,
+                                          page_size=max_results), max_results)
 
+
+async def iter_texture_project_pages(page_size: int = None) -> typing.AsyncIterator[list]:
+    """Yields pages of project dicts that contain textures, see iter_pages()."""
+
+    pages = iter_pages(pillarsdk.Project.all_from_endpoint, '/bcloud/texture-libraries',
+                       page_size=page_size)
     try:
-        children = await pillar_call(pillarsdk.Project.all_from_endpoint,
-                                     '/bcloud/texture-libraries',
-                                     params=params)
+        async for items in pages:
+            yield items
     except pillarsdk.ResourceNotFound as ex:
         log.warning('Unable to find texture projects: %s', ex)
         raise PillarError('Unable to find texture projects: %s' % ex)
+    finally:
+        await pages.aclose()
+
+
+def iter_texture_projects(page_size: int = None) -> typing.AsyncIterator:
+    """Yields project dicts that contain textures, while fetching them page by page."""
+
+    return _iter_items(iter_texture_project_pages(page_size))
+
+
+async def get_texture_projects(max_results=None) -> list:
+    """Returns project dicts that contain textures.
+
+    @param max_results: maximum number of projects to return, or None to return all of them.
+    """
+
+    return await _collect(iter_texture_project_pages(page_size=max_results), max_results)
+
+
+async def _iter_items(pages) -> typing.AsyncIterator:
+    """Yields the items of the pages of an async iterator one at a time."""
+
+    try:
+        async for items in pages:
+            for item in items:
+                yield item
+    finally:
+        # Stops the prefetching of the next page when the caller stops early.
+        await pages.aclose()
+
+
+async def _collect(pages, max_results=None) -> list:
+    """Concatenates the pages of an async iterator, stopping after max_results items."""
+
+    collected = []
+    try:
+        async for items in pages:
+            collected.extend(items)
+            if max_results and len(collected) >= max_results:
+                del collected[max_results:]
+                break
+    finally:
+        # Stops the prefetching of the next page.
+        await pages.aclose()
+    return collected
+
+
+def iter_node_pages_cached(project_uuid: str = None, parent_node_uuid: str = None,
+                           node_type=None, *,
+                           revalidated: callable = None,
+                           doc_cache: node_cache.DocumentCache = None) -> typing.AsyncIterator[list]:
+    """Like iter_node_pages(), but answered from the document cache when possible.
+
+    A cached listing is returned as a single page, without any requests. When
+    it is older than NODE_CACHE_MAX_AGE, it is revalidated in the background
+    by comparing the ETags of the nodes on the server with the cached ones; only
+    the nodes that changed are fetched again.
+
+    :param revalidated: called without arguments when a background revalidation
+        changed the listing, so that the caller can show it again.
+    :param doc_cache: the document cache, defaults to node_cache.default_cache().
+    """
+
+    params = _nodes_query(project_uuid, parent_node_uuid, node_type)
+    key = 'nodes:%s' % json.dumps(params['where'], sort_keys=True)
+
+    def fetch_pages():
+        return iter_pages(pillarsdk.Node.all, params=copy.deepcopy(params))
+
+    async def revalidate(listing: node_cache.CachedListing, doc_cache: node_cache.DocumentCache):
+        # Only fetch the ETags, to find out which nodes changed.
+        etag_params = {'where': params['where'], 'projection': {'_etag': 1}}
+        current = await _collect(iter_pages(pillarsdk.Node.all, params=etag_params))
+        cached_etags = listing.etags
+        changed = [node['_id'] for node in current
+                   if not node._etag or cached_etags.get(node['_id']) != node._etag]
+        log.debug('Revalidated %s: %i of %i nodes changed', key, len(changed), len(current))
+
+        docs = await fetch_docs_by_id(pillarsdk.Node, changed, {
+            'projection': params['projection'],
+            'embed': params['embed'],
+        })
+        doc_ids = [node['_id'] for node in current if node['_id'] in cached_etags or
+                   node['_id'] in docs]
+        await _run_in_executor(doc_cache.put_listing, pillarsdk.Node, key,
+                               parent_node_uuid or project_uuid, doc_ids, docs.values())
+        return bool(docs) or doc_ids != list(cached_etags)
+
+    return _iter_cached_listing(pillarsdk.Node, key, parent_node_uuid or project_uuid,
+                                fetch_pages, revalidate, revalidated, doc_cache)
+
+
+def iter_nodes_cached(project_uuid: str = None, parent_node_uuid: str = None,
+                      node_type=None, *,
+                      revalidated: callable = None,
+                      doc_cache: node_cache.DocumentCache = None) -> typing.AsyncIterator:
+    """Yields nodes one at a time, see iter_node_pages_cached()."""
+
+    return _iter_items(iter_node_pages_cached(project_uuid, parent_node_uuid, node_type,
+                                              revalidated=revalidated, doc_cache=doc_cache))
+
+
+def iter_texture_projects_cached(*, revalidated: callable = None,
+                                 doc_cache: node_cache.DocumentCache = None) \
+        -> typing.AsyncIterator:
+    """Like iter_texture_projects(), but answered from the document cache when possible.
+
+    See iter_node_pages_cached(); the texture libraries endpoint doesn't support
+    projections, so a stale listing is revalidated by fetching it completely.
+    """
+
+    key = 'texture-projects'
+
+    async def revalidate(listing: node_cache.CachedListing, doc_cache: node_cache.DocumentCache):
+        projects = await _collect(iter_texture_project_pages())
+        await _run_in_executor(doc_cache.put_listing, pillarsdk.Project, key, None,
+                               [project['_id'] for project in projects], projects)
+        return [(project['_id'], project._etag) for project in projects] != \
+            list(listing.etags.items())
+
+    return _iter_items(_iter_cached_listing(pillarsdk.Project, key, None,
+                                            iter_texture_project_pages, revalidate,
+                                            revalidated, doc_cache))
+
+
+async def _iter_cached_listing(resource_class, key: str, parent: typing.Optional[str],
+                               fetch_pages: callable, revalidate: callable,
+                               revalidated: typing.Optional[callable],
+                               doc_cache: typing.Optional[node_cache.DocumentCache]) \
+        -> typing.AsyncIterator[list]:
+    """Yields the cached listing as one page, or fetches and caches it page by page.
+
+    :param fetch_pages: returns an async iterator of the pages of the listing.
+    :param revalidate: coroutine function taking (CachedListing, DocumentCache); it
+        updates the cache and returns whether the listing changed.
+    """
+
+    if doc_cache is None:
+        doc_cache = node_cache.default_cache()
+
+    listing = await _run_in_executor(doc_cache.get_listing, resource_class, key)
+    if listing is not None:
+        if listing.age > NODE_CACHE_MAX_AGE:
+            _schedule_revalidation(key, revalidate(listing, doc_cache), revalidated)
+        else:
+            log.debug('Using cached listing %s', key)
+        yield listing.docs
+        return
+
+    docs = []
+    pages = fetch_pages()
+    try:
+        async for items in pages:
+            docs.extend(items)
+            yield items
+    finally:
+        await pages.aclose()
+
+    # Only complete listings are stored; we don't get here when the caller stopped early.
+    await _run_in_executor(doc_cache.put_listing, resource_class, key, parent,
+                           [doc['_id'] for doc in docs], docs)
+
+
+def _schedule_revalidation(key: str, coro: typing.Coroutine, revalidated: typing.Optional[callable]):
+    """Runs the revalidation in the background, unless that listing is being revalidated already."""
+
+    if key in _revalidations:
+        coro.close()
+        return
+
+    log.debug('Revalidating cached listing %s in the background', key)
+    task = _revalidations[key] = asyncio.ensure_future(coro)
+
+    def done(task: asyncio.Future):
+        _revalidations.pop(key, None)
+        if task.cancelled():
+            return
+        ex = task.exception()
+        if ex is not None:
+            log.warning('Unable to revalidate cached listing %s: %s', key, ex)
+            return
+        if task.result() and revalidated is not None:
+            revalidated()
 
-    return children['_items']
+    task.add_done_callback(done)
+
+
+async def _run_in_executor(func: callable, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, func, *args)
 
 
 async def download_to_file(url, filename, *,
-                           header_store: str,
+                           header_store: str = None,
+                           index: download_index.DownloadIndex = None,
+                           record: download_index.DownloadRecord = ...,
                            chunk_size=100 * 1024,
-                           future: asyncio.Future = None):
-    """Downloads a file via HTTP(S) directly to the filesystem."""
+                           future: asyncio.Future = None,
+                           segments: int = None,
+                           http_pool: str = http_pools.TRANSFERS):
+    """Downloads a file via HTTP(S) directly to the filesystem.
+
+    The file is downloaded to '{filename}.part' and renamed once complete.
+    When the server supports range requests, an interrupted download is
+    resumed by the next call, and large files are downloaded in concurrent
+    byte ranges, see SEGMENTED_DOWNLOAD_MIN_SIZE.
+
+    The response headers are stored in the download index, and used to only
+    download the file again when it changed on the server.
+
+    :param header_store: old-style '.headers' file of this download, which
+        is migrated into the index when it exists.
+    :param index: the download index, defaults to download_index.default_index().
+    :param record: the file's record from the index, if the caller already
+        looked it up (None if it has none); saves a query.
+    :param segments: number of concurrent byte ranges, defaults to
+        DOWNLOAD_SEGMENTS. Use 1 to always download in one stream.
+    :param http_pool: the connection pool to download with, see http_pools.
+    """
+
+    if index is None:
+        index = download_index.default_index()
+    if record is ...:
+        record = index.get(filename, legacy_header_store=header_store)
 
     stored_headers = {}
-    if os.path.exists(filename) and os.path.exists(header_store):
-        log.debug('Loading cached headers %r', header_store)
+    if record is not None:
         try:
-            with open(header_store, 'r') as infile:
-                stored_headers = requests.structures.CaseInsensitiveDict(json.load(infile))
-
-            # Check file length.
-            expected_content_length = int(stored_headers['Content-Length'])
             statinfo = os.stat(filename)
-            if expected_content_length == statinfo.st_size:
-                # File exists, and is of the correct length. Don't bother downloading again
+        except FileNotFoundError:
+            log.debug('File %s no longer exists; ignoring cache.', filename)
+        else:
+            if record.matches(statinfo):
+                # File exists, and is what we downloaded before. Don't bother downloading again
                 # if we already downloaded it this session.
                 if url in _downloaded_urls:
                     log.debug('Already downloaded %s this session, skipping this request.',
                               url)
+                    index.touch(filename)
                     return
+                stored_headers = record.headers
             else:
-                log.debug('File size should be %i but is %i; ignoring cache.',
-                          expected_content_length, statinfo.st_size)
-                stored_headers = {}
-        except Exception as ex:
-            log.warning('Unable to load headers from %r, ignoring cache: %s', header_store, str(ex))
+                log.debug('File size should be %s but is %i; ignoring cache.',
+                          record.length, statinfo.st_size)
+
+    part_filename = filename + '.part'
+    journal = None
+    if os.path.exists(part_filename):
+        journal = DownloadJournal.load(part_filename + '.journal', url)
 
     loop = asyncio.get_event_loop()
+    transport = _native_transport()
 
     # Separated doing the GET and downloading the body of the GET, so that we can cancel
     # the download in between.
 
-    def perform_get_request() -> requests.Request:
+    def request_headers() -> dict:
         headers = {}
-        try:
-            if stored_headers['Last-Modified']:
-                headers['If-Modified-Since'] = stored_headers['Last-Modified']
-        except KeyError:
-            pass
-        try:
-            if stored_headers['ETag']:
-                headers['If-None-Match'] = stored_headers['ETag']
-        except KeyError:
-            pass
+        if journal is not None:
+            # Continue the partial download, unless the file changed on the server.
+            _, start, end = journal.pending()[0]
+            headers['Range'] = _range_header(start, end)
+            headers['If-Range'] = journal.validator
+        else:
+            try:
+                if stored_headers['Last-Modified']:
+                    headers['If-Modified-Since'] = stored_headers['Last-Modified']
+            except KeyError:
+                pass
+            try:
+                if stored_headers['ETag']:
+                    headers['If-None-Match'] = stored_headers['ETag']
+            except KeyError:
+                pass
+        return headers
 
+    def perform_get_request() -> requests.Request:
         if is_cancelled(future):
             log.debug('Downloading was cancelled before doing the GET.')
             raise asyncio.CancelledError('Downloading was cancelled')
         log.debug('Performing GET request, waiting for response.')
-        return uncached_session.get(url, headers=headers, stream=True, verify=True)
-
-    # Download the file in a different thread.
-    def download_loop():
-        with with_existing_dir(filename, 'wb') as outfile:
-            with closing(response):
-                for block in response.iter_content(chunk_size=chunk_size):
-                    if is_cancelled(future):
-                        raise asyncio.CancelledError('Downloading was cancelled')
-                    outfile.write(block)
+        return http_pools.session(http_pool).get(url, headers=request_headers(), stream=True,
+                                                 verify=True)
 
     # Check for cancellation even before we start our GET request
     if is_cancelled(future):
         log.debug('Downloading was cancelled before doing the GET')
         raise asyncio.CancelledError('Downloading was cancelled')
 
+    if journal is not None and not journal.pending():
+        # We were interrupted between completing the download and renaming the file.
+        log.debug('Partial download of %s is already complete', _shorten(url))
+        _finish_download(url, filename, index, journal)
+        return
+
     log.debug('Performing GET %s', _shorten(url))
-    response = await loop.run_in_executor(None, perform_get_request)
+    if transport is not None:
+        response = await transport.request('GET', url, headers=request_headers(), stream=True)
+    else:
+        response = await loop.run_in_executor(http_pools.executor(http_pool), perform_get_request)
     log.debug('Status %i from GET %s', response.status_code, _shorten(url))
     response.raise_for_status()
 
     if response.status_code == 304:
         # The file we have cached is still good, just use that instead.
+        response.close()
         _downloaded_urls.add(url)
+        index.touch(filename)
         return
 
+    if journal is not None:
+        _, start, end = journal.pending()[0]
+        if _is_expected_range(response, start, end, journal.size):
+            log.info('Resuming download of %s at byte %i', _shorten(url), journal.completed())
+        else:
+            log.info('File changed on the server, restarting download of %s', _shorten(url))
+            journal.remove()
+            journal = None
+            if response.status_code != 200:
+                response.close()
+                raise PillarError('Unexpected status %i when resuming download of %s' %
+                                  (response.status_code, _shorten(url)))
+
     # After we performed the GET request, we should check whether we should start
     # the download at all.
     if is_cancelled(future):
         log.debug('Downloading was cancelled before downloading the GET response')
+        response.close()
         raise asyncio.CancelledError('Downloading was cancelled')
 
-    log.debug('Downloading response of GET %s', _shorten(url))
-    await loop.run_in_executor(None, download_loop)
+    if journal is None:
+        journal = DownloadJournal.start(part_filename + '.journal', url, response, segments)
+        with with_existing_dir(part_filename, 'wb') as outfile:
+            if journal.size:
+                # Preallocate, so that byte ranges can be written in any order.
+                outfile.truncate(journal.size)
+
+    pending = journal.pending()
+    log.debug('Downloading response of GET %s in %i segment(s)', _shorten(url), len(pending))
+    await _download_ranges(url, part_filename, journal, response,
+                           chunk_size=chunk_size, future=future, transport=transport,
+                           http_pool=http_pool)
     log.debug('Done downloading response of GET %s', _shorten(url))
 
+    _finish_download(url, filename, index, journal)
+
+
+def _finish_download(url, filename, index: download_index.DownloadIndex,
+                     journal: 'DownloadJournal'):
+    """Moves the completed '.part' file into place and stores its headers."""
+
+    os.replace(filename + '.part', filename)
+    journal.remove()
+
     # We're done downloading, now we have something cached we can use.
-    log.debug('Saving header cache to %s', header_store)
+    log.debug('Saving headers of %s to %s', filename, index.path)
     _downloaded_urls.add(url)
+    index.put(filename, url, journal.headers)
+
+
+class DownloadJournal:
+    """Progress of a '.part' file, stored next to it so that the download can be resumed.
+
+    The download consists of one or more byte ranges, which are downloaded
+    concurrently. For each range the journal records the next byte to
+    download. It is saved every JOURNAL_SAVE_INTERVAL downloaded bytes and
+    when the download stops, always after the bytes were written.
+    """
 
-    with with_existing_dir(header_store, 'w') as outfile:
-        json.dump({
+    def __init__(self, path: str, url: str, validator: str, headers: dict, ranges: list):
+        self.path = path
+        self.url = url
+        # ETag or Last-Modified for the If-Range header. Without one the
+        # download cannot be resumed safely, and the journal isn't saved.
+        self.validator = validator
+        # Headers to put in the header store once the download is complete.
+        self.headers = headers
+        # [[first byte, last byte or None for 'until the end', next byte], ...]
+        self.ranges = ranges
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+    @property
+    def size(self) -> typing.Optional[int]:
+        try:
+            return int(self.headers['Content-Length'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @classmethod
+    def start(cls, path: str, url: str, response: requests.Response,
+              segments: int = None) -> 'DownloadJournal':
+        """Creates a journal for downloading the (status 200) response."""
+
+        headers = {
             'ETag': str(response.headers.get('etag', '')),
             'Last-Modified': response.headers.get('Last-Modified'),
             'Content-Length': response.headers.get('Content-Length'),
-        }, outfile, sort_keys=True)
+        }
+        if not _is_identity_encoded(response):
+            # The body is decoded while downloading, so the Content-Length and any byte
+            # ranges refer to something else than what ends up in the file. Download it
+            # in one stream until its end, without resuming.
+            headers['Content-Length'] = None
+            validator = ''
+        elif response.headers.get('Accept-Ranges', '').lower() == 'bytes':
+            validator = _range_validator(response.headers)
+        else:
+            validator = ''
+
+        journal = cls(path, url, validator, headers, [])
+        ranges = _segment_ranges(response, segments)
+        if not ranges:
+            size = journal.size
+            ranges = [(0, None if size is None else size - 1)]
+        journal.ranges = [[start, end, start] for start, end in ranges]
+        return journal
+
+    @classmethod
+    def load(cls, path: str, url: str) -> typing.Optional['DownloadJournal']:
+        """Loads the journal, returning None if it doesn't exist or is for another URL."""
+
+        try:
+            with open(path, 'r') as infile:
+                doc = json.load(infile)
+            journal = cls(path, doc['url'], doc['validator'], doc['headers'],
+                          [list(byte_range) for byte_range in doc['ranges']])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            log.warning('Unable to load download journal %r, ignoring it: %s', path, ex)
+            return None
+
+        if journal.url != url or not journal.validator:
+            return None
+        return journal
+
+    def pending(self) -> list:
+        """Returns [(range index, next byte, last byte), ...] of the incomplete ranges."""
+        with self._lock:
+            return [(index, next_byte, end)
+                    for index, (start, end, next_byte) in enumerate(self.ranges)
+                    if end is None or next_byte <= end]
+
+    def completed(self) -> int:
+        """Returns the number of bytes downloaded."""
+        with self._lock:
+            return sum(next_byte - start for start, end, next_byte in self.ranges)
+
+    def advance(self, index: int, byte_count: int):
+        """Records that the range with the given index has byte_count more bytes on disk."""
+        with self._lock:
+            self.ranges[index][2] += byte_count
+            self._unsaved += byte_count
+            if self._unsaved >= JOURNAL_SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._unsaved = 0
+        if not self.validator:
+            return
+
+        doc = {
+            'url': self.url,
+            'validator': self.validator,
+            'headers': self.headers,
+            'ranges': self.ranges,
+        }
+        temp_path = self.path + '~'
+        with open(temp_path, 'w') as outfile:
+            json.dump(doc, outfile, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _RangeMismatchError(PillarError):
+    """Raised when the server doesn't return the requested byte range."""
+
+
+def _range_header(start: int, end: typing.Optional[int]) -> str:
+    return 'bytes=%i-%s' % (start, '' if end is None else end)
+
+
+def _is_expected_range(response: requests.Response, start: int, end: typing.Optional[int],
+                       size: typing.Optional[int]) -> bool:
+    """Returns whether the response contains exactly the requested byte range."""
+
+    if response.status_code != 206:
+        return False
+    content_range = response.headers.get('Content-Range', '')
+    if end is None:
+        return content_range.startswith('bytes %i-' % start)
+    return content_range == 'bytes %i-%i/%s' % (start, end, '*' if size is None else size)
+
+
+def _segment_ranges(response: requests.Response, segments: int = None) -> list:
+    """Returns the byte ranges to download the response body in.
+
+    :returns: list of (first byte, last byte) tuples, or an empty list when the
+        response should be downloaded in one stream.
+    """
+
+    if segments is None:
+        segments = DOWNLOAD_SEGMENTS
+    if segments < 2 or response.status_code != 200:
+        return []
+    if response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return []
+    if not _is_identity_encoded(response):
+        # Byte ranges would refer to the encoded body.
+        return []
+    try:
+        size = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return []
+    if size < SEGMENTED_DOWNLOAD_MIN_SIZE:
+        return []
+
+    segment_size = -(-size // segments)
+    return [(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)]
+
+
+def _is_identity_encoded(response: requests.Response) -> bool:
+    return response.headers.get('Content-Encoding', 'identity').lower() == 'identity'
+
+
+def _range_validator(headers) -> str:
+    """Returns the value for an If-Range header, to only get ranges of this version of the file."""
+
+    etag = headers.get('ETag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+    # Weak ETags cannot be used in If-Range.
+    return headers.get('Last-Modified') or ''
+
+
+async def _download_ranges(url, part_filename, journal: DownloadJournal,
+                           response: requests.Response,
+                           *, chunk_size: int, future: asyncio.Future = None,
+                           transport: async_http.Transport = None,
+                           http_pool: str = http_pools.TRANSFERS):
+    """Downloads the pending byte ranges of the journal concurrently into the '.part' file.
+
+    The first pending range is read from the already-started response, the
+    others are requested with a Range header. Each range runs on the executor
+    of the HTTP pool, or as task on the loop when a native transport is given.
+    """
+
+    loop = asyncio.get_event_loop()
+    abort = threading.Event()
+
+    def range_request_headers(start: int, end: typing.Optional[int]) -> dict:
+        headers = {'Range': _range_header(start, end)}
+        if journal.validator:
+            headers['If-Range'] = journal.validator
+        return headers
+
+    def check_range_response(range_response, headers: dict, start: int, end: typing.Optional[int]):
+        range_response.raise_for_status()
+        if not _is_expected_range(range_response, start, end, journal.size):
+            range_response.close()
+            raise _RangeMismatchError('Server did not return %s of %s' %
+                                      (headers['Range'], _shorten(url)))
+
+    def download_range(outfile, index: int, start: int, end: typing.Optional[int],
+                       range_response=None):
+        try:
+            if range_response is None:
+                headers = range_request_headers(start, end)
+                range_response = http_pools.session(http_pool).get(url, headers=headers,
+                                                                   stream=True, verify=True)
+                check_range_response(range_response, headers, start, end)
+
+            def advance(byte_count):
+                journal.advance(index, byte_count)
+
+            with closing(range_response):
+                if _have_pwrite:
+                    _write_segment_pwrite(outfile.fileno(), range_response, start, end,
+                                          chunk_size, abort, future, advance)
+                else:
+                    with open(part_filename, 'r+b') as segment_file:
+                        segment_file.seek(start)
+                        _write_segment_sequential(segment_file, range_response, start, end,
+                                                  chunk_size, abort, future, advance)
+        except BaseException:
+            abort.set()
+            raise
+
+    async def download_range_native(outfile, index: int, start: int, end: typing.Optional[int],
+                                    range_response=None):
+        try:
+            if range_response is None:
+                headers = range_request_headers(start, end)
+                range_response = await transport.request('GET', url, headers=headers,
+                                                         stream=True)
+                check_range_response(range_response, headers, start, end)
+
+            # The loop runs one segment at a time, so they can share the file object.
+            with closing(range_response):
+                offset = start
+                async for block in range_response.iter_content(chunk_size):
+                    if abort.is_set() or is_cancelled(future):
+                        raise asyncio.CancelledError('Downloading was cancelled')
+                    if end is not None:
+                        block = block[:end + 1 - offset]
+                    _write_block(outfile, block, offset)
+                    journal.advance(index, len(block))
+                    offset += len(block)
+                    if end is not None and offset > end:
+                        return
+                if end is not None:
+                    raise PillarError('Download ended at byte %i, expected %i' %
+                                      (offset, end + 1))
+        except BaseException:
+            abort.set()
+            raise
+
+    pending = journal.pending()
+    if not pending:
+        response.close()
+        return
+
+    with open(part_filename, 'r+b') as outfile:
+        if transport is not None:
+            tasks = [asyncio.ensure_future(
+                download_range_native(outfile, index, start, end,
+                                      response if task_index == 0 else None))
+                for task_index, (index, start, end) in enumerate(pending)]
+        else:
+            executor = http_pools.executor(http_pool)
+            tasks = [loop.run_in_executor(executor, download_range, outfile, index, start, end,
+                                          response if task_index == 0 else None)
+                     for task_index, (index, start, end) in enumerate(pending)]
+        try:
+            await asyncio.wait(tasks)
+        except asyncio.CancelledError:
+            # Don't close the file while the segments are still writing to it.
+            abort.set()
+            if transport is not None:
+                for task in tasks:
+                    task.cancel()
+            await asyncio.wait(tasks)
+            errors = [asyncio.CancelledError('Downloading was cancelled')]
+        else:
+            # Segments on the loop that stopped because of the abort are cancelled tasks.
+            errors = [asyncio.CancelledError('Downloading was cancelled') if task.cancelled()
+                      else task.exception()
+                      for task in tasks
+                      if task.cancelled() or task.exception() is not None]
+
+    if not errors:
+        return
+
+    if any(isinstance(ex, _RangeMismatchError) for ex in errors):
+        # The file changed on the server, so what we have is useless.
+        journal.remove()
+        os.unlink(part_filename)
+    else:
+        journal.save()
+
+    # Report the error that caused the other segments to abort.
+    errors.sort(key=lambda ex: isinstance(ex, asyncio.CancelledError))
+    raise errors[0]
+
+
+def _iter_segment_blocks(response: requests.Response, start: int, end: typing.Optional[int],
+                         chunk_size: int, abort: threading.Event, future: asyncio.Future):
+    """Yields (offset, data) for the bytes start to end (inclusive) of the response body.
+
+    When end is None, everything until the end of the body is yielded.
+    """
+
+    offset = start
+    for block in response.iter_content(chunk_size=chunk_size):
+        if abort.is_set() or is_cancelled(future):
+            raise asyncio.CancelledError('Downloading was cancelled')
+        if end is not None:
+            block = block[:end + 1 - offset]
+        yield offset, block
+        offset += len(block)
+        if end is not None and offset > end:
+            return
+    if end is not None:
+        raise PillarError('Download ended at byte %i, expected %i' % (offset, end + 1))
+
+
+def _write_segment_pwrite(fd: int, response: requests.Response, start: int, end: int,
+                          chunk_size: int, abort: threading.Event, future: asyncio.Future,
+                          advance: typing.Callable[[int], None]):
+    for offset, block in _iter_segment_blocks(response, start, end, chunk_size, abort, future):
+        view = memoryview(block)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+            advance(written)
+
+
+def _write_block(outfile, block: bytes, offset: int):
+    if _have_pwrite:
+        view = memoryview(block)
+        while view:
+            written = os.pwrite(outfile.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        outfile.seek(offset)
+        outfile.write(block)
+        # Make sure the journal never gets ahead of the file.
+        outfile.flush()
+
+
+def _write_segment_sequential(outfile, response: requests.Response, start: int, end: int,
+                              chunk_size: int, abort: threading.Event, future: asyncio.Future,
+                              advance: typing.Callable[[int], None]):
+    for _, block in _iter_segment_blocks(response, start, end, chunk_size, abort, future):
+        outfile.write(block)
+        # Make sure the journal never gets ahead of the file.
+        outfile.flush()
+        advance(len(block))
 
 
 async def fetch_thumbnail_info(file: pillarsdk.File, directory: str, desired_size: str):
@@ -526,7 +1419,10 @@ async def fetch_thumbnail_info(file: pillarsdk.File, directory: str, desired_siz
         finished.
     """
 
-    thumb_link = await pillar_call(file.thumbnail, desired_size)
+    thumb_link = thumbnail_link_from_variations(file, desired_size)
+    if thumb_link is None:
+        # Older files don't have variations; File.thumbnail() knows how to handle those.
+        thumb_link = await pillar_call(file.thumbnail, desired_size)
 
     if thumb_link is None:
         raise ValueError("File {} has no thumbnail of size {}"
@@ -539,11 +1435,114 @@ async def fetch_thumbnail_info(file: pillarsdk.File, directory: str, desired_siz
     return thumb_link, thumb_path
 
 
+def thumbnail_link_from_variations(file: pillarsdk.File, desired_size: str) -> typing.Optional[str]:
+    """Returns the link of the thumbnail variation of the file, or None if it has none."""
+
+    for variation in file.variations or ():
+        if variation.size == desired_size and variation.link:
+            return variation.link
+    return None
+
+
+async def fetch_file_docs(file_uuids: typing.Iterable[str], projection: dict = None) \
+        -> typing.Dict[str, pillarsdk.File]:
+    """Fetches File documents with one query per FILE_QUERY_BATCH_SIZE files.
+
+    :param projection: the fields to fetch, defaults to THUMBNAIL_FILE_PROJECTION.
+    :returns: {file UUID: pillarsdk.File}; files that can't be found are omitted.
+    """
+
+    if projection is None:
+        projection = THUMBNAIL_FILE_PROJECTION
+    return await fetch_docs_by_id(pillarsdk.File, file_uuids, {'projection': projection})
+
+
+async def fetch_file_docs_cached(file_uuids: typing.Iterable[str], *,
+                                 doc_cache: node_cache.DocumentCache = None) \
+        -> typing.Dict[str, pillarsdk.File]:
+    """Like fetch_file_docs(), but uses File documents from the document cache when possible.
+
+    Only cached documents younger than NODE_CACHE_MAX_AGE are used, as the
+    links in them expire.
+    """
+
+    if doc_cache is None:
+        doc_cache = node_cache.default_cache()
+
+    uuids = set(file_uuids)
+    file_docs = await _run_in_executor(doc_cache.get, pillarsdk.File, uuids, NODE_CACHE_MAX_AGE)
+    missing = uuids.difference(file_docs)
+    if missing:
+        fetched = await fetch_file_docs(missing)
+        await _run_in_executor(doc_cache.put, pillarsdk.File, fetched.values())
+        file_docs.update(fetched)
+    return file_docs
+
+
+async def fetch_docs_by_id(resource_class, doc_uuids: typing.Iterable[str],
+                           params: dict = None) -> typing.Dict[str, pillarsdk.Resource]:
+    """Fetches documents with one query per FILE_QUERY_BATCH_SIZE documents.
+
+    :param resource_class: pillarsdk.File, pillarsdk.Node, etc.
+    :param params: extra query parameters, like 'projection' and 'embed'.
+    :returns: {document UUID: document}; documents that can't be found are omitted.
+    """
+
+    uuids = sorted(set(doc_uuids))
+
+    async def fetch_batch(batch: list) -> list:
+        items = []
+        page = 1
+        while True:
+            query = copy.deepcopy(params) if params else {}
+            # The pillarsdk adds its own fields to the given projection.
+            query.update({
+                'where': {'_id': {'$in': batch}},
+                'max_results': len(batch),
+                'page': page,
+            })
+            result = await pillar_call(resource_class.all, query)
+            page_items = result['_items']
+            items.extend(page_items)
+
+            # The server may cap max_results, so there can be more pages.
+            try:
+                total = result['_meta']['total']
+            except (KeyError, TypeError):
+                break
+            if not page_items or len(items) >= total:
+                break
+            page += 1
+        return items
+
+    batches = [uuids[start:start + FILE_QUERY_BATCH_SIZE]
+               for start in range(0, len(uuids), FILE_QUERY_BATCH_SIZE)]
+    results = await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+    return {doc['_id']: doc for items in results for doc in items}
+
+
+def texture_picture_uuid(texture_node) -> typing.Optional[str]:
+    """Returns the UUID of the File to use as thumbnail of the texture node."""
+
+    pic_uuid = texture_node.picture
+    if pic_uuid:
+        return pic_uuid
+
+    # Fall back to the first texture file, if it exists.
+    log.debug('Node %r does not have a picture, falling back to first file.',
+              texture_node['_id'])
+    files = texture_node.properties and texture_node.properties.files
+    if not files:
+        return None
+    return files[0].file or None
+
+
 async def fetch_texture_thumbs(parent_node_uuid: str, desired_size: str,
                                thumbnail_directory: str,
                                *,
                                thumbnail_loading: callable,
                                thumbnail_loaded: callable,
+                               revalidated: callable = None,
                                future: asyncio.Future = None):
     """Generator, fetches all texture thumbnails in a certain parent node.
 
@@ -555,29 +1554,56 @@ async def fetch_texture_thumbs(parent_node_uuid: str, desired_size: str,
         show a "downloading" indicator.
     @param thumbnail_loaded: callback function that takes (pillarsdk.Node, pillarsdk.File object,
         thumbnail path) parameters, which is called for every thumbnail after it's been downloaded.
+    @param revalidated: callback function without parameters, which is called when the texture
+        nodes were shown from the document cache and then turned out to have changed on the server;
+        see iter_node_pages_cached().
     @param future: Future that's inspected; if it is not None and cancelled, texture downloading
         is aborted.
     """
 
-    # Download all texture nodes in parallel.
-    log.debug('Getting child nodes of node %r', parent_node_uuid)
-    texture_nodes = await get_nodes(parent_node_uuid=parent_node_uuid,
-                                    node_type=TEXTURE_NODE_TYPES)
-
-    if is_cancelled(future):
-        log.warning('fetch_texture_thumbs: Texture downloading cancelled')
-        return
+    # Look up what we downloaded before with a single query, instead of one per thumbnail.
+    loop = asyncio.get_event_loop()
+    index = download_index.default_index()
+    await loop.run_in_executor(None, index.migrate_directory, thumbnail_directory)
+    records = await loop.run_in_executor(None, index.get_directory, thumbnail_directory)
 
-    coros = (download_texture_thumbnail(texture_node, desired_size,
-                                        thumbnail_directory,
-                                        thumbnail_loading=thumbnail_loading,
-                                        thumbnail_loaded=thumbnail_loaded,
-                                        future=future)
-             for texture_node in texture_nodes)
+    # Download the thumbnails of each page of texture nodes while the next page is fetched.
+    log.debug('Getting child nodes of node %r', parent_node_uuid)
+    downloads = []
+    doc_cache = node_cache.default_cache()
+    pages = iter_node_pages_cached(parent_node_uuid=parent_node_uuid, node_type=TEXTURE_NODE_TYPES,
+                                   revalidated=revalidated, doc_cache=doc_cache)
+    try:
+        async for texture_nodes in pages:
+            if is_cancelled(future):
+                log.warning('fetch_texture_thumbs: Texture downloading cancelled')
+                break
+
+            # Fetch the File documents of the page at once, instead of one per texture.
+            pic_uuids = (texture_picture_uuid(texture_node) for texture_node in texture_nodes
+                         if texture_node['node_type'] in TEXTURE_NODE_TYPES)
+            file_docs = await fetch_file_docs_cached((uuid for uuid in pic_uuids if uuid),
+                                                     doc_cache=doc_cache)
+
+            downloads.extend(
+                asyncio.ensure_future(download_texture_thumbnail(
+                    texture_node, desired_size, thumbnail_directory,
+                    thumbnail_loading=thumbnail_loading,
+                    thumbnail_loaded=thumbnail_loaded,
+                    index=index,
+                    records=records,
+                    file_docs=file_docs,
+                    future=future))
+                for texture_node in texture_nodes)
+    except BaseException:
+        for download in downloads:
+            download.cancel()
+        raise
+    finally:
+        await pages.aclose()
 
-    # raises any exception from failed handle_texture_node() calls.
-    loop = asyncio.get_event_loop()
-    await asyncio.gather(*coros, loop=loop)
+    # raises any exception from failed download_texture_thumbnail() calls.
+    await asyncio.gather(*downloads)
 
     log.info('fetch_texture_thumbs: Done downloading texture thumbnails')
 
@@ -587,7 +1613,19 @@ async def download_texture_thumbnail(texture_node, desired_size: str,
                                      *,
                                      thumbnail_loading: callable,
                                      thumbnail_loaded: callable,
+                                     index: download_index.DownloadIndex = None,
+                                     records: dict = None,
+                                     file_docs: typing.Dict[str, pillarsdk.File] = None,
                                      future: asyncio.Future = None):
+    """Downloads the thumbnail of a texture node.
+
+    :param index: the download index, defaults to download_index.default_index().
+    :param records: {path: DownloadRecord} of the thumbnail directory, when the
+        caller already looked those up; see DownloadIndex.get_directory().
+    :param file_docs: {file UUID: File} with the File documents of the thumbnails,
+        when the caller already fetched those; see fetch_file_docs().
+    """
+
     # Skip non-texture nodes, as we can't thumbnail them anyway.
     if texture_node['node_type'] not in TEXTURE_NODE_TYPES:
         return
@@ -600,26 +1638,19 @@ async def download_texture_thumbnail(texture_node, desired_size: str,
     loop = asyncio.get_event_loop()
 
     # Find out which file to use for the thumbnail picture.
-    pic_uuid = texture_node.picture
+    pic_uuid = texture_picture_uuid(texture_node)
     if not pic_uuid:
-        # Fall back to the first texture file, if it exists.
-        log.debug('Node %r does not have a picture, falling back to first file.',
-                  texture_node['_id'])
-        files = texture_node.properties and texture_node.properties.files
-        if not files:
-            log.info('Node %r does not have a picture nor files, skipping.', texture_node['_id'])
-            return
-        pic_uuid = files[0].file
-        if not pic_uuid:
-            log.info('Node %r does not have a picture nor files, skipping.', texture_node['_id'])
-            return
+        log.info('Node %r does not have a picture nor files, skipping.', texture_node['_id'])
+        return
 
     # Load the File that belongs to this texture node's picture.
     loop.call_soon_threadsafe(thumbnail_loading, texture_node, texture_node)
-    file_desc = await pillar_call(pillarsdk.File.find, pic_uuid, params={
-        'projection': {'filename': 1, 'variations': 1, 'width': 1, 'height': 1,
-                       'length': 1},
-    })
+    if file_docs is not None:
+        file_desc = file_docs.get(pic_uuid)
+    else:
+        file_desc = await pillar_call(pillarsdk.File.find, pic_uuid, params={
+            'projection': dict(THUMBNAIL_FILE_PROJECTION),
+        })
 
     if file_desc is None:
         log.warning('Unable to find file for texture node %s', pic_uuid)
@@ -639,11 +1670,15 @@ async def download_texture_thumbnail(texture_node, desired_size: str,
                       file_desc['_id'])
             return
 
-        # Cached headers are stored next to thumbnails in sidecar files.
-        header_store = '%s.headers' % thumb_path
+        if records is None:
+            # Cached headers used to be stored next to thumbnails in sidecar files.
+            download_kwargs = {'header_store': '%s.headers' % thumb_path}
+        else:
+            download_kwargs = {'record': records.get(thumb_path)}
 
         try:
-            await download_to_file(thumb_url, thumb_path, header_store=header_store, future=future)
+            await download_to_file(thumb_url, thumb_path, index=index, future=future,
+                                   http_pool=http_pools.THUMBNAILS, **download_kwargs)
         except requests.exceptions.HTTPError as ex:
             log.error('Unable to download %s: %s', thumb_url, ex)
             thumb_path = 'ERROR'
@@ -733,7 +1768,7 @@ async def download_file_by_uuid(file_uuid,
 
     # Find the File document.
     file_desc = await pillar_call(pillarsdk.File.find, file_uuid, params={
-        'projection': {'link': 1, 'filename': 1, 'length': 1},
+        'projection': {'link': 1, 'filename': 1, 'length': 1, 'md5': 1},
     })
 
     # Save the file document to disk
@@ -755,11 +1790,20 @@ async def download_file_by_uuid(file_uuid,
     if file_loading is not None:
         loop.call_soon_threadsafe(file_loading, file_path, file_desc, map_type)
 
-    # Cached headers are stored in the project space
-    header_store = os.path.join(metadata_directory, 'files',
-                                sanitize_filename('%s.headers' % file_uuid))
+    # The file is downloaded into the blob store, and linked into the target
+    # directory from there, so that it's stored only once.
+    store = blob_store.default_store()
+    blob_key = blob_store.blob_key(file_uuid, file_desc.md5)
+    await download_to_file(file_url, store.blob_path(blob_key), index=store.index,
+                           future=future)
+    if is_cancelled(future):
+        log.debug('download_file_by_uuid(%r) cancelled.', file_uuid)
+        return
 
-    await download_to_file(file_url, file_path, header_store=header_store, future=future)
+    link_mode = await loop.run_in_executor(None, store.link_out, blob_key, file_path)
+    log.debug('Placed %s at %s (%s)', blob_key, file_path, link_mode or 'already there')
+    eviction = loop.run_in_executor(None, store.maybe_evict)
+    eviction.add_done_callback(functools.partial(_log_eviction_failure, store.directory))
 
     if file_loaded is not None:
         loop.call_soon_threadsafe(file_loaded, file_path, file_desc, map_type)
@@ -767,6 +1811,16 @@ async def download_file_by_uuid(file_uuid,
         await file_loaded_sync(file_path, file_desc, map_type)
 
 
+def _log_eviction_failure(directory: str, future: asyncio.Future):
+    """Logs the exception of a background eviction, as nothing awaits it."""
+
+    if future.cancelled():
+        return
+    ex = future.exception()
+    if ex is not None:
+        log.warning('Unable to evict files from %s: %s', directory, ex)
+
+
 async def download_texture(texture_node,
                            target_directory: str,
                            metadata_directory: str,
@@ -812,9 +1866,8 @@ async def upload_file(project_id: str, file_path: pathlib.Path, *,
         auth_token = blender_id_subclient()['token']
 
         with file_path.open(mode='rb') as infile:
-            return uncached_session.post(url,
-                                         files={'file': infile},
-                                         auth=(auth_token, SUBCLIENT_ID))
+            return http_pools.session(http_pools.TRANSFERS).post(
+                url, files={'file': infile}, auth=(auth_token, SUBCLIENT_ID))
 
     # Check for cancellation even before we start our POST request
     if is_cancelled(future):
@@ -822,7 +1875,15 @@ async def upload_file(project_id: str, file_path: pathlib.Path, *,
         raise asyncio.CancelledError('Uploading was cancelled')
 
     log.debug('Performing POST %s', _shorten(url))
-    response = await loop.run_in_executor(None, upload)
+    transport = _native_transport()
+    if transport is not None:
+        content_type, length, body_iter = async_http.file_upload_body('file', file_path)
+        response = await transport.request(
+            'POST', url, headers={'Content-Type': content_type},
+            auth=(blender_id_subclient()['token'], SUBCLIENT_ID),
+            body_length=length, body_iter=body_iter)
+    else:
+        response = await loop.run_in_executor(http_pools.executor(http_pools.TRANSFERS), upload)
     log.debug('Status %i from POST %s', response.status_code, _shorten(url))
     response.raise_for_status()
 
@@ -957,6 +2018,12 @@ async def find_or_create_node(where: dict,
         log.error('Blender Cloud addon: unable to create node on the Cloud.')
         raise PillarError('Unable to create node on the Cloud')
 
+    # Cached listings of its siblings no longer are complete.
+    parent = node_props.get('parent') or node_props.get('project')
+    if isinstance(parent, str):
+        doc_cache = node_cache.default_cache()
+        await _run_in_executor(doc_cache.invalidate_parent, parent)
+
     return created_node, True
 
 
@@ -514,9 +514,8 @@ class PILLAR_OT_sync(pillar.PillarOperatorMixin,
         log.debug('Overriding values: %s', remembered)
 
         # Rewrite the userprefs.blend file to override the options.
-        with blendfile.open_blend(file_path, 'rb+') as blend:
-            prefs = next(block for block in blend.blocks
-                         if block.code == b'USER')
+        with blendfile.open_blend(file_path, 'rb+', lazy=True) as blend:
+            prefs = next(blend.iter_blocks_from_code(b'USER'))
 
             for key, value in remembered.items():
                 self.log.debug('prefs[%r] = %r' % (key, prefs[key]))
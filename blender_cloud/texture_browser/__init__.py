@@ -17,6 +17,7 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import asyncio
+import functools
 import logging
 import os
 import threading
@@ -196,8 +197,22 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         if db_user is None:
             raise pillar.UserNotLoggedInError()
 
+        # Keep the thumbnails within their size budget, without holding up the browser.
+        eviction = asyncio.get_event_loop().run_in_executor(None, cache.evict_thumbnails,
+                                                            self.thumbnails_cache)
+        eviction.add_done_callback(self._thumbnail_eviction_done)
+
         await self.async_download_previews()
 
+    def _thumbnail_eviction_done(self, future: asyncio.Future):
+        """Logs the exception of the thumbnail eviction, as nothing awaits it."""
+
+        if future.cancelled():
+            return
+        ex = future.exception()
+        if ex is not None:
+            self.log.warning('Unable to evict thumbnails from %s: %s', self.thumbnails_cache, ex)
+
     def _show_subscribe_screen(self, *, can_renew: bool):
         """Shows the "You need to subscribe" screen."""
 
@@ -321,22 +336,28 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         project_uuid = self.current_path.project_uuid
         node_uuid = self.current_path.node_uuid
 
+        # Listings come from the document cache when possible, and are then
+        # revalidated in the background; when they changed, we browse again.
+        # Otherwise the nodes and projects are fetched page by page; the menu
+        # items of each page are shown while the next page is being fetched.
+        revalidated = functools.partial(self._listing_revalidated, self.current_path)
         if node_uuid:
             # Query for sub-nodes of this node.
             self.log.debug('Getting subnodes for parent node %r', node_uuid)
-            children = await pillar.get_nodes(parent_node_uuid=node_uuid,
-                                              node_type={'group_texture', 'group_hdri'})
+            children = pillar.iter_nodes_cached(parent_node_uuid=node_uuid,
+                                                node_type={'group_texture', 'group_hdri'},
+                                                revalidated=revalidated)
         elif project_uuid:
             # Query for top-level nodes.
             self.log.debug('Getting subnodes for project node %r', project_uuid)
-            children = await pillar.get_nodes(project_uuid=project_uuid,
-                                              parent_node_uuid='',
-                                              node_type={'group_texture', 'group_hdri'})
+            children = pillar.iter_nodes_cached(project_uuid=project_uuid,
+                                                parent_node_uuid='',
+                                                node_type={'group_texture', 'group_hdri'},
+                                                revalidated=revalidated)
         else:
             # Query for projects
             self.log.debug('No node UUID and no project UUID, listing available projects')
-            children = await pillar.get_texture_projects()
-            for proj_dict in children:
+            async for proj_dict in pillar.iter_texture_projects_cached(revalidated=revalidated):
                 self.add_menu_item(nodes.ProjectNode(proj_dict), None, 'FOLDER', proj_dict['name'])
             return
 
@@ -345,7 +366,7 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
 
         # Download all child nodes
         self.log.debug('Iterating over child nodes of %r', self.current_path)
-        for child in children:
+        async for child in children:
             # print('  - %(_id)s = %(name)s' % child)
             if child['node_type'] not in menu_item_mod.MenuItem.SUPPORTED_NODE_TYPES:
                 self.log.debug('Skipping node of type %r', child['node_type'])
@@ -372,8 +393,22 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         await pillar.fetch_texture_thumbs(node_uuid, 's', directory,
                                           thumbnail_loading=thumbnail_loading,
                                           thumbnail_loaded=thumbnail_loaded,
+                                          revalidated=revalidated,
                                           future=self.signalling_future)
 
+    def _listing_revalidated(self, path: pillar.CloudPath):
+        """Shows the listing again after it changed on the server, if we're still there."""
+
+        try:
+            if self._state != 'BROWSING' or self.current_path != path:
+                return
+        except ReferenceError:
+            # The operator has finished, and Blender freed it.
+            return
+
+        self.log.debug('Listing of %r changed on the server, browsing again', path)
+        self.browse_assets()
+
     def browse_assets(self):
         self.log.debug('Browsing assets at %r', self.current_path)
         bpy.context.window_manager.last_blender_cloud_location = str(self.current_path)
@@ -17,9 +17,14 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import json
+import logging
+import os
 import pathlib
+import sqlite3
 import typing
 
+log = logging.getLogger(__name__)
+
 
 def sizeof_fmt(num: int, suffix='B') -> str:
     """Returns a human-readable size.
@@ -35,6 +40,48 @@ def sizeof_fmt(num: int, suffix='B') -> str:
     return '%.1f Yi%s' % (num, suffix)
 
 
+def open_index(path: str, schema_version: int,
+               schema: typing.Iterable[str]) -> sqlite3.Connection:
+    """Opens the SQLite database, creating its tables if needed.
+
+    The database is in WAL mode, so that several Blender processes can use it
+    at the same time, and in autocommit mode; use 'BEGIN' for transactions.
+    When its 'user_version' isn't schema_version, all its tables are dropped
+    and created again with the statements in 'schema'.
+
+    The connection may be used from other threads; protect it with a lock.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == schema_version:
+        return conn
+
+    log.debug('Creating database %s, schema version %i', path, schema_version)
+    with conn:
+        conn.execute('BEGIN')
+        tables = [row[0] for row in
+                  conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        for table in tables:
+            conn.execute('DROP TABLE IF EXISTS "%s"' % table)
+        for statement in schema:
+            conn.execute(statement)
+        conn.execute('PRAGMA user_version=%i' % schema_version)
+    return conn
+
+
+def remove_file(path: str):
+    """Removes the file, if it exists."""
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
 def find_in_path(path: pathlib.Path, filename: str) -> typing.Optional[pathlib.Path]:
     """Performs a breadth-first search for the filename.
 
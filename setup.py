@@ -37,7 +37,7 @@ sys.dont_write_bytecode = True
 
 # Download wheels from pypi. The specific versions are taken from requirements.txt
 wheels = [
-    'lockfile', 'pillarsdk', 'blender-asset-tracer',
+    'pillarsdk', 'blender-asset-tracer',
 ]
 
 
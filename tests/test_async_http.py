@@ -0,0 +1,172 @@
+"""Unittests for blender_cloud.async_http."""
+
+import asyncio
+import http.server
+import json
+import pathlib
+import tempfile
+import threading
+import unittest
+
+import pillarsdk
+import pillarsdk.exceptions
+import requests.exceptions
+
+from blender_cloud import async_http
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.requests.append((self.command, self.path, dict(self.headers)))
+
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in (b'hello ', b'chunked ', b'world'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        elif self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/api/nodes/5a1b2c3d')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/api/nodes/5a1b2c3d':
+            self.send_body(200, json.dumps({'_id': '5a1b2c3d', 'name': 'Bricks'}).encode())
+        else:
+            self.send_body(404, b'{"_error": "not found"}')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append((self.command, self.path, dict(self.headers), body))
+        self.send_body(201, json.dumps({'file_id': 'f1le', 'received': len(body)}).encode())
+
+
+class AbstractHTTPTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        handler = type('Handler', (StubHandler,), {'requests': self.requests})
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:%i' % self.server.server_port
+        self.transport = async_http.Transport()
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+
+class TransportTest(AbstractHTTPTest):
+    def test_keep_alive(self):
+        async def get_twice():
+            first = await self.transport.request('GET', self.base_url + '/api/nodes/5a1b2c3d')
+            second = await self.transport.request('GET', self.base_url + '/api/nodes/5a1b2c3d')
+            return first, second
+
+        first, second = self.run_async(get_twice())
+        self.assertEqual({'_id': '5a1b2c3d', 'name': 'Bricks'}, first.json())
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(1, self.transport.connections_opened)
+        self.assertEqual(2, self.transport.requests)
+
+    def test_chunked(self):
+        async def stream():
+            response = await self.transport.request('GET', self.base_url + '/chunked',
+                                                    stream=True)
+            return [block async for block in response.iter_content(4)]
+
+        blocks = self.run_async(stream())
+        self.assertEqual(b'hello chunked world', b''.join(blocks))
+        self.assertTrue(all(len(block) <= 4 for block in blocks))
+        self.assertEqual(1, self.transport.stats()['idle_connections'])
+
+    def test_redirect(self):
+        response = self.run_async(self.transport.request('GET', self.base_url + '/redirect'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.base_url + '/api/nodes/5a1b2c3d', response.url)
+        self.assertEqual(['/redirect', '/api/nodes/5a1b2c3d'],
+                         [path for _, path, _ in self.requests])
+
+    def test_errors(self):
+        response = self.run_async(self.transport.request('GET', self.base_url + '/missing'))
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            response.raise_for_status()
+        self.assertIs(response, context.exception.response)
+
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.run_async(self.transport.request('GET', self.base_url + '/missing'))
+
+    def test_upload(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = pathlib.Path(tmpdir) / 'texture.png'
+            path.write_bytes(b'\x89PNG' * 1000)
+            content_type, length, body_iter = async_http.file_upload_body('file', path,
+                                                                          block_size=1000)
+            response = self.run_async(self.transport.request(
+                'POST', self.base_url + '/storage/stream/p', auth=('token', 'PILLAR'),
+                headers={'Content-Type': content_type},
+                body_length=length, body_iter=body_iter))
+
+        self.assertEqual({'file_id': 'f1le', 'received': length}, response.json())
+        _, _, headers, body = self.requests[0]
+        self.assertEqual('Basic dG9rZW46UElMTEFS', headers['Authorization'])
+        self.assertIn(b'name="file"; filename="texture.png"\r\n\r\n\x89PNG', body)
+        self.assertTrue(body.endswith(b'\x89PNG\r\n--%s--\r\n' %
+                                      content_type.split('boundary=')[1].encode()))
+
+
+class ReplayTest(AbstractHTTPTest):
+    def setUp(self):
+        super().setUp()
+        self.api = pillarsdk.Api(endpoint=self.base_url + '/api/', username='user',
+                                 password='PILLAR', token='token')
+
+    def call(self, pillar_func, *args, **kwargs):
+        def replayed(session):
+            self.api.requests_session = session
+            return pillar_func(*args, api=self.api, **kwargs)
+
+        return self.run_async(async_http.run_replayed(self.transport, replayed))
+
+    def test_find(self):
+        node = self.call(pillarsdk.Node.find, '5a1b2c3d')
+        self.assertEqual('Bricks', node.name)
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual('application/json', self.requests[0][2]['Accept'])
+
+    def test_not_found(self):
+        with self.assertRaises(pillarsdk.exceptions.ResourceNotFound) as context:
+            self.call(pillarsdk.Node.find, 'missing')
+        self.assertIn('Response status: 404', str(context.exception))
+
+    def test_unsupported(self):
+        def with_files(session):
+            return session.request('POST', self.base_url, files={'file': b''})
+
+        with self.assertRaises(async_http.NotSupportedError):
+            self.run_async(async_http.run_replayed(self.transport, with_files))
+        self.assertEqual([], self.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
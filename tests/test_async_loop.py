@@ -0,0 +1,144 @@
+"""Unittests for the scheduling of blender_cloud.async_loop."""
+
+import asyncio
+import sys
+import time
+import types
+import unittest
+import unittest.mock
+
+# The module defines Blender operators; the scheduling functions don't need Blender.
+_bpy_stub = types.SimpleNamespace(types=types.SimpleNamespace(Operator=object))
+with unittest.mock.patch.dict(sys.modules, {'bpy': _bpy_stub}):
+    from blender_cloud import async_loop
+
+
+class AbstractLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+
+class NextKickIntervalTest(AbstractLoopTest):
+    def test_idle(self):
+        self.assertEqual((0, None), async_loop.loop_state(self.loop))
+        self.assertEqual(0.05, async_loop.next_kick_interval(self.loop, 0.05))
+        self.assertEqual(async_loop.MIN_KICK_INTERVAL,
+                         async_loop.next_kick_interval(self.loop, 0))
+
+    def test_due_timer(self):
+        self.loop.call_later(0.02, lambda: None)
+        ready_count, next_timer = async_loop.loop_state(self.loop)
+        self.assertEqual(0, ready_count)
+        self.assertAlmostEqual(0.02, next_timer, places=2)
+
+        # The timer is due before the polling interval ends.
+        self.assertAlmostEqual(0.02, async_loop.next_kick_interval(self.loop, 0.05), places=2)
+        self.assertEqual(0.01, async_loop.next_kick_interval(self.loop, 0.01))
+
+        # Overdue timers still get the minimum interval.
+        with unittest.mock.patch.object(self.loop, 'time', return_value=self.loop.time() + 1):
+            self.assertEqual(async_loop.MIN_KICK_INTERVAL,
+                             async_loop.next_kick_interval(self.loop, 0.05))
+
+    def test_ready_callbacks(self):
+        self.loop.call_later(0.02, lambda: None)
+        self.loop.call_soon(lambda: None)
+        self.assertEqual(1, async_loop.loop_state(self.loop)[0])
+        self.assertEqual(async_loop.MIN_KICK_INTERVAL,
+                         async_loop.next_kick_interval(self.loop, 0.05))
+
+    def test_other_loops(self):
+        other_loop = unittest.mock.Mock(spec=asyncio.AbstractEventLoop)
+        self.assertEqual((0, None), async_loop.loop_state(other_loop))
+        self.assertEqual(0.05, async_loop.next_kick_interval(other_loop, 0.05))
+
+
+class KickAsyncLoopTest(AbstractLoopTest):
+    def setUp(self):
+        super().setUp()
+        patcher = unittest.mock.patch.object(async_loop, 'kick_stats', async_loop.KickStats())
+        self.kick_stats = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_order_across_batches(self):
+        called = []
+
+        def callback(index):
+            called.append(index)
+            if index < 3:
+                self.loop.call_soon(called.append, ('late', index))
+
+        count = 3 * async_loop.KICK_BATCH_SIZE + 5
+        for index in range(count):
+            self.loop.call_soon(callback, index)
+
+        kicks = 0
+        while async_loop.loop_state(self.loop)[0]:
+            async_loop.kick_async_loop(time_budget=0)
+            kicks += 1
+
+        expected = list(range(count)) + [('late', index) for index in range(3)]
+        self.assertEqual(expected, called)
+        self.assertEqual(4, kicks)
+        self.assertEqual(4, self.kick_stats.kicks)
+
+    def test_time_budget(self):
+        called = []
+
+        def slow_callback(index):
+            called.append(index)
+            time.sleep(0.001)
+
+        count = 2 * async_loop.KICK_BATCH_SIZE
+        for index in range(count):
+            self.loop.call_soon(slow_callback, index)
+
+        # Time is only checked between batches, so the first batch always runs.
+        async_loop.kick_async_loop(time_budget=0.001)
+        self.assertEqual(list(range(async_loop.KICK_BATCH_SIZE)), called)
+        self.assertEqual(async_loop.KICK_BATCH_SIZE, async_loop.loop_state(self.loop)[0])
+        self.assertEqual(1, self.kick_stats.over_budget)
+
+        # With enough time, the next kick runs all remaining batches.
+        self.loop.call_soon(called.append, 'last')
+        async_loop.kick_async_loop(time_budget=10)
+        self.assertEqual(list(range(count)) + ['last'], called)
+        self.assertEqual(0, async_loop.loop_state(self.loop)[0])
+        self.assertEqual(1, self.kick_stats.over_budget)
+        self.assertEqual(2, self.kick_stats.kicks)
+
+
+class KickStatsTest(unittest.TestCase):
+    @unittest.mock.patch('time.perf_counter')
+    def test_window(self, mock_perf_counter):
+        stats = async_loop.KickStats(window=1.0)
+
+        mock_perf_counter.return_value = 10.0
+        stats.record(0.002, over_budget=False)
+        mock_perf_counter.return_value = 10.5
+        stats.record(0.004, over_budget=True)
+        self.assertAlmostEqual(0.006, stats.ui_time_per_second())
+
+        # The first kick falls out of the window, the second one is still in it.
+        mock_perf_counter.return_value = 11.2
+        self.assertAlmostEqual(0.004, stats.ui_time_per_second())
+
+        mock_perf_counter.return_value = 12.0
+        stats.record(0.001, over_budget=False)
+        self.assertAlmostEqual(0.001, stats.ui_time_per_second())
+
+        self.assertEqual({'kicks': 3,
+                          'total_time': unittest.mock.ANY,
+                          'over_budget': 1,
+                          'ui_time_per_second': 0.001},
+                         stats.stats())
+        self.assertAlmostEqual(0.007, stats.total_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
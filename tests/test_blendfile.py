@@ -0,0 +1,525 @@
+"""Unittests for blender_cloud.blendfile.
+
+The blend files used here are generated on the fly; they contain a tiny
+DNA catalog with just enough structs to exercise the reader.
+"""
+
+import gzip
+import io
+import os
+import pathlib
+import struct
+import tempfile
+import unittest
+import unittest.mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from blender_cloud import blendfile
+
+DNA_NAMES = [b'*next', b'*prev', b'name[24]', b'us', b'flag', b'id', b'*parent',
+             b'obmat[4][4]', b'lay[4]', b'restrictflag', b'pad2', b'*data', b'name[1024]']
+DNA_TYPES = [(b'char', 1), (b'short', 2), (b'int', 4), (b'float', 4), (b'void', 0),
+             (b'Link', 16), (b'ID', 48), (b'Object', 152), (b'Image', 1072)]
+# (struct type, [(field type, field name), ...])
+DNA_STRUCTS = [
+    (b'Link', [(b'Link', b'*next'), (b'Link', b'*prev')]),
+    (b'ID', [(b'void', b'*next'), (b'void', b'*prev'), (b'char', b'name[24]'),
+             (b'int', b'us'), (b'int', b'flag')]),
+    (b'Object', [(b'ID', b'id'), (b'Object', b'*parent'), (b'float', b'obmat[4][4]'),
+                 (b'int', b'lay[4]'), (b'int', b'restrictflag'), (b'short', b'flag'),
+                 (b'short', b'pad2'), (b'void', b'*data')]),
+    (b'Image', [(b'ID', b'id'), (b'char', b'name[1024]')]),
+]
+SDNA_OBJECT = 2
+SDNA_IMAGE = 3
+
+
+def _pad4(data: bytes) -> bytes:
+    return data + b'\0' * (-len(data) % 4)
+
+
+def dna1_block_data() -> bytes:
+    type_index = {name: idx for idx, (name, _) in enumerate(DNA_TYPES)}
+    name_index = {name: idx for idx, name in enumerate(DNA_NAMES)}
+
+    data = b'SDNANAME' + struct.pack('<I', len(DNA_NAMES))
+    data += b''.join(name + b'\0' for name in DNA_NAMES)
+    data = _pad4(data) + b'TYPE' + struct.pack('<I', len(DNA_TYPES))
+    data += b''.join(name + b'\0' for name, _ in DNA_TYPES)
+    data = _pad4(data) + b'TLEN' + b''.join(struct.pack('<H', size) for _, size in DNA_TYPES)
+    data = _pad4(data) + b'STRC' + struct.pack('<I', len(DNA_STRUCTS))
+    for struct_type, fields in DNA_STRUCTS:
+        data += struct.pack('<HH', type_index[struct_type], len(fields))
+        for field_type, field_name in fields:
+            data += struct.pack('<HH', type_index[field_type], name_index[field_name])
+    return data
+
+
+def object_data(name: bytes, *, parent=0, data=0, us=1, lay=(1, 0, 0, 0),
+                restrictflag=0, next_ptr=0) -> bytes:
+    obmat = [float(i) for i in range(16)]
+    return (struct.pack('<QQ24sii', next_ptr, 0, name, us, 0) +
+            struct.pack('<Q', parent) +
+            struct.pack('<16f', *obmat) +
+            struct.pack('<4i', *lay) +
+            struct.pack('<ihhQ', restrictflag, 0, 0, data))
+
+
+def image_data(name: bytes, filepath: bytes) -> bytes:
+    return struct.pack('<QQ24sii1024s', 0, 0, name, 1, 0, filepath)
+
+
+def block(code: bytes, addr_old: int, data: bytes, sdna_index=0, count=1) -> bytes:
+    return struct.pack('<4sIQII', code, len(data), addr_old, sdna_index, count) + data
+
+
+def build_blend(extra_blocks=()) -> bytes:
+    """Returns the contents of a small 64-bit little-endian blend file."""
+    return b''.join([
+        b'BLENDER-v280',
+        block(b'OB', 0x1000, object_data(b'OBCube', data=0x3000, next_ptr=0x2000), SDNA_OBJECT),
+        block(b'OB', 0x2000, object_data(b'OBChild', parent=0x1000, us=2), SDNA_OBJECT),
+        block(b'DATA', 0x3000, struct.pack('<QQ', 0x1000, 0x2000)),
+        *extra_blocks,
+        block(b'DNA1', 0x4000, dna1_block_data()),
+        struct.pack('<4sIQII', b'ENDB', 0, 0, 0, 0),
+    ])
+
+
+class AbstractBlendFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.blendpath = pathlib.Path(self.tmpdir.name) / 'synthetic.blend'
+        self.blendpath.write_bytes(build_blend())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class OpenBlendTest(AbstractBlendFileTest):
+    def _check_contents(self, bfile: blendfile.BlendFile):
+        self.assertEqual(b'ENDB', bfile.blocks[-1].code)
+        self.assertEqual([b'OB', b'OB', b'DATA', b'DNA1', b'ENDB'],
+                         [block.code for block in bfile.blocks])
+
+        cube, child = bfile.find_blocks_from_code(b'OB')
+        self.assertEqual('OBCube', cube[b'id', b'name'].decode())
+        self.assertEqual('OBCube', cube.get((b'id', b'name')))
+        self.assertEqual(2, child[b'id', b'us'])
+        self.assertEqual([float(i) for i in range(16)], cube[b'obmat'])
+        self.assertEqual([1, 0, 0, 0], cube[b'lay'])
+        self.assertEqual(0x2000, cube[b'id', b'next'])
+        self.assertIs(cube, child.get_pointer(b'parent'))
+        self.assertIsNone(cube.get_pointer(b'parent'))
+        self.assertEqual(0x3000, cube.get_pointer(b'data').addr_old)
+
+        name_ofs, name_len = cube.get_file_offset(b'id')
+        self.assertEqual(cube.file_offset, name_ofs)
+
+    def test_handle(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            self.assertIsNone(bfile.data)
+            self._check_contents(bfile)
+
+    def test_mmap(self):
+        with blendfile.open_blend(str(self.blendpath), use_mmap=True) as bfile:
+            self.assertIsNotNone(bfile.data)
+            self._check_contents(bfile)
+
+            cube = bfile.find_blocks_from_code(b'OB')[0]
+            raw_name = cube.get((b'id', b'name'), use_nil=False, use_str=False)
+            self.assertIsInstance(raw_name, memoryview)
+            self.assertEqual(b'OBCube\0', raw_name[:7].tobytes())
+            raw_name.release()
+
+    def test_mmap_write(self):
+        with blendfile.open_blend(str(self.blendpath), 'rb+', use_mmap=True) as bfile:
+            child = bfile.find_blocks_from_code(b'OB')[1]
+            child[b'restrictflag'] = 47
+
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            child = bfile.find_blocks_from_code(b'OB')[1]
+            self.assertEqual(47, child[b'restrictflag'])
+            self.assertEqual('OBChild', child.get((b'id', b'name')))
+            self.assertEqual(os.path.getsize(str(self.blendpath)), len(build_blend()))
+
+    def test_gzipped_mmap(self):
+        gzpath = self.blendpath.with_suffix('.gz.blend')
+        gzpath.write_bytes(gzip.compress(build_blend()))
+
+        with blendfile.open_blend(str(gzpath), use_mmap=True) as bfile:
+            self.assertTrue(bfile.is_compressed)
+            self._check_contents(bfile)
+
+
+class LazyOpenTest(AbstractBlendFileTest):
+    def _test_lazy(self, use_mmap: bool):
+        with blendfile.open_blend(str(self.blendpath), lazy=True, use_mmap=use_mmap) as bfile:
+            self.assertIsNotNone(bfile.structs)
+            self.assertEqual({}, bfile.code_index)
+
+            cube = next(bfile.iter_blocks_from_code(b'OB'))
+            self.assertEqual('OBCube', cube.get((b'id', b'name')))
+            self.assertEqual([b'OB'], list(bfile.code_index))
+            self.assertIsNone(bfile.block_from_offset)
+
+            # Resolving pointers indexes the remaining blocks.
+            child = list(bfile.iter_blocks_from_code(b'OB'))[1]
+            self.assertIs(cube, child.get_pointer(b'parent'))
+            self.assertIsNotNone(bfile.block_from_offset)
+            self.assertEqual([b'OB', b'OB', b'DATA', b'DNA1', b'ENDB'],
+                             [block.code for block in bfile.blocks])
+
+    def test_lazy_handle(self):
+        self._test_lazy(False)
+
+    def test_lazy_mmap(self):
+        self._test_lazy(True)
+
+    def test_lazy_without_trailing_dna1(self):
+        # DNA1 followed by another block cannot be found from the tail.
+        self.blendpath.write_bytes(build_blend()[:-24] +
+                                   block(b'TEST', 0x5000, b'SDNANAME' * 2) +
+                                   struct.pack('<4sIQII', b'ENDB', 0, 0, 0, 0))
+        with blendfile.open_blend(str(self.blendpath), lazy=True) as bfile:
+            self.assertEqual(b'TEST', bfile.find_blocks_from_code(b'TEST')[0].code)
+            self.assertEqual('OBChild', bfile.find_blocks_from_code(b'OB')[1].get((b'id', b'name')))
+
+
+class CompactBlockTableTest(AbstractBlendFileTest):
+    def test_columns(self):
+        with blendfile.open_blend(str(self.blendpath), compact=True) as bfile:
+            table = bfile.blocks
+            self.assertIsInstance(table, blendfile.BlendFileBlockTable)
+            self.assertEqual(5, len(table))
+            # Only the DNA1 block has been looked at so far.
+            self.assertEqual([3], list(table._views))
+            self.assertEqual([0x1000, 0x2000, 0x3000], list(table.addr_olds[:3]))
+            self.assertEqual(b'DATA', table.code_at(2))
+
+            self.assertEqual([b'OB', b'OB', b'DATA', b'DNA1', b'ENDB'],
+                             [block.code for block in table])
+            self.assertIs(table[0], table[-5])
+            self.assertEqual(b'ENDB', table[-1].code)
+
+    def test_lookups(self):
+        with blendfile.open_blend(str(self.blendpath), compact=True, use_mmap=True) as bfile:
+            cube, child = bfile.find_blocks_from_code(b'OB')
+            self.assertEqual('OBChild', child.get((b'id', b'name')))
+            self.assertIs(cube, child.get_pointer(b'parent'))
+            self.assertIs(cube, bfile.find_block_from_offset(0x1000))
+            self.assertIsNone(bfile.find_block_from_offset(0x1001))
+            self.assertIsNone(bfile.find_block_from_offset(0))
+            self.assertIsNone(bfile.block_from_offset)
+
+    def test_duplicate_addresses(self):
+        # Like the dict-based index, the last block with an address wins.
+        self.blendpath.write_bytes(build_blend([block(b'TEST', 0x1000, b'abcd')]))
+        with blendfile.open_blend(str(self.blendpath), compact=True) as bfile:
+            self.assertEqual(b'TEST', bfile.find_block_from_offset(0x1000).code)
+
+    def test_lazy(self):
+        with blendfile.open_blend(str(self.blendpath), compact=True, lazy=True) as bfile:
+            cube = next(bfile.iter_blocks_from_code(b'OB'))
+            self.assertEqual('OBCube', cube.get((b'id', b'name')))
+            self.assertEqual(1, len(bfile._blocks))
+            self.assertIs(cube, bfile.find_block_from_offset(0x1000))
+            self.assertEqual(5, len(bfile._blocks))
+
+
+@unittest.skipIf(numpy is None, 'NumPy not installed')
+class StructuredArrayTest(AbstractBlendFileTest):
+    def setUp(self):
+        super().setUp()
+        objects = block(b'OB', 0x5000,
+                        object_data(b'OBOne', lay=(1, 2, 3, 4), data=0x3000) +
+                        object_data(b'OBTwo', lay=(5, 6, 7, 8), parent=0x5000),
+                        SDNA_OBJECT, count=2)
+        self.blendpath.write_bytes(build_blend([objects]))
+
+    def test_dtype(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            dtype = bfile.structs[SDNA_OBJECT].numpy_dtype(bfile.header)
+            self.assertEqual(152, dtype.itemsize)
+            self.assertEqual(('id', 'parent', 'obmat', 'lay', 'restrictflag', 'flag', 'pad2',
+                              'data'), dtype.names)
+            self.assertEqual(numpy.dtype('<u8'), dtype['parent'])
+            self.assertEqual((4, 4), dtype['obmat'].shape)
+            self.assertEqual(numpy.dtype('S24'), dtype['id']['name'])
+            self.assertIs(dtype, bfile.structs[SDNA_OBJECT].numpy_dtype(bfile.header))
+
+    def test_get_array(self):
+        with blendfile.open_blend(str(self.blendpath), use_mmap=True) as bfile:
+            objects = bfile.find_blocks_from_code(b'OB')[2]
+            self.assertEqual([b'OBOne', b'OBTwo'],
+                             objects.get_array((b'id', b'name')).tolist())
+            self.assertEqual([3, 7], objects.get_array((b'lay', 2)).tolist())
+            self.assertEqual([0x3000, 0], objects.get_array(b'data').tolist())
+            self.assertEqual(objects.get(b'obmat', base_index=1),
+                             objects.get_array(b'obmat')[1].ravel().tolist())
+            with self.assertRaises(KeyError):
+                objects.get_array(b'nonexistant')
+
+            # Zero-copy view of the memory-mapped file.
+            array = objects.as_structured_array()
+            self.assertEqual(2, len(array))
+            self.assertFalse(array.flags.owndata)
+            del array
+
+    def test_without_mmap(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            cube = bfile.find_blocks_from_code(b'OB')[0]
+            self.assertEqual([b'OBCube'], cube.get_array((b'id', b'name')).tolist())
+
+    def test_block_too_small(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            data_block = bfile.find_blocks_from_code(b'DATA')[0]
+            with self.assertRaises(ValueError):
+                data_block.as_structured_array(sdna_index_refine=SDNA_OBJECT)
+
+    def test_numpy_missing(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            cube = bfile.find_blocks_from_code(b'OB')[0]
+            with unittest.mock.patch.dict('sys.modules', {'numpy': None}):
+                with self.assertRaises(ImportError):
+                    cube.as_structured_array()
+
+
+class DependencyWalkTest(AbstractBlendFileTest):
+    def _walk(self, code_index, **kwargs):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            start = bfile.find_blocks_from_code(b'OB')[code_index]
+            return [block.addr_old for block in bfile.iter_dependencies(start, **kwargs)]
+
+    def test_pointer_struct(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            ob_struct = bfile.structs[SDNA_OBJECT]
+            ob_struct.get_pointer_struct(bfile.header)
+            self.assertEqual((0, 8, 48, 144), ob_struct.pointer_offsets)
+
+            cube = bfile.find_blocks_from_code(b'OB')[0]
+            self.assertEqual([0x2000, 0x3000], list(cube.iter_pointer_values()))
+
+            # Raw data isn't typed, so its bytes aren't followed as pointers.
+            data_block = bfile.find_blocks_from_code(b'DATA')[0]
+            self.assertEqual([], list(data_block.iter_pointer_values()))
+
+    def test_walk(self):
+        self.assertEqual([0x2000, 0x3000], self._walk(0))
+        self.assertEqual([0x1000, 0x2000, 0x3000], self._walk(0, include_start=True))
+        # Each block is yielded once, even though the graph has cycles.
+        self.assertEqual([0x1000, 0x3000], self._walk(1))
+
+    def test_filters(self):
+        self.assertEqual([], self._walk(0, max_depth=0))
+        self.assertEqual([0x1000], self._walk(1, max_depth=1))
+        self.assertEqual([0x2000], self._walk(0, codes={b'OB'}))
+        self.assertEqual([0x2000], self._walk(0, exclude_codes={b'DATA'}))
+        self.assertEqual([0x3000], self._walk(0, visited={0x2000}))
+
+    def test_raw_data_not_followed(self):
+        # Raw data has the SDNA index of Link, but its bytes aren't pointers.
+        raw_data = block(b'DATA', 0x6000, b'A string that is not a list of pointers\0')
+        pointers = block(b'DATA', 0x8000, struct.pack('<3Q', 0x1000, 0x5000, 0x3000))
+        image = block(b'IM', 0x5000, image_data(b'IMImage', b'//image.png'), SDNA_IMAGE)
+        owner = block(b'OB', 0x7000, object_data(b'OBOwner', data=0x6000, parent=0x8000),
+                      SDNA_OBJECT)
+        self.blendpath.write_bytes(build_blend([raw_data, pointers, image, owner]))
+        self.assertEqual([0x8000, 0x6000], self._walk(2))
+        self.assertEqual([], self._walk(2, codes={b'IM'}))
+
+    def test_compact(self):
+        with blendfile.open_blend(str(self.blendpath), compact=True) as bfile:
+            cube = bfile.find_block_from_offset(0x1000)
+            self.assertEqual([bfile.find_block_from_offset(0x2000)],
+                             list(bfile.iter_dependencies([cube], codes={b'OB'})))
+
+
+class FieldAccessorTest(AbstractBlendFileTest):
+    def test_compiled_once(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            cube, child = bfile.find_blocks_from_code(b'OB')
+            ob_struct = bfile.structs[SDNA_OBJECT]
+
+            self.assertEqual([float(i) for i in range(16)], cube[b'obmat'])
+            accessor = ob_struct.accessor_from_path[b'obmat']
+            self.assertEqual(16 * 4, accessor.value_struct.size)
+            self.assertEqual(48 + 8, accessor.offset)
+
+            self.assertEqual([float(i) for i in range(16)], child[b'obmat'])
+            self.assertIs(accessor, ob_struct.field_accessor(bfile.header, b'obmat'))
+
+    def test_nested_and_indexed(self):
+        with blendfile.open_blend(str(self.blendpath), use_mmap=True) as bfile:
+            cube = bfile.find_blocks_from_code(b'OB')[0]
+            accessor = bfile.structs[SDNA_OBJECT].field_accessor(bfile.header, (b'id', b'us'))
+            self.assertEqual(8 + 8 + 24, accessor.offset)
+            self.assertEqual(1, cube[b'id', b'us'])
+            self.assertEqual(4.0, cube.get((b'obmat', 4))[0])
+            self.assertIsNone(bfile.structs[SDNA_OBJECT].field_accessor(bfile.header, b'nope'))
+            self.assertEqual('default', cube.get(b'nope', default='default'))
+            with self.assertRaises(KeyError):
+                cube.get(b'nope')
+
+    def test_not_implemented(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            cube = bfile.find_blocks_from_code(b'OB')[0]
+            self.assertEqual('<ID>', dict(cube.items())[b'id'])
+            self.assertIn(((b'id', b'name'), b'OBCube'), list(cube.items_recursive_iter()))
+
+
+class DataHashTest(AbstractBlendFileTest):
+    def _hashes(self, algorithm):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            return [block.get_data_hash(algorithm) for block in bfile.find_blocks_from_code(b'OB')]
+
+    def test_raw_hash_ignores_pointers(self):
+        for algorithm in ('adler32', 'crc32', 'blake2b'):
+            self.blendpath.write_bytes(build_blend())
+            cube_hash, child_hash = self._hashes(algorithm)
+            self.assertNotEqual(cube_hash, child_hash)
+
+            # Same data, different pointers.
+            relocated = block(b'OB', 0x8000, object_data(b'OBCube', data=0x9000, next_ptr=0xa000),
+                              SDNA_OBJECT)
+            self.blendpath.write_bytes(build_blend([relocated]))
+            hashes = self._hashes(algorithm)
+            self.assertEqual(cube_hash, hashes[2], algorithm)
+
+            # Different data.
+            changed = block(b'OB', 0x8000, object_data(b'OBCube', restrictflag=1), SDNA_OBJECT)
+            self.blendpath.write_bytes(build_blend([changed]))
+            hashes = self._hashes(algorithm)
+            self.assertNotEqual(cube_hash, hashes[2], algorithm)
+
+    def test_raw_hash_of_raw_data(self):
+        def raw_data_hash(algorithm, data) -> int:
+            self.blendpath.write_bytes(build_blend([block(b'DATA', 0x6000, data)]))
+            with blendfile.open_blend(str(self.blendpath)) as bfile:
+                return bfile.find_block_from_offset(0x6000).get_data_hash(algorithm)
+
+        # Raw data has the SDNA index of Link, but must not be masked as such.
+        for algorithm in ('adler32', 'crc32', 'blake2b'):
+            self.assertNotEqual(raw_data_hash(algorithm, b'A' * 24),
+                                raw_data_hash(algorithm, b'B' * 24), algorithm)
+            self.assertNotEqual(raw_data_hash(algorithm, bytes(range(16))),
+                                raw_data_hash(algorithm, bytes(16)), algorithm)
+            self.assertNotEqual(raw_data_hash(algorithm, bytes(range(40))),
+                                raw_data_hash(algorithm, bytes(40)), algorithm)
+
+    def test_pointer_mask(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            mask = bfile.structs[SDNA_OBJECT].get_pointer_mask(bfile.header)
+            self.assertEqual(152, len(mask))
+            self.assertEqual(bytes(16) + b'\xff' * 32 + bytes(8), mask[:56])
+            self.assertEqual(bytes(8), mask[-8:])
+
+    def test_legacy_hash(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            cube, child = bfile.find_blocks_from_code(b'OB')
+            self.assertIsInstance(cube.get_data_hash(), int)
+            self.assertNotEqual(cube.get_data_hash(), child.get_data_hash())
+
+    def test_unknown_algorithm(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            with self.assertRaises(ValueError):
+                bfile.find_blocks_from_code(b'OB')[0].get_data_hash('md5')
+
+
+class CompressedBlendTest(AbstractBlendFileTest):
+    def setUp(self):
+        super().setUp()
+        self.gzpath = self.blendpath.with_suffix('.gz.blend')
+        self.gzpath.write_bytes(gzip.compress(build_blend()))
+
+    def test_in_memory(self):
+        with blendfile.open_blend(str(self.gzpath)) as bfile:
+            self.assertIsInstance(bfile.handle, io.BytesIO)
+            self.assertEqual(2, len(bfile.find_blocks_from_code(b'OB')))
+
+    def test_temporary_file(self):
+        with blendfile.open_blend(str(self.gzpath), max_in_memory_size=0) as bfile:
+            self.assertNotIsInstance(bfile.handle, io.BytesIO)
+            self.assertEqual(2, len(bfile.find_blocks_from_code(b'OB')))
+
+    def test_spill_to_temporary_file(self):
+        # The gzip trailer of a multi-member file only mentions the size of the last member.
+        contents = build_blend()
+        self.gzpath.write_bytes(gzip.compress(contents[:-100]) + gzip.compress(contents[-100:]))
+        with blendfile.open_blend(str(self.gzpath), max_in_memory_size=200) as bfile:
+            self.assertNotIsInstance(bfile.handle, io.BytesIO)
+            self.assertEqual(2, len(bfile.find_blocks_from_code(b'OB')))
+
+    def test_modify(self):
+        for use_mmap in (False, True):
+            with blendfile.open_blend(str(self.gzpath), 'rb+', use_mmap=use_mmap) as bfile:
+                bfile.find_blocks_from_code(b'OB')[0][b'restrictflag'] = 3 + use_mmap
+
+            with blendfile.open_blend(str(self.gzpath), lazy=True) as bfile:
+                self.assertTrue(bfile.is_compressed)
+                cube = next(bfile.iter_blocks_from_code(b'OB'))
+                self.assertEqual(3 + use_mmap, cube[b'restrictflag'])
+
+    def test_gzip_compress_parallel(self):
+        contents = b''.join(struct.pack('<I', i * 7919 % 65521) for i in range(100000))
+        for data in (b'', b'1234', contents):
+            infile = io.BytesIO(data)
+            outfile = io.BytesIO()
+            blendfile.gzip_compress_parallel(infile, outfile, chunk_size=16 * 1024, max_workers=3)
+            self.assertEqual(data, gzip.decompress(outfile.getvalue()))
+
+
+class DNACatalogCacheTest(AbstractBlendFileTest):
+    def setUp(self):
+        super().setUp()
+        blendfile.clear_dna_cache()
+
+    def tearDown(self):
+        blendfile.DNA_CACHE_DIRECTORY = None
+        blendfile.clear_dna_cache()
+        super().tearDown()
+
+    def test_in_memory(self):
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            structs = bfile.structs
+        with blendfile.open_blend(str(self.blendpath), use_mmap=True) as bfile:
+            self.assertIs(structs, bfile.structs)
+
+    def test_bounded(self):
+        header = unittest.mock.Mock(pointer_size=8, endian_index=0)
+        with unittest.mock.patch('blender_cloud.blendfile.DNA_CATALOG_CACHE_SIZE', 2), \
+                unittest.mock.patch('blender_cloud.blendfile.BlendFile.decode_structs',
+                                    side_effect=lambda header, data: data) as decode:
+            for data in (b'v1', b'v2', b'v1', b'v3', b'v1', b'v2'):
+                self.assertEqual(data, blendfile.dna_catalog(header, data))
+        # v2 was the least recently used when v3 was added.
+        self.assertEqual([b'v1', b'v2', b'v3', b'v2'],
+                         [call[0][1] for call in decode.call_args_list])
+
+    def test_on_disk(self):
+        cache_dir = pathlib.Path(self.tmpdir.name) / 'dna-cache'
+        blendfile.DNA_CACHE_DIRECTORY = str(cache_dir)
+
+        with blendfile.open_blend(str(self.blendpath)) as bfile:
+            structs = bfile.structs
+        self.assertEqual(1, len(list(cache_dir.glob('dna-*.pickle'))))
+
+        blendfile.clear_dna_cache()
+        with unittest.mock.patch('blender_cloud.blendfile.BlendFile.decode_structs') as decode:
+            with blendfile.open_blend(str(self.blendpath)) as bfile:
+                self.assertIsNot(structs, bfile.structs)
+                self.assertEqual([s.dna_type_id for s in structs],
+                                 [s.dna_type_id for s in bfile.structs])
+                self.assertEqual([(f.dna_name.name_full, f.dna_type.dna_type_id, f.dna_offset)
+                                  for f in structs[SDNA_OBJECT].fields],
+                                 [(f.dna_name.name_full, f.dna_type.dna_type_id, f.dna_offset)
+                                  for f in bfile.structs[SDNA_OBJECT].fields])
+
+                cube, child = bfile.find_blocks_from_code(b'OB')
+                self.assertEqual('OBChild', child.get((b'id', b'name')))
+                self.assertIs(cube, child.get_pointer(b'parent'))
+        decode.assert_not_called()
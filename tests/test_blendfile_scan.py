@@ -0,0 +1,66 @@
+"""Unittests for blender_cloud.blendfile_scan."""
+
+import contextlib
+import gzip
+import io
+import json
+import pathlib
+import tempfile
+import unittest
+
+from blender_cloud import blendfile_scan
+
+from test_blendfile import SDNA_IMAGE, block, build_blend, image_data
+
+
+class ScanTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmpdir.name)
+
+        image = block(b'IM', 0x6000, image_data(b'IMbrick', b'//textures/brick.png'), SDNA_IMAGE)
+        (self.root / 'sub').mkdir()
+        (self.root / 'plain.blend').write_bytes(build_blend())
+        (self.root / 'sub' / 'compressed.blend').write_bytes(gzip.compress(build_blend([image])))
+        (self.root / 'sub' / 'broken.blend').write_bytes(b'BLENDER-v280')
+        (self.root / 'sub' / 'notes.txt').write_text('not a blend file')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _results(self, **kwargs) -> dict:
+        results = blendfile_scan.scan_tree(self.root, max_workers=2, **kwargs)
+        return {pathlib.Path(result['path']).name: result for result in results}
+
+    def test_scan_tree(self):
+        results = self._results()
+        self.assertEqual({'plain.blend', 'compressed.blend', 'broken.blend'}, set(results))
+
+        plain = results['plain.blend']
+        self.assertEqual({'OB': 2}, plain['blocks'])
+        self.assertEqual({'OB': ['OBCube', 'OBChild']}, plain['ids'])
+        self.assertEqual([], plain['images'])
+        self.assertFalse(plain['is_compressed'])
+
+        compressed = results['compressed.blend']
+        self.assertEqual({'OB': 2, 'IM': 1}, compressed['blocks'])
+        self.assertEqual(['IMbrick'], compressed['ids']['IM'])
+        self.assertEqual(['//textures/brick.png'], compressed['images'])
+        self.assertTrue(compressed['is_compressed'])
+
+        self.assertIn('error', results['broken.blend'])
+
+    def test_selected_codes(self):
+        results = self._results(codes=[b'IM', b'DATA'])
+        self.assertEqual({'DATA': 1}, results['plain.blend']['blocks'])
+        self.assertEqual({}, results['plain.blend']['ids'])
+        self.assertEqual({'DATA': 1, 'IM': 1}, results['compressed.blend']['blocks'])
+
+    def test_main(self):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            exit_code = blendfile_scan.main([str(self.root), '-j', '2', '-c', 'OB'])
+        self.assertEqual(1, exit_code, 'the broken file should be reported')
+
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(3, len(lines))
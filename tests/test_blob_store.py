@@ -0,0 +1,123 @@
+"""Unittests for blender_cloud.blob_store."""
+
+import os
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+from blender_cloud import blob_store
+
+
+class AbstractBlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = pathlib.Path(self._tmpdir.name)
+        self.store = blob_store.BlobStore(str(self.tmpdir / 'blobs'), max_size=1000)
+
+    def tearDown(self):
+        self.store.index.close()
+        self._tmpdir.cleanup()
+
+    def add_blob(self, key: str, contents: bytes, last_used: float = None):
+        """Mimics pillar.download_to_file() downloading into the store."""
+        blob_path = pathlib.Path(self.store.blob_path(key))
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        blob_path.write_bytes(contents)
+        self.store.index.put(str(blob_path), 'https://cloud.local/%s' % key, {'ETag': key})
+        if last_used is not None:
+            self.store.index.touch(str(blob_path), last_used)
+
+
+class LinkOutTest(AbstractBlobStoreTest):
+    def setUp(self):
+        super().setUp()
+        self.add_blob('5a1b2c3d', b'texture')
+        self.target = self.tmpdir / 'project' / 'textures' / 'brick.png'
+
+    def test_default_modes(self):
+        self.assertIn(self.store.link_out('5a1b2c3d', str(self.target)), ('reflink', 'copy'))
+        self.assertEqual(b'texture', self.target.read_bytes())
+        self.assertFalse(os.path.samefile(self.store.blob_path('5a1b2c3d'), str(self.target)))
+
+        # Linking again is a no-op.
+        self.assertEqual('', self.store.link_out('5a1b2c3d', str(self.target)))
+
+    def test_writing_to_placed_file(self):
+        self.store.link_out('5a1b2c3d', str(self.target))
+
+        # Like settings_sync does with a downloaded userpref.blend.
+        with self.target.open('rb+') as outfile:
+            outfile.write(b'T')
+        self.assertEqual(b'Texture', self.target.read_bytes())
+        self.assertEqual(b'texture', pathlib.Path(self.store.blob_path('5a1b2c3d')).read_bytes())
+
+    def test_fallback_to_copy(self):
+        failing = unittest.mock.Mock(side_effect=OSError('not supported'))
+        with unittest.mock.patch.dict(blob_store._LINKERS, reflink=failing):
+            self.assertEqual('copy', self.store.link_out('5a1b2c3d', str(self.target)))
+            self.assertEqual('', self.store.link_out('5a1b2c3d', str(self.target)))
+        self.assertEqual(b'texture', self.target.read_bytes())
+        self.assertFalse(os.path.samefile(self.store.blob_path('5a1b2c3d'), str(self.target)))
+        self.assertEqual([self.target.name], os.listdir(str(self.target.parent)))
+
+    def test_replaces_existing_file(self):
+        self.target.parent.mkdir(parents=True)
+        self.target.write_bytes(b'old texture')
+        self.store.link_out('5a1b2c3d', str(self.target))
+        self.assertEqual(b'texture', self.target.read_bytes())
+
+    def test_replaced_blob_keeps_placed_file(self):
+        self.store.link_out('5a1b2c3d', str(self.target))
+
+        # A new version is downloaded to a '.part' file and renamed into place.
+        part_path = self.store.blob_path('5a1b2c3d') + '.part'
+        pathlib.Path(part_path).write_bytes(b'new texture')
+        os.replace(part_path, self.store.blob_path('5a1b2c3d'))
+        self.assertEqual(b'texture', self.target.read_bytes())
+
+        self.store.link_out('5a1b2c3d', str(self.target))
+        self.assertEqual(b'new texture', self.target.read_bytes())
+
+
+class BlobKeyTest(unittest.TestCase):
+    def test_blob_key(self):
+        self.assertEqual('5a1b2c3d', blob_store.blob_key('5a1b2c3d'))
+        self.assertEqual('5a1b2c3d', blob_store.blob_key('5a1b2c3d', ''))
+        self.assertEqual('5a1b2c3d-c0ffee', blob_store.blob_key('5a1b2c3d', 'c0ffee'))
+        self.assertEqual('5a1b2c3d-rL0Y2-_bfw', blob_store.blob_key('5a1b2c3d', 'rL0Y2+/bfw=='))
+        self.assertEqual('5a1b2c3d', blob_store.blob_key('5a1b2c3d', '../../etc'))
+
+
+class EvictionTest(AbstractBlobStoreTest):
+    def test_lru(self):
+        self.add_blob('aaaa01', b'a' * 400, last_used=1000)
+        self.add_blob('bbbb02', b'b' * 400, last_used=3000)
+        self.add_blob('cccc03', b'c' * 400, last_used=2000)
+        part_path = pathlib.Path(self.store.blob_path('dddd04') + '.part')
+        part_path.parent.mkdir()
+        part_path.write_bytes(b'd' * 400)
+
+        self.assertEqual(400, self.store.evict())
+        self.assertEqual(['bbbb02', 'cccc03'], sorted(key for key, _, _ in self.store.blobs()))
+
+        # Using a file protects it from eviction.
+        self.store.touch('cccc03')
+        self.store.max_size = 500
+        self.assertEqual(400, self.store.evict())
+        self.assertEqual(['cccc03'], [key for key, _, _ in self.store.blobs()])
+        self.assertIsNone(self.store.index.get(self.store.blob_path('bbbb02')))
+        self.assertTrue(os.path.exists(self.store.blob_path('dddd04') + '.part'))
+
+    def test_maybe_evict(self):
+        self.add_blob('aaaa01', b'a' * 2000)
+        self.assertEqual(2000, self.store.maybe_evict())
+
+        self.add_blob('bbbb02', b'b' * 2000)
+        self.assertEqual(0, self.store.maybe_evict())
+        with unittest.mock.patch('blender_cloud.blob_store.EVICTION_INTERVAL', 0):
+            self.assertEqual(2000, self.store.maybe_evict())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+"""Unittests for blender_cloud.concurrency."""
+
+import asyncio
+import unittest
+import unittest.mock
+
+import pillarsdk
+
+from blender_cloud import concurrency, pillar
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = concurrency.AdaptiveLimiter(initial_limit=2, min_limit=1, max_limit=4)
+        self.now = 100.0
+        patcher = unittest.mock.patch('blender_cloud.concurrency.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, latency: float, **release_kwargs):
+        """Performs a call that takes 'latency' seconds."""
+
+        async def do_call():
+            token = await self.limiter.acquire()
+            self.now += latency
+            self.limiter.release(token, **release_kwargs)
+
+        asyncio.run(do_call())
+
+    def saturate(self, latency: float, count: int):
+        """Performs calls while all other slots are in use."""
+
+        for _ in range(count):
+            self.limiter._in_flight = self.limiter.limit - 1
+            self.call(latency)
+            self.limiter._in_flight = 0
+
+    def test_additive_increase(self):
+        # Roughly one step per 'limit' calls.
+        self.saturate(0.1, 3)
+        self.assertEqual(3, self.limiter.limit)
+        self.saturate(0.1, 3)
+        self.assertEqual(4, self.limiter.limit)
+        self.saturate(0.1, 20)
+        self.assertEqual(4, self.limiter.limit)
+
+    def test_no_increase_when_unsaturated(self):
+        for _ in range(10):
+            self.call(0.1)
+        self.assertEqual(2, self.limiter.limit)
+        self.assertEqual(10, self.limiter.stats()['calls'])
+
+    def test_decrease_on_overload(self):
+        self.saturate(0.1, 6)
+        self.assertEqual(4, self.limiter.limit)
+
+        self.call(0.1, overloaded=True)
+        self.assertEqual(2, self.limiter.limit)
+        self.assertEqual(1, self.limiter.overloads)
+
+        # Errors of calls started before the decrease don't decrease it again.
+        token = self.now - 1
+        self.limiter._in_flight = 1
+        self.limiter.release(token, overloaded=True)
+        self.assertEqual(2, self.limiter.limit)
+
+        self.call(0.1, overloaded=True)
+        self.call(0.1, overloaded=True)
+        self.assertEqual(1, self.limiter.limit)
+
+    def test_decrease_on_latency(self):
+        self.saturate(0.1, 6)
+        self.assertEqual(4, self.limiter.limit)
+
+        self.saturate(1.0, 2)
+        self.assertEqual(2, self.limiter.limit)
+
+    def test_unmeasured_calls(self):
+        self.call(0.1, measure=False)
+        self.assertEqual(0, self.limiter.calls)
+        self.assertEqual(0, self.limiter.in_flight)
+
+
+class LimiterQueueTest(unittest.TestCase):
+    def test_queue(self):
+        limiter = concurrency.AdaptiveLimiter(initial_limit=2, min_limit=1, max_limit=4)
+        log = []
+
+        async def call(name: str, event: asyncio.Event):
+            token = await limiter.acquire()
+            log.append(name)
+            await event.wait()
+            limiter.release(token, measure=False)
+
+        async def main():
+            events = [asyncio.Event() for _ in range(4)]
+            tasks = [asyncio.ensure_future(call(str(idx), event))
+                     for idx, event in enumerate(events)]
+            await asyncio.sleep(0)
+
+            self.assertEqual(['0', '1'], log)
+            self.assertEqual(2, limiter.in_flight)
+            self.assertEqual(2, limiter.queue_depth)
+
+            # A timed-out waiter leaves the queue.
+            with self.assertRaises(asyncio.TimeoutError):
+                await limiter.acquire(timeout=0.01)
+            self.assertEqual(2, limiter.queue_depth)
+
+            events[0].set()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertEqual(['0', '1', '2'], log)
+            self.assertEqual(1, limiter.queue_depth)
+
+            for event in events:
+                event.set()
+            await asyncio.gather(*tasks)
+            self.assertEqual(['0', '1', '2', '3'], log)
+            self.assertEqual(0, limiter.in_flight)
+            self.assertEqual(0, limiter.queue_depth)
+
+        asyncio.run(main())
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = concurrency.SingleFlight()
+        self.calls = []
+
+    async def slow_call(self, value, event: asyncio.Event):
+        self.calls.append(value)
+        await event.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def test_shared_result(self):
+        async def main():
+            event = asyncio.Event()
+            tasks = [asyncio.ensure_future(self.single_flight.call(
+                'key', lambda: self.slow_call('result', event), 'label'))
+                for _ in range(3)]
+            other = asyncio.ensure_future(self.single_flight.call(
+                'other', lambda: self.slow_call('other', event)))
+            await asyncio.sleep(0)
+            event.set()
+            return await asyncio.gather(*tasks, other)
+
+        self.assertEqual(['result'] * 3 + ['other'], asyncio.run(main()))
+        self.assertEqual(['result', 'other'], self.calls)
+        self.assertEqual({'calls': 2, 'hits': 2, 'in_flight': 0,
+                          'hits_per_label': {'label': 2}}, self.single_flight.stats())
+
+    def test_shared_exception(self):
+        async def main():
+            event = asyncio.Event()
+            tasks = [asyncio.ensure_future(self.single_flight.call(
+                'key', lambda: self.slow_call(KeyError('missing'), event)))
+                for _ in range(2)]
+            await asyncio.sleep(0)
+            event.set()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        first, second = asyncio.run(main())
+        self.assertIsInstance(first, KeyError)
+        self.assertIs(first, second)
+        self.assertEqual(1, len(self.calls))
+
+    def test_cancellation(self):
+        async def main():
+            event = asyncio.Event()
+            tasks = [asyncio.ensure_future(self.single_flight.call(
+                'key', lambda: self.slow_call('result', event)))
+                for _ in range(2)]
+            await asyncio.sleep(0)
+
+            # The call continues for the other caller.
+            tasks[0].cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(1, self.single_flight.in_flight)
+
+            # Nobody waits for it any more.
+            tasks[1].cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(0, self.single_flight.in_flight)
+
+            # A new call is made.
+            event.set()
+            return await self.single_flight.call('key', lambda: self.slow_call('again', event))
+
+        self.assertEqual('again', asyncio.run(main()))
+        self.assertEqual(['result', 'again'], self.calls)
+
+
+class PillarSingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        pillar.pillar_memory_cache.clear()
+
+    def test_keys(self):
+        key = pillar._single_flight_key
+        params = {'projection': {'name': 1}, 'embed': ['parent']}
+        self.assertEqual(key(pillarsdk.Node.find, ('abc', ), {'params': params}, True),
+                         key(pillarsdk.Node.find, ('abc', ), {'params': dict(params)}, True))
+        self.assertNotEqual(key(pillarsdk.Node.find, ('abc', ), {}, True),
+                            key(pillarsdk.Node.find, ('abc', ), {}, False))
+        self.assertNotEqual(key(pillarsdk.Node.find, ('abc', ), {}, True),
+                            key(pillarsdk.File.find, ('abc', ), {}, True))
+
+        # Calls that may change something are never shared.
+        self.assertIsNone(key(pillarsdk.Node.create_asset_from_file, ('p', 'g', 'file', 'x'),
+                              {}, False))
+        node = pillarsdk.Node({'_id': 'abc'})
+        self.assertIsNone(key(node.create, (), {}, True))
+
+    def test_pillar_call(self):
+        calls = []
+
+        async def perform_pillar_call(transport, api, pillar_func, args, kwargs):
+            calls.append((pillar_func.__name__, args))
+            await asyncio.sleep(0.01)
+            return pillarsdk.User({'_id': 'me'})
+
+        async def main():
+            return await asyncio.gather(pillar.pillar_call(pillarsdk.User.me),
+                                        pillar.pillar_call(pillarsdk.User.me),
+                                        pillar.pillar_call(pillarsdk.User.find, 'me'))
+
+        hits_before = pillar.pillar_single_flight.hits
+        with unittest.mock.patch('blender_cloud.pillar.pillar_api'), \
+                unittest.mock.patch('blender_cloud.pillar._perform_pillar_call',
+                                    perform_pillar_call):
+            first, second, third = asyncio.run(main())
+
+        self.assertIs(first, second)
+        self.assertEqual([('me', ()), ('find', ('me', ))], calls)
+        self.assertEqual(1, pillar.pillar_single_flight.hits - hits_before)
+        self.assertLessEqual(1, pillar.pillar_single_flight.hits_per_label['User.me'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Unittests for blender_cloud.download_index."""
+
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+
+from blender_cloud import download_index
+
+
+class AbstractIndexTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = pathlib.Path(self._tmpdir.name)
+        self.index = download_index.DownloadIndex(str(self.tmpdir / 'downloads.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        self._tmpdir.cleanup()
+
+    def write_file(self, relpath: str, contents=b'thumbnail') -> str:
+        path = self.tmpdir / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(contents)
+        return str(path)
+
+
+class DownloadIndexTest(AbstractIndexTest):
+    def test_wal_mode(self):
+        self.index.get('/nonexistant')
+        conn = self.index._connection()
+        self.assertEqual('wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_put_get(self):
+        path = self.write_file('thumbs/a.jpg')
+        self.index.put(path, 'https://cloud.local/a.jpg',
+                       {'ETag': '"abc"', 'Last-Modified': 'Mon, 15 Apr 2019 12:00:00 GMT',
+                        'Content-Length': '9'})
+
+        record = self.index.get(path)
+        self.assertEqual('https://cloud.local/a.jpg', record.url)
+        self.assertEqual('"abc"', record.etag)
+        self.assertEqual(9, record.length)
+        self.assertTrue(record.matches(os.stat(path)))
+
+        self.write_file('thumbs/a.jpg', b'other file')
+        self.assertFalse(record.matches(os.stat(path)))
+
+        self.index.delete(path)
+        self.assertIsNone(self.index.get(path))
+
+    def test_get_many(self):
+        paths = [self.write_file('thumbs/%04d.jpg' % i) for i in range(1200)]
+        for path in paths[::2]:
+            self.index.put(path, 'https://cloud.local/', {'ETag': path})
+
+        records = self.index.get_many(paths)
+        self.assertEqual(sorted(paths[::2]), sorted(records))
+        self.assertEqual(paths[10], records[paths[10]].etag)
+
+    def test_get_directory(self):
+        paths = [self.write_file('thumbs/a.jpg'),
+                 self.write_file('thumbs/sub/b.jpg'),
+                 self.write_file('thumbs2/c.jpg'),
+                 self.write_file('thumb.jpg')]
+        for path in paths:
+            self.index.put(path, 'https://cloud.local/', {})
+
+        self.assertEqual(sorted(paths[:2]),
+                         sorted(self.index.get_directory(str(self.tmpdir / 'thumbs'))))
+
+
+class MigrationTest(AbstractIndexTest):
+    def write_header_store(self, path: str, content_length):
+        with open(path + '.headers', 'w') as outfile:
+            json.dump({'ETag': '"etag"', 'Last-Modified': 'Mon, 15 Apr 2019 12:00:00 GMT',
+                       'Content-Length': content_length}, outfile)
+
+    def test_migrate_directory(self):
+        valid = self.write_file('thumbs/valid.jpg')
+        self.write_header_store(valid, '9')
+        wrong_length = self.write_file('thumbs/wrong-length.jpg')
+        self.write_header_store(wrong_length, '1234')
+        without_file = str(self.tmpdir / 'thumbs' / 'deleted.jpg')
+        self.write_header_store(without_file, '9')
+        broken = self.write_file('thumbs/broken.jpg')
+        pathlib.Path(broken + '.headers').write_text('{not json')
+
+        self.assertEqual(1, self.index.migrate_directory(str(self.tmpdir / 'thumbs')))
+        self.assertEqual([valid], list(self.index.get_directory(str(self.tmpdir / 'thumbs'))))
+        self.assertEqual('Mon, 15 Apr 2019 12:00:00 GMT', self.index.get(valid).last_modified)
+
+        # All headers files are removed, including the ones that couldn't be used.
+        self.assertEqual([], [name for name in os.listdir(str(self.tmpdir / 'thumbs'))
+                          if name.endswith('.headers')])
+
+    def test_migrate_on_get(self):
+        path = self.write_file('thumbs/a.jpg')
+        self.write_header_store(path, '9')
+
+        self.assertEqual('"etag"', self.index.get(path, legacy_header_store=path + '.headers').etag)
+        self.assertFalse(os.path.exists(path + '.headers'))
+        self.assertEqual('"etag"', self.index.get(path).etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Unittests for blender_cloud.http_cache and the thumbnail budget in blender_cloud.cache."""
+
+import http.server
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import cachecontrol
+import requests
+
+from blender_cloud import cache, download_index, http_cache
+
+
+class AbstractCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, 'http_cache')
+        self.caches = []
+
+    def tearDown(self):
+        for bounded_cache in self.caches:
+            bounded_cache.close()
+        self.tmpdir.cleanup()
+
+    def make_cache(self, **kwargs) -> http_cache.BoundedFileCache:
+        bounded_cache = http_cache.BoundedFileCache(self.directory, **kwargs)
+        self.caches.append(bounded_cache)
+        return bounded_cache
+
+
+class BoundedFileCacheTest(AbstractCacheTest):
+    def test_get_set_delete(self):
+        bounded_cache = self.make_cache()
+        self.assertIsNone(bounded_cache.get('https://cloud/api/nodes/1'))
+        bounded_cache.set('https://cloud/api/nodes/1', b'response')
+        self.assertEqual(b'response', bounded_cache.get('https://cloud/api/nodes/1'))
+
+        # Another process sees the same entries.
+        self.assertEqual(b'response', self.make_cache().get('https://cloud/api/nodes/1'))
+
+        bounded_cache.delete('https://cloud/api/nodes/1')
+        self.assertIsNone(bounded_cache.get('https://cloud/api/nodes/1'))
+
+        stats = bounded_cache.stats()
+        self.assertEqual({'hits': 1, 'misses': 2, 'bytes_read': 8, 'bytes_written': 8,
+                          'entries': 0, 'size': 0}, {key: stats[key] for key in (
+                              'hits', 'misses', 'bytes_read', 'bytes_written', 'entries', 'size')})
+
+        # Only the index and the entry directories; no lock or temporary files.
+        leftovers = [name for _, _, names in os.walk(self.directory) for name in names
+                     if not name.startswith(http_cache.INDEX_FILENAME)]
+        self.assertEqual([], leftovers)
+
+    def test_lru(self):
+        bounded_cache = self.make_cache(max_size=300)
+        now = time.time()
+        for idx, key in enumerate('abc'):
+            with unittest.mock.patch('time.time', return_value=now + idx):
+                bounded_cache.set(key, bytes(100))
+        with unittest.mock.patch('time.time', return_value=now + 10):
+            bounded_cache.get('a')
+
+        # The budget is exceeded; evict down to 90% of 300 bytes.
+        with unittest.mock.patch('time.time', return_value=now + 20):
+            bounded_cache.set('d', bytes(100))
+        self.assertIsNone(bounded_cache.get('b'))
+        self.assertIsNone(bounded_cache.get('c'))
+        self.assertIsNotNone(bounded_cache.get('a'))
+        self.assertIsNotNone(bounded_cache.get('d'))
+
+        stats = bounded_cache.stats()
+        self.assertEqual(2, stats['evictions'])
+        self.assertEqual(200, stats['bytes_evicted'])
+        self.assertEqual(200, stats['size'])
+
+    def test_lfu(self):
+        bounded_cache = self.make_cache(max_size=300, policy='lfu')
+        for key in 'abc':
+            bounded_cache.set(key, bytes(100))
+        for _ in range(3):
+            bounded_cache.get('a')
+        bounded_cache.get('c')
+        # Storing an entry again keeps its hits.
+        bounded_cache.set('a', bytes(100))
+
+        bounded_cache.set('d', bytes(100))
+        self.assertIsNone(bounded_cache.get('b'))
+        self.assertIsNone(bounded_cache.get('c'))
+        self.assertIsNotNone(bounded_cache.get('a'))
+        self.assertIsNotNone(bounded_cache.get('d'))
+
+    def test_total_size(self):
+        bounded_cache = self.make_cache()
+        other = self.make_cache()
+        bounded_cache.set('a', bytes(100))
+        bounded_cache.set('a', bytes(50))
+        other.set('b', bytes(30))
+        other.delete('a')
+        bounded_cache.delete('missing')
+        self.assertEqual(30, bounded_cache.stats()['size'])
+
+        bounded_cache.set('c', bytes(20))
+        bounded_cache.evict(target_size=25)
+        self.assertEqual(20, other.stats()['size'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            http_cache.BoundedFileCache(self.directory, policy='fifo')
+
+
+class CachedHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    request_count = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        type(self).request_count += 1
+        body = b'{"_id": "5a1b2c3d"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=600')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CacheControlTest(AbstractCacheTest):
+    def test_session(self):
+        handler = type('Handler', (CachedHandler, ), {'request_count': 0})
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        bounded_cache = self.make_cache()
+        session = cachecontrol.CacheControl(requests.session(), cache=bounded_cache)
+        url = 'http://127.0.0.1:%i/api/nodes/5a1b2c3d' % server.server_port
+        for _ in range(3):
+            self.assertEqual({'_id': '5a1b2c3d'}, session.get(url).json())
+
+        self.assertEqual(1, handler.request_count)
+        self.assertEqual(2, bounded_cache.stats()['hits'])
+        self.assertEqual(1, bounded_cache.stats()['entries'])
+
+
+class EvictThumbnailsTest(AbstractCacheTest):
+    def test_evict(self):
+        thumbs_dir = pathlib.Path(self.tmpdir.name) / 'thumbnails'
+        node_dir = thumbs_dir / 'project' / 'node'
+        node_dir.mkdir(parents=True)
+        index = download_index.DownloadIndex(str(pathlib.Path(self.tmpdir.name) / 'dl.sqlite'))
+        self.addCleanup(index.close)
+
+        now = time.time()
+        for idx, name in enumerate(['old.jpg', 'new.jpg', 'newest.jpg']):
+            path = node_dir / name
+            path.write_bytes(bytes(100))
+            index.put(str(path), 'https://cdn/%s' % name, {'ETag': '"%i"' % idx})
+            index.touch(str(path), now + idx)
+        # Not in the index at all.
+        (node_dir / 'unknown.jpg').write_bytes(bytes(100))
+        # Still being downloaded.
+        (node_dir / 'loading.jpg.part').write_bytes(bytes(100))
+        (node_dir / 'loading.jpg.part.journal').write_bytes(bytes(10))
+
+        with unittest.mock.patch('blender_cloud.download_index.default_index',
+                                 return_value=index):
+            removed = cache.evict_thumbnails(str(thumbs_dir), max_size=250)
+
+        self.assertEqual(200, removed)
+        self.assertEqual(['loading.jpg.part', 'loading.jpg.part.journal', 'new.jpg', 'newest.jpg'],
+                         sorted(os.listdir(str(node_dir))))
+        self.assertIsNone(index.get(str(node_dir / 'old.jpg')))
+
+
+if __name__ == '__main__':
+    unittest.main()
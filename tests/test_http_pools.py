@@ -0,0 +1,113 @@
+"""Unittests for blender_cloud.http_pools."""
+
+import http.server
+import threading
+import unittest
+
+import requests.adapters
+
+from blender_cloud import http_pools, pillar
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = None
+    failures = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, dict(self.headers)))
+        if self.failures:
+            self.failures.pop()
+            status, body = 503, b'busy'
+        else:
+            status, body = 200, b'thumbnail'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPPoolsTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.failures = []
+        handler = type('Handler', (StubHandler,), {'requests': self.requests,
+                                                   'failures': self.failures})
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%i/thumb.jpg' % self.server.server_port
+
+        http_pools.POOL_CONFIGS['test'] = http_pools.PoolConfig(
+            pool_maxsize=2, retries=2, backoff_factor=0,
+            retry_statuses=frozenset({503}), max_workers=2)
+
+    def tearDown(self):
+        http_pools.close()
+        for registry in (http_pools.POOL_CONFIGS, http_pools._sessions, http_pools._mounted):
+            registry.pop('test', None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive_and_stats(self):
+        session = http_pools.session('test')
+        self.assertIs(session, http_pools.session('test'))
+        self.assertIsNot(session, http_pools.session(http_pools.API))
+
+        for _ in range(3):
+            self.assertEqual(b'thumbnail', session.get(self.url).content)
+
+        stats = http_pools.stats()['test']
+        self.assertEqual({'hosts': 1, 'connections_opened': 1, 'requests': 3,
+                          'idle_connections': 1, 'pool_maxsize': 2}, stats)
+
+    def test_no_keep_alive(self):
+        http_pools.configure('test', keep_alive=False)
+        http_pools.session('test').get(self.url)
+        self.assertEqual('close', self.requests[0][1]['Connection'])
+
+    def test_retry_statuses(self):
+        self.failures.extend([True, True])
+        response = http_pools.session('test').get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(self.requests))
+
+        # After the last retry the response is returned as-is.
+        self.failures.extend([True, True, True])
+        response = http_pools.session('test').get(self.url)
+        self.assertEqual(503, response.status_code)
+
+    def test_configure(self):
+        class CustomAdapter(requests.adapters.HTTPAdapter):
+            def __init__(self, marker, **kwargs):
+                self.marker = marker
+                super().__init__(**kwargs)
+
+        session = requests.session()
+        http_pools.mount(session, 'test', CustomAdapter, marker='cache')
+        http_pools.configure('test', pool_maxsize=5)
+
+        adapter = session.get_adapter(self.url)
+        self.assertIsInstance(adapter, CustomAdapter)
+        self.assertEqual('cache', adapter.marker)
+        self.assertEqual(5, adapter.pool_config.pool_maxsize)
+        self.assertIs(adapter, session.get_adapter('https://cloud.blender.org/'))
+
+    def test_executors(self):
+        self.assertIsNone(http_pools.executor(http_pools.API))
+
+        executor = http_pools.executor('test')
+        self.assertIs(executor, http_pools.executor('test'))
+        thread_name = executor.submit(lambda: threading.current_thread().name).result()
+        self.assertTrue(thread_name.startswith('blender-cloud-test'))
+
+    def test_api_pool_matches_limiter(self):
+        self.assertGreaterEqual(http_pools.POOL_CONFIGS[http_pools.API].pool_maxsize,
+                                pillar.pillar_limiter.max_limit)
+
+
+if __name__ == '__main__':
+    unittest.main()
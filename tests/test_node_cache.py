@@ -0,0 +1,299 @@
+"""Unittests for blender_cloud.node_cache and the cached listings in blender_cloud.pillar."""
+
+import asyncio
+import datetime
+import pathlib
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import pillarsdk
+
+from blender_cloud import node_cache, pillar
+
+
+def node(idx: int, etag='etag-0', **extra) -> pillarsdk.Node:
+    doc = {'_id': '%024x' % idx, '_etag': etag, 'name': 'node %i' % idx,
+           'node_type': 'group_texture', 'parent': {'_id': 'p', 'name': 'Parent'}}
+    doc.update(extra)
+    return pillarsdk.Node(doc)
+
+
+class AbstractCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.doc_cache = node_cache.DocumentCache(str(pathlib.Path(self.tmpdir.name) / 'docs.sqlite'))
+
+    def tearDown(self):
+        self.doc_cache.close()
+        self.tmpdir.cleanup()
+
+
+class DocumentCacheTest(AbstractCacheTest):
+    def test_documents(self):
+        updated = datetime.datetime(2019, 4, 15, 12, tzinfo=pillarsdk.utils.utc)
+        self.doc_cache.put(pillarsdk.Node, [node(1, _updated=updated), node(2)])
+
+        docs = self.doc_cache.get(pillarsdk.Node, ['%024x' % 1, '%024x' % 3])
+        self.assertEqual(['%024x' % 1], list(docs))
+        doc = docs['%024x' % 1]
+        self.assertIsInstance(doc, pillarsdk.Node)
+        self.assertEqual(updated, doc._updated)
+        self.assertEqual('Parent', doc.parent.name)
+
+        # Documents are stored per kind.
+        self.assertEqual({}, self.doc_cache.get(pillarsdk.File, ['%024x' % 1]))
+
+        with unittest.mock.patch('time.time', return_value=time.time() + 60):
+            self.assertEqual({}, self.doc_cache.get(pillarsdk.Node, ['%024x' % 1], max_age=30))
+            self.assertEqual(1, len(self.doc_cache.get(pillarsdk.Node, ['%024x' % 1],
+                                                       max_age=90)))
+
+    def test_listings(self):
+        nodes = [node(idx) for idx in range(3)]
+        ids = [doc['_id'] for doc in nodes]
+        self.doc_cache.put_listing(pillarsdk.Node, 'key', 'p', ids[::-1], nodes)
+
+        listing = self.doc_cache.get_listing(pillarsdk.Node, 'key')
+        self.assertEqual(ids[::-1], [doc['_id'] for doc in listing.docs])
+        self.assertLess(listing.age, 5)
+        self.assertIsNone(self.doc_cache.get_listing(pillarsdk.Node, 'other'))
+        self.assertIsNone(self.doc_cache.get_listing(pillarsdk.Project, 'key'))
+
+        # Listings can't be used when their documents are missing.
+        self.doc_cache.put_listing(pillarsdk.Node, 'key', 'p', ids + ['missing'], [])
+        self.assertIsNone(self.doc_cache.get_listing(pillarsdk.Node, 'key'))
+
+        self.doc_cache.put_listing(pillarsdk.Node, 'key', 'p', ids, [])
+        self.doc_cache.invalidate_parent('p')
+        self.assertIsNone(self.doc_cache.get_listing(pillarsdk.Node, 'key'))
+
+
+class MemoryCacheTest(unittest.TestCase):
+    def test_lru_and_ttl(self):
+        memory = node_cache.MemoryCache(max_entries=2, ttl=60)
+        memory.put('a', 1)
+        memory.put('b', 2)
+        self.assertEqual(1, memory.get('a'))
+        memory.put('c', 3)
+        self.assertIsNone(memory.get('b'))
+        self.assertEqual(1, memory.get('a'))
+        self.assertEqual(1, memory.evictions)
+
+        with unittest.mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual('gone', memory.get('a', 'gone'))
+
+    def test_invalidate(self):
+        memory = node_cache.MemoryCache(max_entries=10, ttl=60)
+        memory.put('node', 1, tags=['nodes'])
+        memory.put('file', 2, tags=['files'])
+        generation = memory.generation
+
+        self.assertEqual(1, memory.invalidate('nodes'))
+        self.assertIsNone(memory.get('node'))
+        self.assertEqual(2, memory.get('file'))
+
+        # A result obtained before the invalidation may be outdated.
+        memory.put('node', 1, tags=['nodes'], generation=generation)
+        self.assertIsNone(memory.get('node'))
+
+
+class DocumentCacheMemoryTest(AbstractCacheTest):
+    def test_no_decoding_when_remembered(self):
+        nodes = [node(idx) for idx in range(3)]
+        ids = [doc['_id'] for doc in nodes]
+        self.doc_cache.put_listing(pillarsdk.Node, 'key', 'p', ids, nodes)
+
+        with unittest.mock.patch('blender_cloud.node_cache._loads') as mock_loads:
+            listing = self.doc_cache.get_listing(pillarsdk.Node, 'key')
+            self.assertEqual(2, len(self.doc_cache.get(pillarsdk.Node, ids[1:])))
+        mock_loads.assert_not_called()
+        self.assertIs(nodes[0], listing.docs[0])
+
+        # Another instance has to decode the documents once.
+        other = node_cache.DocumentCache(self.doc_cache.path)
+        self.addCleanup(other.close)
+        self.assertEqual(ids, [doc['_id'] for doc in other.get_listing(pillarsdk.Node, 'key').docs])
+        with unittest.mock.patch('blender_cloud.node_cache._loads') as mock_loads:
+            other.get_listing(pillarsdk.Node, 'key')
+        mock_loads.assert_not_called()
+
+        self.doc_cache.invalidate_parent('p')
+        self.assertIsNone(self.doc_cache.get_listing(pillarsdk.Node, 'key'))
+
+
+class PillarMemoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        pillar.pillar_memory_cache.clear()
+        self.calls = []
+
+    async def perform_pillar_call(self, transport, api, pillar_func, args, kwargs):
+        self.calls.append(pillar_func.__name__)
+        await asyncio.sleep(0)
+        if not isinstance(pillar_func.__self__, type):
+            return True
+        return pillar_func.__self__({'_id': args[0] if args else 'me'})
+
+    def run_calls(self, *calls, patch_api=True) -> list:
+        async def main():
+            return [await pillar.pillar_call(*call[0], **call[1]) for call in calls]
+
+        with unittest.mock.patch('blender_cloud.pillar._perform_pillar_call',
+                                 self.perform_pillar_call):
+            if not patch_api:
+                return asyncio.run(main())
+            with unittest.mock.patch('blender_cloud.pillar.pillar_api'):
+                return asyncio.run(main())
+
+    def test_repeated_queries(self):
+        first, second, uncached = self.run_calls(
+            ((pillarsdk.Node.find, 'abc'), {}),
+            ((pillarsdk.Node.find, 'abc'), {}),
+            ((pillarsdk.Node.find, 'abc'), {'caching': False}))
+        self.assertIs(first, second)
+        self.assertIsNot(first, uncached)
+        self.assertEqual(['find', 'find'], self.calls)
+
+    def test_invalidated_by_writes(self):
+        new_node = pillarsdk.Node({'name': 'new'})
+        self.run_calls(((pillarsdk.Node.find, 'abc'), {}),
+                       ((pillarsdk.File.find, 'def'), {}),
+                       ((new_node.create, ), {}),
+                       ((pillarsdk.Node.find, 'abc'), {}),
+                       ((pillarsdk.File.find, 'def'), {}))
+        self.assertEqual(['find', 'find', 'create', 'find'], self.calls)
+
+        with unittest.mock.patch('blender_cloud.pillar.pillar_api'):
+            pillar.sync_call(unittest.mock.Mock(__self__=pillarsdk.Node({}), __name__='patch'))
+        self.run_calls(((pillarsdk.Node.find, 'abc'), {}))
+        self.assertEqual(['find', 'find', 'create', 'find', 'find'], self.calls)
+
+    def test_not_invalidated_by_reads(self):
+        file_doc = pillarsdk.File({'_id': 'def'})
+        self.run_calls(((pillarsdk.File.find, 'def'), {}),
+                       ((file_doc.thumbnail, 's'), {}),
+                       ((pillarsdk.File.find, 'def'), {}))
+        self.assertEqual(['find', 'thumbnail'], self.calls)
+
+    def test_current_user_not_remembered(self):
+        self.run_calls(((pillarsdk.User.me, ), {}), ((pillarsdk.User.me, ), {}))
+        self.assertEqual(['me', 'me'], self.calls)
+
+    def test_credentials_changed(self):
+        profile = unittest.mock.Mock(subclients={pillar.SUBCLIENT_ID: {
+            'subclient_user_id': 'user-1', 'token': 'token-1'}})
+        with unittest.mock.patch('blender_cloud.pillar._testing_blender_id_profile', profile), \
+                unittest.mock.patch('blender_cloud.cache.requests_session'):
+            pillar.reset_pillar_api()
+            pillar.pillar_api('http://pillar/')
+            self.run_calls(((pillarsdk.Node.find, 'abc'), {}),
+                           ((pillarsdk.Node.find, 'abc'), {}), patch_api=False)
+            self.assertEqual(['find'], self.calls)
+
+            # Another user logged in.
+            profile.subclients[pillar.SUBCLIENT_ID] = {
+                'subclient_user_id': 'user-2', 'token': 'token-2'}
+            preferences = unittest.mock.Mock(return_value=unittest.mock.Mock(
+                pillar_server='http://pillar/'))
+            with unittest.mock.patch.dict('sys.modules', {
+                    'blender_cloud.blender': unittest.mock.Mock(preferences=preferences)}):
+                self.run_calls(((pillarsdk.Node.find, 'abc'), {}), patch_api=False)
+            self.assertEqual(['find', 'find'], self.calls)
+            self.assertEqual('user-2', pillar.pillar_api().username)
+        pillar.reset_pillar_api()
+
+
+class FakeNodeCollection:
+    """Answers Node.all() queries like Eve, on listings and on '_id $in' queries."""
+
+    def __init__(self, node_count: int):
+        self.nodes = [node(idx) for idx in range(node_count)]
+        self.queries = []
+
+    async def pillar_call(self, pillar_func, params: dict):
+        assert pillar_func == pillarsdk.Node.all
+        self.queries.append(params)
+        await asyncio.sleep(0)
+
+        where = params['where']
+        if '_id' in where:
+            wanted = set(where['_id']['$in'])
+            matches = [doc for doc in self.nodes if doc['_id'] in wanted]
+        else:
+            matches = self.nodes
+        if params['projection'] == {'_etag': 1}:
+            matches = [pillarsdk.Node({'_id': doc['_id'], '_etag': doc._etag})
+                       for doc in matches]
+
+        return pillarsdk.Node.list_class({
+            '_items': matches,
+            '_meta': {'page': 1, 'max_results': params['max_results'], 'total': len(matches)},
+        })
+
+
+class CachedListingTest(AbstractCacheTest):
+    def setUp(self):
+        super().setUp()
+        self.collection = FakeNodeCollection(5)
+        pillar._revalidations.clear()
+
+    def list_nodes(self, revalidated=None) -> list:
+        async def list_and_revalidate():
+            nodes = [doc async for doc in pillar.iter_nodes_cached(
+                parent_node_uuid='p', revalidated=revalidated, doc_cache=self.doc_cache)]
+            # Let a background revalidation finish.
+            while pillar._revalidations:
+                await asyncio.gather(*pillar._revalidations.values())
+            await asyncio.sleep(0)
+            return nodes
+
+        with unittest.mock.patch('blender_cloud.pillar.pillar_call', self.collection.pillar_call):
+            return asyncio.run(list_and_revalidate())
+
+    def test_second_listing_from_cache(self):
+        first = self.list_nodes()
+        self.assertEqual(1, len(self.collection.queries))
+
+        second = self.list_nodes()
+        self.assertEqual(1, len(self.collection.queries))
+        self.assertEqual([doc['_id'] for doc in first], [doc['_id'] for doc in second])
+        self.assertEqual('Parent', second[0].parent.name)
+
+    def test_revalidation(self):
+        self.list_nodes()
+        self.collection.queries.clear()
+
+        # One node changed, one was added.
+        self.collection.nodes[2] = node(2, etag='etag-1', name='renamed')
+        self.collection.nodes.append(node(5))
+        revalidated = unittest.mock.Mock()
+
+        with unittest.mock.patch('blender_cloud.pillar.NODE_CACHE_MAX_AGE', -1):
+            stale = self.list_nodes(revalidated)
+        self.assertEqual(5, len(stale))
+        revalidated.assert_called_once_with()
+
+        # Only the changed nodes were fetched completely.
+        etag_query, docs_query = self.collection.queries
+        self.assertEqual({'_etag': 1}, etag_query['projection'])
+        self.assertEqual(sorted(['%024x' % 2, '%024x' % 5]), docs_query['where']['_id']['$in'])
+
+        fresh = self.list_nodes()
+        self.assertEqual(2, len(self.collection.queries))
+        self.assertEqual(6, len(fresh))
+        self.assertEqual('renamed', fresh[2].name)
+
+    def test_unchanged_revalidation(self):
+        self.list_nodes()
+        self.collection.queries.clear()
+        revalidated = unittest.mock.Mock()
+
+        with unittest.mock.patch('blender_cloud.pillar.NODE_CACHE_MAX_AGE', -1):
+            self.list_nodes(revalidated)
+        self.assertEqual(1, len(self.collection.queries))
+        revalidated.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
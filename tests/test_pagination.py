@@ -0,0 +1,99 @@
+"""Unittests for the pagination of Pillar collections in blender_cloud.pillar."""
+
+import asyncio
+import unittest
+import unittest.mock
+
+import pillarsdk
+
+from blender_cloud import pillar
+
+
+class FakeNodeCollection:
+    """Answers Node.all() queries like Eve, with a maximum page size."""
+
+    def __init__(self, node_count: int, pagination_limit=25, links=True):
+        self.nodes = [{'_id': '%024x' % idx, 'name': 'node %i' % idx, 'node_type': 'texture'}
+                      for idx in range(node_count)]
+        self.pagination_limit = pagination_limit
+        self.links = links
+        self.requested_pages = []
+
+    async def pillar_call(self, pillar_func, *args, params: dict):
+        assert pillar_func == pillarsdk.Node.all
+        page = params['page']
+        self.requested_pages.append(page)
+        await asyncio.sleep(0)
+
+        max_results = min(params['max_results'], self.pagination_limit)
+        start = (page - 1) * max_results
+        response = {
+            '_items': [pillarsdk.Node(node) for node in self.nodes[start:start + max_results]],
+            '_meta': {'page': page, 'max_results': max_results, 'total': len(self.nodes)},
+        }
+        if self.links:
+            response['_links'] = {'self': {'href': 'nodes?page=%i' % page}}
+            if start + max_results < len(self.nodes):
+                response['_links']['next'] = {'href': 'nodes?page=%i' % (page + 1)}
+        return pillarsdk.Node.list_class(response)
+
+
+class PaginationTest(unittest.TestCase):
+    def run_with(self, collection: FakeNodeCollection, coro):
+        with unittest.mock.patch('blender_cloud.pillar.pillar_call', collection.pillar_call):
+            return asyncio.run(coro)
+
+    def test_get_nodes_all_pages(self):
+        collection = FakeNodeCollection(60)
+        nodes = self.run_with(collection, pillar.get_nodes(parent_node_uuid='p'))
+        self.assertEqual([node['_id'] for node in collection.nodes],
+                         [node['_id'] for node in nodes])
+        self.assertEqual([1, 2, 3], collection.requested_pages)
+
+    def test_without_links(self):
+        collection = FakeNodeCollection(50, links=False)
+        nodes = self.run_with(collection, pillar.get_nodes(parent_node_uuid='p'))
+        self.assertEqual(50, len(nodes))
+        self.assertEqual([1, 2], collection.requested_pages)
+
+    def test_max_results(self):
+        collection = FakeNodeCollection(60)
+        nodes = self.run_with(collection, pillar.get_nodes(parent_node_uuid='p', max_results=30))
+        self.assertEqual(30, len(nodes))
+
+    def test_prefetch(self):
+        collection = FakeNodeCollection(60)
+        seen = []
+
+        async def consume():
+            async for items in pillar.iter_node_pages(parent_node_uuid='p'):
+                # The next page has been requested before this one is processed.
+                await asyncio.sleep(0)
+                seen.append(list(collection.requested_pages))
+
+        self.run_with(collection, consume())
+        self.assertEqual([[1, 2], [1, 2, 3], [1, 2, 3]], seen)
+
+    def test_stop_early(self):
+        collection = FakeNodeCollection(100)
+
+        async def first_nodes() -> list:
+            nodes = []
+            iterator = pillar.iter_nodes(parent_node_uuid='p')
+            async for node in iterator:
+                nodes.append(node)
+                if len(nodes) == 30:
+                    break
+            await iterator.aclose()
+            await asyncio.sleep(0)
+            return nodes
+
+        nodes = self.run_with(collection, first_nodes())
+        self.assertEqual(30, len(nodes))
+        # Page 3 may have been prefetched when the caller stopped; page 4 never is.
+        self.assertEqual([1, 2], collection.requested_pages[:2])
+        self.assertNotIn(4, collection.requested_pages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,389 @@
+"""Unittests for blender_cloud.pillar.download_to_file().
+
+Downloads from a local HTTP server that supports range requests.
+"""
+
+import asyncio
+import gzip
+import http.server
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import pillarsdk
+
+from blender_cloud import async_http, blob_store, download_index, pillar
+
+CONTENT = bytes(range(256)) * 1000 + b'tail'
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Overridden per test, see AbstractDownloadTest.setUp().
+    content = b''
+    etag = '"v1"'
+    accept_ranges = True
+    requests = None
+    # When set, the next response body is cut off after this many bytes.
+    truncate_after = None
+    # When set, complete responses are sent with 'Content-Encoding: gzip' to clients
+    # that accept it.
+    gzip_encoded = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if match and self.accept_ranges and if_range in (None, self.etag):
+            start, end = int(match.group(1)), int(match.group(2))
+            body = self.content[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %i-%i/%i' % (start, end, len(self.content)))
+        else:
+            body = self.content
+            self.send_response(200)
+            if self.gzip_encoded and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+
+        if self.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.truncate_after is not None:
+            body = body[:self.truncate_after]
+            type(self).truncate_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class RangeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing the connection before the end of the body is expected.
+        pass
+
+
+class AbstractDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        handler = type('Handler', (RangeRequestHandler,),
+                       {'content': CONTENT, 'requests': self.requests})
+        self.handler = handler
+        self.server = RangeServer(('127.0.0.1', 0), handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%i/texture.exr' % self.server.server_port
+
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = pathlib.Path(self._tmpdir.name)
+        self.filename = str(self.tmpdir / 'subdir' / 'texture.exr')
+        self.index = download_index.DownloadIndex(str(self.tmpdir / 'downloads.sqlite'))
+
+        pillar._downloaded_urls.clear()
+        patcher = unittest.mock.patch('blender_cloud.pillar.SEGMENTED_DOWNLOAD_MIN_SIZE', 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.index.close()
+        self._tmpdir.cleanup()
+
+    def download(self, **kwargs):
+        coro = pillar.download_to_file(self.url, self.filename, index=self.index,
+                                       chunk_size=4096, **kwargs)
+        asyncio.run(coro)
+
+    def range_requests(self):
+        return sorted(request['Range'] for request in self.requests if 'Range' in request)
+
+
+class SegmentedDownloadTest(AbstractDownloadTest):
+    def test_segmented(self):
+        self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+
+        # The first segment is read from the initial GET response.
+        self.assertEqual(4, len(self.requests))
+        self.assertEqual(['bytes=128002-192002', 'bytes=192003-256003', 'bytes=64001-128001'],
+                         self.range_requests())
+        self.assertTrue(all(request.get('If-Range') == '"v1"'
+                            for request in self.requests if 'Range' in request))
+
+    def test_sequential_writes(self):
+        with unittest.mock.patch('blender_cloud.pillar._have_pwrite', False):
+            self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertEqual(3, len(self.range_requests()))
+
+    def test_single_stream(self):
+        self.download(segments=1)
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertEqual([], self.range_requests())
+
+    def test_no_range_support(self):
+        self.handler.accept_ranges = False
+        self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertEqual([], self.range_requests())
+
+    def test_small_file(self):
+        with unittest.mock.patch('blender_cloud.pillar.SEGMENTED_DOWNLOAD_MIN_SIZE',
+                                 len(CONTENT) + 1):
+            self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertEqual([], self.range_requests())
+
+    def test_gzip_encoded(self):
+        self.handler.gzip_encoded = True
+        self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertFalse(pathlib.Path(self.filename + '.part.journal').exists())
+        # The native transport only accepts the identity encoding, and can use ranges.
+        if 'gzip' in self.requests[0].get('Accept-Encoding', ''):
+            self.assertEqual([], self.range_requests())
+
+        # The length of the decoded file is stored, not the encoded Content-Length.
+        record = self.index.get(self.filename)
+        self.assertEqual(len(CONTENT), record.length)
+        self.requests.clear()
+        pillar._downloaded_urls.clear()
+        self.download()
+        self.assertEqual('"v1"', self.requests[0]['If-None-Match'])
+
+    def test_changed_during_download(self):
+        # If-Range doesn't match, so the server sends the entire new file.
+        self.handler.etag = '"v2"'
+        with unittest.mock.patch('blender_cloud.pillar._range_validator', return_value='"v1"'):
+            with self.assertRaises(pillar.PillarError):
+                self.download()
+        self.assertFalse(pathlib.Path(self.filename).exists())
+        self.assertFalse(pathlib.Path(self.filename + '.part').exists())
+
+    def test_revalidation(self):
+        self.download()
+        self.requests.clear()
+        pillar._downloaded_urls.clear()
+
+        # Second download is validated with the stored ETag.
+        self.download()
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual('"v1"', self.requests[0]['If-None-Match'])
+
+        # Third download doesn't even do that.
+        self.download()
+        self.assertEqual(1, len(self.requests))
+
+    def test_revalidation_with_record(self):
+        self.download()
+        record = self.index.get(self.filename)
+        self.requests.clear()
+        pillar._downloaded_urls.clear()
+
+        with unittest.mock.patch.object(self.index, 'get') as mock_get:
+            self.download(record=record)
+        mock_get.assert_not_called()
+        self.assertEqual('"v1"', self.requests[0]['If-None-Match'])
+
+    def test_changed_file_is_downloaded_again(self):
+        self.download()
+        pathlib.Path(self.filename).write_bytes(b'overwritten')
+        self.requests.clear()
+
+        self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertNotIn('If-None-Match', self.requests[0])
+
+    def test_migrate_header_store(self):
+        header_store = pathlib.Path(self.filename + '.headers')
+        header_store.parent.mkdir()
+        header_store.write_text(json.dumps({'ETag': '"v1"', 'Last-Modified': None,
+                                            'Content-Length': str(len(CONTENT))}))
+        pathlib.Path(self.filename).write_bytes(CONTENT)
+
+        self.download(header_store=str(header_store))
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual('"v1"', self.requests[0]['If-None-Match'])
+        self.assertFalse(header_store.exists())
+        self.assertEqual('"v1"', self.index.get(self.filename).etag)
+
+    def test_cancelled(self):
+        async def download_cancelled():
+            future = asyncio.get_event_loop().create_future()
+            future.cancel()
+            await pillar.download_to_file(self.url, self.filename, index=self.index,
+                                          future=future)
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(download_cancelled())
+        self.assertEqual([], self.requests)
+
+
+class ResumeDownloadTest(AbstractDownloadTest):
+    def setUp(self):
+        super().setUp()
+        patcher = unittest.mock.patch('blender_cloud.pillar.JOURNAL_SAVE_INTERVAL', 4096)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.part = pathlib.Path(self.filename + '.part')
+        self.journal = pathlib.Path(self.filename + '.part.journal')
+
+    def interrupted_download(self, **kwargs):
+        self.handler.truncate_after = 30000
+        with self.assertRaises(Exception):
+            self.download(**kwargs)
+        self.assertFalse(pathlib.Path(self.filename).exists())
+        self.assertTrue(self.part.exists())
+        self.assertTrue(self.journal.exists())
+        self.requests.clear()
+
+    def assertDownloadComplete(self):
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+        self.assertFalse(self.part.exists())
+        self.assertFalse(self.journal.exists())
+
+    def test_resume_single_stream(self):
+        self.interrupted_download(segments=1)
+
+        self.download(segments=1)
+        self.assertDownloadComplete()
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual('"v1"', self.requests[0]['If-Range'])
+        start = int(re.fullmatch(r'bytes=(\d+)-256003', self.requests[0]['Range']).group(1))
+        self.assertGreaterEqual(start, 20000)
+        self.assertLessEqual(start, 30000)
+
+    def test_resume_segmented(self):
+        self.interrupted_download()
+
+        self.download()
+        self.assertDownloadComplete()
+        # All segments were stopped when the first one failed; they are all
+        # resumed, without downloading the first segment's bytes again.
+        self.assertEqual(4, len(self.requests))
+        self.assertTrue(all(request['If-Range'] == '"v1"' for request in self.requests))
+        first_range = [request['Range'] for request in self.requests
+                       if request['Range'].endswith('-64000')]
+        self.assertEqual(1, len(first_range))
+        self.assertNotEqual('bytes=0-64000', first_range[0])
+
+    def test_changed_on_server(self):
+        self.interrupted_download(segments=1)
+        self.handler.content = CONTENT[::-1]
+        self.handler.etag = '"v2"'
+
+        self.download(segments=1)
+        self.assertEqual(CONTENT[::-1], pathlib.Path(self.filename).read_bytes())
+        self.assertFalse(self.journal.exists())
+
+    def test_other_url(self):
+        self.interrupted_download(segments=1)
+        self.url += '?v=2'
+
+        self.download(segments=1)
+        self.assertDownloadComplete()
+        self.assertEqual([], self.range_requests())
+
+    def test_index_record(self):
+        self.interrupted_download(segments=1)
+        self.download(segments=1)
+
+        # The length is the file length, not that of the range in the last response.
+        record = self.index.get(self.filename)
+        self.assertEqual((self.url, '"v1"', None, len(CONTENT)),
+                         (record.url, record.etag, record.last_modified, record.length))
+
+
+class DownloadFileByUuidTest(AbstractDownloadTest):
+    def setUp(self):
+        super().setUp()
+        self.store = blob_store.BlobStore(str(self.tmpdir / 'blobs'), index=self.index)
+        self.file_doc = {'_id': '5a1b2c3d', 'filename': 'brick.png', 'link': self.url,
+                         'md5': 'c0ffee'}
+
+        async def pillar_call(pillar_func, file_uuid, **kwargs):
+            return pillarsdk.File(self.file_doc)
+
+        for patcher in (unittest.mock.patch('blender_cloud.pillar.pillar_call', pillar_call),
+                        unittest.mock.patch('blender_cloud.blob_store.default_store',
+                                            return_value=self.store)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def download_file(self) -> pathlib.Path:
+        coro = pillar.download_file_by_uuid('5a1b2c3d', str(self.tmpdir / 'textures'),
+                                            str(self.tmpdir / 'metadata'), future=None)
+        asyncio.run(coro)
+        return self.tmpdir / 'textures' / 'brick.png'
+
+    def test_keyed_by_content_hash(self):
+        self.assertEqual(CONTENT, self.download_file().read_bytes())
+        self.assertTrue(os.path.exists(self.store.blob_path('5a1b2c3d-c0ffee')))
+
+        # A new version is stored as a new blob, even when the old one is still valid.
+        self.handler.content = b'new version'
+        self.file_doc['md5'] = 'decaf'
+        self.assertEqual(b'new version', self.download_file().read_bytes())
+        self.assertTrue(os.path.exists(self.store.blob_path('5a1b2c3d-decaf')))
+
+    def test_eviction_failure_is_logged(self):
+        with unittest.mock.patch.object(self.store, 'maybe_evict',
+                                        side_effect=OSError('disk on fire')), \
+                self.assertLogs('blender_cloud.pillar', 'WARNING') as logs:
+            self.assertEqual(CONTENT, self.download_file().read_bytes())
+        self.assertIn('disk on fire', '\n'.join(logs.output))
+
+
+class NativeTransportMixin:
+    """Runs the tests of the base class with async_http instead of 'requests'."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = unittest.mock.patch('blender_cloud.pillar.NATIVE_TRANSPORT', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        async_http.default_transport().close()
+        super().tearDown()
+
+
+class NativeSegmentedDownloadTest(NativeTransportMixin, SegmentedDownloadTest):
+    def test_keep_alive(self):
+        transport = async_http.default_transport()
+        opened = transport.connections_opened
+        self.download()
+        self.assertEqual(CONTENT, pathlib.Path(self.filename).read_bytes())
+
+        # The first response wasn't read until its end, so its connection is closed.
+        self.assertEqual(4, transport.connections_opened - opened)
+        self.assertEqual(3, transport.stats()['idle_connections'])
+
+
+class NativeResumeDownloadTest(NativeTransportMixin, ResumeDownloadTest):
+    pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Unittests for the batched File lookups of the texture browser."""
+
+import asyncio
+import unittest
+import unittest.mock
+
+import pillarsdk
+
+from blender_cloud import pillar
+
+
+class FakeFileCollection:
+    """Answers File.all() queries like Eve, with a maximum page size."""
+
+    def __init__(self, file_uuids, pagination_limit: int):
+        self.docs = {uuid: {'_id': uuid, 'file_path': '%s.png' % uuid,
+                            'variations': [{'size': 's', 'link': 'https://cdn/%s-s.jpg' % uuid}]}
+                     for uuid in file_uuids}
+        self.pagination_limit = pagination_limit
+        self.queries = []
+
+    async def pillar_call(self, pillar_func, params):
+        assert pillar_func == pillarsdk.File.all
+        self.queries.append(params)
+
+        matches = [self.docs[uuid] for uuid in params['where']['_id']['$in']
+                   if uuid in self.docs]
+        max_results = min(params['max_results'], self.pagination_limit)
+        start = (params['page'] - 1) * max_results
+        return pillarsdk.File.list_class({
+            '_items': [pillarsdk.File(doc) for doc in matches[start:start + max_results]],
+            '_meta': {'total': len(matches), 'max_results': max_results,
+                      'page': params['page']},
+        })
+
+
+class FetchFileDocsTest(unittest.TestCase):
+    def fetch(self, collection, uuids):
+        with unittest.mock.patch('blender_cloud.pillar.pillar_call', collection.pillar_call):
+            return asyncio.run(pillar.fetch_file_docs(uuids))
+
+    def test_single_query(self):
+        uuids = ['%024x' % idx for idx in range(60)]
+        collection = FakeFileCollection(uuids, pagination_limit=100)
+
+        docs = self.fetch(collection, uuids + uuids[:10])
+        self.assertEqual(sorted(uuids), sorted(docs))
+        self.assertEqual(1, len(collection.queries))
+        self.assertEqual(60, collection.queries[0]['max_results'])
+        self.assertIn('variations', collection.queries[0]['projection'])
+
+    def test_batches_and_pages(self):
+        uuids = ['%024x' % idx for idx in range(250)]
+        # Some files no longer exist.
+        collection = FakeFileCollection(uuids[5:], pagination_limit=40)
+
+        with unittest.mock.patch('blender_cloud.pillar.FILE_QUERY_BATCH_SIZE', 100):
+            docs = self.fetch(collection, uuids)
+        self.assertEqual(sorted(uuids[5:]), sorted(docs))
+
+        # Batches of 100, 100 and 50 UUIDs, in pages of at most 40 documents.
+        self.assertEqual([(1, 1), (1, 2), (1, 3),
+                          (2, 1), (2, 2), (2, 3),
+                          (3, 1), (3, 2)],
+                         sorted((1 + uuids.index(query['where']['_id']['$in'][0]) // 100,
+                                 query['page'])
+                                for query in collection.queries))
+
+    def test_no_files(self):
+        collection = FakeFileCollection([], pagination_limit=40)
+        self.assertEqual({}, self.fetch(collection, []))
+        self.assertEqual([], collection.queries)
+
+
+class ThumbnailLinkTest(unittest.TestCase):
+    def test_from_variations(self):
+        file_doc = pillarsdk.File({'_id': 'abc', 'variations': [
+            {'size': 's', 'link': 'https://cdn/abc-s.jpg'},
+            {'size': 'm'},
+        ]})
+        self.assertEqual('https://cdn/abc-s.jpg',
+                         pillar.thumbnail_link_from_variations(file_doc, 's'))
+        self.assertIsNone(pillar.thumbnail_link_from_variations(file_doc, 'm'))
+        self.assertIsNone(pillar.thumbnail_link_from_variations(file_doc, 'l'))
+        self.assertIsNone(pillar.thumbnail_link_from_variations(pillarsdk.File({}), 's'))
+
+
+if __name__ == '__main__':
+    unittest.main()
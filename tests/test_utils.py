@@ -1,6 +1,7 @@
 """Unittests for blender_cloud.utils."""
 
 import pathlib
+import tempfile
 import unittest
 
 from blender_cloud import utils
@@ -23,3 +24,38 @@ class FindInPathTest(unittest.TestCase):
         path = pathlib.Path(__file__).parent / 'test_really_breadth_first'
         found = utils.find_in_path(path, 'do_not_find_me.txt')
         self.assertEqual(None, found)
+
+
+class OpenIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = str(pathlib.Path(self.tmpdir.name) / 'subdir' / 'index.sqlite')
+
+    def open(self, version: int, schema: tuple):
+        conn = utils.open_index(self.path, version, schema)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_schema_versions(self):
+        conn = self.open(1, ('CREATE TABLE old (name TEXT)',
+                             'CREATE INDEX old_name ON old (name)'))
+        self.assertEqual('wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+        conn.execute("INSERT INTO old VALUES ('kept')")
+
+        # Same version, so the data is kept.
+        conn = self.open(1, ())
+        self.assertEqual([('kept', )], conn.execute('SELECT name FROM old').fetchall())
+
+        # A new version replaces all tables.
+        conn = self.open(2, ('CREATE TABLE new (name TEXT)', ))
+        tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        self.assertEqual([('new', )], tables)
+        self.assertEqual(2, conn.execute('PRAGMA user_version').fetchone()[0])
+
+    def test_remove_file(self):
+        path = pathlib.Path(self.tmpdir.name) / 'file'
+        path.write_bytes(b'')
+        utils.remove_file(str(path))
+        utils.remove_file(str(path))
+        self.assertFalse(path.exists())